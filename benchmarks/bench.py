@@ -0,0 +1,387 @@
+"""
+Benchmark Suite
+
+Times every metric and loader of the evaluation tool (and the Task 1/2
+scoring functions) on synthetic phantoms of several sizes, plus full
+cohort runs of several cohort sizes. Each case reports the median and
+minimum wall time over repeats and the peak traced memory of one extra
+run (tracemalloc, which includes numpy buffers). Cohort cases run in
+a fresh process each and report the peak RSS of that process and its
+workers instead.
+
+Results can be saved as a named baseline and later runs compared
+against it; the comparison exits non-zero on a regression.
+
+Usage (from project root):
+
+    python benchmarks/bench.py --sizes tiny,small --save_baseline main
+    python benchmarks/bench.py --sizes tiny,small --compare main
+"""
+
+import argparse
+import gc
+import importlib.util
+import json
+import multiprocessing
+import os
+import platform
+import re
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+# Benchmarks measure computation, never cached results
+os.environ.pop("EVAL_RESULT_STORE", None)
+os.environ.pop("EVAL_VOLUME_STORE", None)
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+
+sys.path.insert(0, os.path.join(REPO_ROOT, "evaluation_tool"))
+sys.path.append(os.path.join(REPO_ROOT, "src", "evaluation"))
+
+import numpy as np
+import nibabel as nib
+
+from metrics import (
+    VirtualDynamicImage,
+    compute_organ_bias_from_totalseg,
+    compute_tac_bias,
+    compute_whole_body_suv_mae,
+    configure_store,
+    get_cache,
+)
+from metrics.common import compute_k_values, iter_frames
+from metrics.label_stats import load_label_index
+from metrics.volume_cache import iter_slabs, load_labels, load_volume
+from metrics.volume_store import decode_volume
+from cohort import (
+    AORTA_LABEL,
+    BRAIN_THRESHOLDS,
+    ORGAN_LABELS,
+    TAC_BRAIN_LABELS,
+    run_cohort,
+    subject_paths,
+)
+from phantom import SIZES, make_cohort, parse_shape
+
+BASELINE_DIR = os.path.join(BENCH_DIR, "baselines")
+
+COHORT_FRAMES = 8
+
+
+class Seconds(float):
+    """
+    Returned by cases that time only part of their work.
+    """
+
+
+def _load_task_metrics():
+    # src/evaluation/metrics.py shares its module name with the
+    # evaluation tool's metrics package
+    spec = importlib.util.spec_from_file_location(
+        "task_metrics", os.path.join(REPO_ROOT, "src", "evaluation", "metrics.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+task_metrics = _load_task_metrics()
+
+
+# =========================================================
+# Cases
+# =========================================================
+
+def volume_cases(root, subject):
+    """
+    (name, fn) of every loader and metric on one phantom.
+    """
+
+    p = subject_paths(root, subject)
+    base = os.path.join(root, subject)
+    ref = os.path.join(base, "reference")
+    frame_durations = np.full(8, 4.0)
+    num_slices = nib.load(p["pred_pet"]).shape[2]
+
+    def store_load(warm):
+        store_dir = tempfile.mkdtemp(prefix="bench-store-")
+        try:
+            store = configure_store(store_dir)
+            if warm:
+                store.load(p["gt_pet"], np.float32)
+            start = time.perf_counter()
+            store.load(p["gt_pet"], np.float32)
+            return Seconds(time.perf_counter() - start)
+        finally:
+            configure_store(None)
+            shutil.rmtree(store_dir, ignore_errors=True)
+
+    def full_slab_pass():
+        for _ in iter_slabs(p["pred_pet"], [(0, num_slices)], 32, np.float32):
+            pass
+
+    def frame_pass():
+        for _ in iter_frames(VirtualDynamicImage(p["pred_pet"], 8)):
+            pass
+
+    return [
+        ("load.decode_pet", lambda: decode_volume(p["pred_pet"], np.float32)),
+        ("load.decode_labels", lambda: decode_volume(p["ts_total"])),
+        ("load.load_volume", lambda: load_volume(p["pred_pet"])),
+        ("load.load_labels", lambda: load_labels(p["ts_total"])),
+        ("load.store_cold", lambda: store_load(warm=False)),
+        ("load.store_warm", lambda: store_load(warm=True)),
+        ("load.slabs", full_slab_pass),
+        ("load.frames_virtual4d", frame_pass),
+        ("load.label_index", lambda: load_label_index(p["ts_total"], ORGAN_LABELS.values())),
+        ("metric.whole_body_mae", lambda: compute_whole_body_suv_mae(
+            p["pred_pet"], p["gt_pet"], p["ts_body"], p["ts_total"], p["meta_json"])),
+        ("metric.whole_body_mae_slabs", lambda: compute_whole_body_suv_mae(
+            p["pred_pet"], p["gt_pet"], p["ts_body"], p["ts_total"], p["meta_json"],
+            slab_thickness=32)),
+        ("metric.brain_k_values", lambda: compute_k_values(
+            p["pred_pet"], p["gt_pet"], p["synthseg"], thresholds=BRAIN_THRESHOLDS)),
+        ("metric.organ_bias", lambda: compute_organ_bias_from_totalseg(
+            p["pred_pet"], p["gt_pet"], p["ts_total"], ORGAN_LABELS, p["meta_json"])),
+        ("metric.tac_bias", lambda: compute_tac_bias(
+            VirtualDynamicImage(p["pred_pet"], 8), VirtualDynamicImage(p["gt_pet"], 8),
+            p["ts_total"], p["synthseg"], frame_durations, AORTA_LABEL, TAC_BRAIN_LABELS)),
+        ("task1.mae_ct", lambda: task_metrics.mae_ct(
+            nib.load(os.path.join(base, "predictions", "predicted_ct.nii.gz")),
+            nib.load(os.path.join(ref, f"{subject}_ct.nii.gz")),
+            nib.load(os.path.join(ref, f"{subject}_seg-body_dseg.nii.gz")))),
+        ("task2.mae_suv_pet", lambda: task_metrics.mae_suv_pet(
+            nib.load(os.path.join(base, "predictions", "reconstructed_pet.nii.gz")),
+            nib.load(os.path.join(ref, f"{subject}_pet.nii.gz")),
+            nib.load(os.path.join(ref, f"{subject}_seg-body_dseg.nii.gz")),
+            1.0)),
+    ]
+
+
+# =========================================================
+# Measurement
+# =========================================================
+
+def measure(fn, repeat):
+    """
+    Median/min wall time over ``repeat`` cold runs (empty volume
+    cache) and the tracemalloc peak of one more run.
+    """
+
+    walls = []
+
+    for _ in range(repeat):
+        get_cache().clear()
+        gc.collect()
+        start = time.perf_counter()
+        inner = fn()
+        wall = time.perf_counter() - start
+        walls.append(inner if isinstance(inner, Seconds) else wall)
+
+    get_cache().clear()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        get_cache().clear()
+
+    return {
+        "wall_median": statistics.median(walls),
+        "wall_min": min(walls),
+        "peak_bytes": peak,
+    }
+
+
+def measure_cohort(root, subjects, workers, repeat):
+    """
+    Cohort run timings and peak RSS, measured in a fresh process so
+    that the peak covers only this case (max RSS of reaped children
+    accumulates over the lifetime of a process).
+    """
+
+    context = multiprocessing.get_context("spawn")
+
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        walls, rss = executor.submit(
+            _cohort_case, root, subjects, workers, repeat
+        ).result()
+
+    return {
+        "wall_median": statistics.median(walls),
+        "wall_min": min(walls),
+        "peak_bytes": rss,
+        "subjects_per_s": len(subjects) / statistics.median(walls),
+    }
+
+
+def _cohort_case(root, subjects, workers, repeat):
+    walls = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows, _ = run_cohort(root, subjects, workers=workers, cache_mb=2048)
+        walls.append(time.perf_counter() - start)
+        failed = [r["subject"] for r in rows if r["error"]]
+        if failed:
+            raise RuntimeError(f"cohort benchmark failed for {failed}")
+
+    # ru_maxrss is in KiB on Linux
+    rss = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    ) * 1024
+
+    return walls, rss
+
+
+def run_benchmarks(data_dir, sizes, cohort_sizes, cohort_size_name, workers,
+                   repeat, only=None, log=print):
+    cases = {}
+    pattern = re.compile(only) if only else None
+
+    for size in sizes:
+        root = os.path.join(data_dir, size)
+        subject = make_cohort(root, 1, parse_shape(size))[0]
+
+        for name, fn in volume_cases(root, subject):
+            case = f"{name}[{size}]"
+            if pattern and not pattern.search(case):
+                continue
+            cases[case] = measure(fn, repeat)
+            log(_format_case(case, cases[case]))
+
+    for n in cohort_sizes:
+        case = f"cohort.run_cohort[{cohort_size_name}x{n},workers={min(workers, n)}]"
+        if pattern and not pattern.search(case):
+            continue
+        # Dynamic phantoms, so the TAC metric runs on real 4D files
+        root = os.path.join(data_dir, f"{cohort_size_name}-dynamic")
+        subjects = make_cohort(root, n, parse_shape(cohort_size_name), frames=COHORT_FRAMES)
+        cases[case] = measure_cohort(root, subjects[:n], min(workers, n), repeat)
+        log(_format_case(case, cases[case]))
+
+    return {
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "nibabel": nib.__version__,
+            "cpus": os.cpu_count(),
+        },
+        "repeat": repeat,
+        "cases": cases,
+    }
+
+
+def _format_case(case, result):
+    peak = result["peak_bytes"]
+    peak = "-" if peak is None else f"{peak / 1024 ** 2:.1f} MB"
+    return f"{case:<58}{result['wall_median'] * 1e3:>11.1f} ms{peak:>12}"
+
+
+# =========================================================
+# Baselines
+# =========================================================
+
+def baseline_path(name):
+    return os.path.join(BASELINE_DIR, f"{name}.json")
+
+
+def compare(results, baseline, time_tolerance, memory_tolerance):
+    """
+    Ratio of every case present in both runs; returns the report lines
+    and the cases slower or larger than the tolerances allow.
+    """
+
+    lines = [f"{'case':<58}{'time':>9}{'memory':>9}"]
+    regressions = []
+
+    for case, new in results["cases"].items():
+        old = baseline["cases"].get(case)
+        if old is None:
+            continue
+
+        time_ratio = new["wall_median"] / old["wall_median"] if old["wall_median"] else float("nan")
+        if new["peak_bytes"] and old["peak_bytes"]:
+            mem_ratio = new["peak_bytes"] / old["peak_bytes"]
+        else:
+            mem_ratio = float("nan")
+
+        flag = ""
+        if time_ratio > time_tolerance or mem_ratio > memory_tolerance:
+            regressions.append(case)
+            flag = "  REGRESSION"
+
+        lines.append(f"{case:<58}{time_ratio:>8.2f}x{mem_ratio:>8.2f}x{flag}")
+
+    return lines, regressions
+
+
+# =========================================================
+# Main
+# =========================================================
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Evaluation benchmark suite")
+    parser.add_argument("--data_dir", default=os.path.join(tempfile.gettempdir(), "bic-mac-bench"),
+                        help="Phantom cache directory (generated on first use)")
+    parser.add_argument("--sizes", default="tiny,small",
+                        help=f"Comma-separated volume sizes ({', '.join(SIZES)} or X,Y,Z)")
+    parser.add_argument("--cohort_sizes", default="4",
+                        help="Comma-separated cohort sizes for the run_cohort cases ('' to skip)")
+    parser.add_argument("--cohort_volume", default="tiny", help="Volume size of the cohort phantoms")
+    parser.add_argument("--workers", type=int, default=4, help="Workers of the cohort cases")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", help="Regex selecting case names")
+    parser.add_argument("--output", help="Write the results JSON here")
+    parser.add_argument("--save_baseline", metavar="NAME", help="Store the results as benchmarks/baselines/NAME.json")
+    parser.add_argument("--compare", metavar="NAME", help="Compare against a stored baseline (or a results file)")
+    parser.add_argument("--time_tolerance", type=float, default=1.25, help="Allowed time ratio (default: 1.25)")
+    parser.add_argument("--memory_tolerance", type=float, default=1.10, help="Allowed peak memory ratio (default: 1.10)")
+
+    args = parser.parse_args()
+
+    sizes = [s for s in args.sizes.split(",") if s]
+    cohort_sizes = [int(n) for n in args.cohort_sizes.split(",") if n]
+
+    results = run_benchmarks(
+        args.data_dir, sizes, cohort_sizes, args.cohort_volume,
+        args.workers, args.repeat, only=args.only,
+    )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(baseline_path(args.save_baseline), "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {baseline_path(args.save_baseline)}")
+
+    if args.compare:
+        path = args.compare if os.path.exists(args.compare) else baseline_path(args.compare)
+        with open(path, "r") as f:
+            baseline = json.load(f)
+
+        lines, regressions = compare(results, baseline, args.time_tolerance, args.memory_tolerance)
+        print("\n".join(lines))
+
+        if regressions:
+            print(f"{len(regressions)} regression(s) against {path}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,406 @@
+"""
+Synthetic Phantom Generator
+
+Writes deterministic synthetic subjects in the file layout used by
+the evaluation tool and the challenge scripts, so the metrics can be
+exercised and benchmarked without patient data.
+
+Per subject ``<root>/<subject>/``:
+
+    features/   nacstat PET (the "prediction"), constants.json
+    labels/     acstat PET, TotalSegmentator body and total labels,
+                SynthSeg labels
+    input/      container input: nacstat PET, DIXON body/chunks/head,
+                topogram, metadata.json
+    reference/  Task 1/2 labels: CT, PET, body segmentation, suv.txt
+    predictions/predicted_ct.nii.gz, reconstructed_pet.nii.gz
+
+Usage (from project root):
+
+    python benchmarks/phantom.py data/phantoms --subjects 4 --size medium
+    python benchmarks/phantom.py data/phantoms --size quadra --frames 8
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+import nibabel as nib
+
+
+# =========================================================
+# Geometry
+# =========================================================
+
+# Axial FOV of a Biograph Vision Quadra reconstruction (mm):
+# 440 x 440 x 645 voxels of 1.65 mm
+QUADRA_FOV_MM = (726.0, 726.0, 1064.25)
+
+SIZES = {
+    "tiny": (48, 48, 72),
+    "small": (96, 96, 144),
+    "medium": (192, 192, 288),
+    "large": (320, 320, 470),
+    "quadra": (440, 440, 645),
+}
+
+# Slices generated at a time (bounds float temporaries)
+SLAB_SLICES = 32
+
+# TotalSegmentator ids as scored by the evaluation tool (organ bias /
+# TAC bias / whole-body MAE). Its organ table scores "heart" as label
+# 52, the TAC aorta label, so heart and aorta share it here.
+SPLEEN, LIVER, PANCREAS, AORTA = 1, 5, 10, 52
+HEART = AORTA
+BRAIN, MUSCLE, ADIPOSE, EXTREMITIES = 90, 200, 201, 300
+
+# SynthSeg ids: white matter, cortex, thalamus, cerebellum (L, R)
+WM_L, CORTEX_L, THALAMUS_L, CEREBELLUM_L = 2, 3, 10, 8
+WM_R, CORTEX_R, THALAMUS_R, CEREBELLUM_R = 41, 42, 49, 47
+
+# Mean activity (kBq/ml) of the reference PET per region
+ACTIVITY = {
+    0: 1.5, SPLEEN: 5.0, LIVER: 6.0, PANCREAS: 3.0, AORTA: 4.0,
+    BRAIN: 10.0, MUSCLE: 1.2, ADIPOSE: 0.5, EXTREMITIES: 1.0,
+}
+
+BRAIN_ACTIVITY = {
+    WM_L: 4.0, WM_R: 4.0, CORTEX_L: 12.0, CORTEX_R: 12.0,
+    THALAMUS_L: 11.0, THALAMUS_R: 11.0, CEREBELLUM_L: 9.0, CEREBELLUM_R: 9.0,
+}
+
+# CT numbers (HU) per region
+HOUNSFIELD = {
+    0: 40, SPLEEN: 50, LIVER: 60, PANCREAS: 40, AORTA: 45,
+    BRAIN: 35, MUSCLE: 55, ADIPOSE: -100, EXTREMITIES: 50,
+}
+
+AIR_HU = -1000
+
+
+def _ellipsoid(x, y, z, center, radii):
+    return (
+        ((x - center[0]) / radii[0]) ** 2
+        + ((y - center[1]) / radii[1]) ** 2
+        + ((z - center[2]) / radii[2]) ** 2
+    ) <= 1.0
+
+
+def _slab_labels(shape, z0, z1):
+    """
+    Body mask, TotalSegmentator and SynthSeg labels of slices
+    ``z0:z1``, in normalized coordinates (x, y in [-1, 1], z in
+    [0, 1] from feet to head), so anatomy scales with the grid.
+    """
+
+    x = np.linspace(-1, 1, shape[0], dtype=np.float32)[:, None, None]
+    y = np.linspace(-1, 1, shape[1], dtype=np.float32)[None, :, None]
+    z = np.linspace(0, 1, shape[2], dtype=np.float32)[None, None, z0:z1]
+
+    head = z > 0.86
+    rx = np.where(head, 0.22, 0.62)
+    ry = np.where(head, 0.26, 0.40)
+    ellipse = (x / rx) ** 2 + (y / ry) ** 2
+    body = (ellipse <= 1.0) & (z > 0.02) & (z < 0.98)
+
+    total = np.zeros(body.shape, dtype=np.int16)
+    total[body] = np.broadcast_to(
+        np.where(z < 0.35, EXTREMITIES, 0), body.shape
+    )[body]
+    total[body & (ellipse > 0.72)] = MUSCLE
+    total[body & (ellipse > 0.88)] = ADIPOSE
+
+    organs = [
+        (LIVER, (-0.22, 0.0, 0.55), (0.22, 0.18, 0.07)),
+        (SPLEEN, (0.30, 0.05, 0.56), (0.08, 0.08, 0.035)),
+        (PANCREAS, (0.05, 0.10, 0.53), (0.12, 0.04, 0.02)),
+        (HEART, (0.05, -0.05, 0.66), (0.15, 0.13, 0.05)),
+        (BRAIN, (0.0, 0.0, 0.92), (0.18, 0.22, 0.045)),
+    ]
+    for label, center, radii in organs:
+        total[_ellipsoid(x, y, z, center, radii) & body] = label
+
+    aorta = ((x - 0.02) ** 2 + (y + 0.14) ** 2 <= 0.035 ** 2) & (z > 0.42) & (z < 0.68)
+    total[aorta & body] = AORTA
+
+    synthseg = np.zeros(body.shape, dtype=np.int16)
+    brain = total == BRAIN
+    left = np.broadcast_to(x < 0, body.shape)
+    inner = _ellipsoid(x, y, z, (0.0, 0.0, 0.92), (0.13, 0.17, 0.032))
+    synthseg[brain & left] = CORTEX_L
+    synthseg[brain & ~left] = CORTEX_R
+    synthseg[brain & inner & left] = WM_L
+    synthseg[brain & inner & ~left] = WM_R
+    synthseg[brain & _ellipsoid(x, y, z, (-0.04, 0.0, 0.92), (0.03, 0.04, 0.01))] = THALAMUS_L
+    synthseg[brain & _ellipsoid(x, y, z, (0.04, 0.0, 0.92), (0.03, 0.04, 0.01))] = THALAMUS_R
+    cerebellum = brain & (np.broadcast_to(y, body.shape) > 0.1) & (np.broadcast_to(z, body.shape) < 0.905)
+    synthseg[cerebellum & left] = CEREBELLUM_L
+    synthseg[cerebellum & ~left] = CEREBELLUM_R
+
+    return body, total, synthseg
+
+
+def _lookup(table, labels, default=0.0, dtype=np.float32):
+    lut = np.full(int(max(table)) + 1, default, dtype=dtype)
+    for label, value in table.items():
+        lut[label] = value
+    return lut[np.clip(labels, 0, len(lut) - 1)]
+
+
+# =========================================================
+# Subject
+# =========================================================
+
+def make_phantom(root, subject, shape=SIZES["small"], frames=0, seed=0,
+                 weight_kg=75.0, dose_mbq=250.0):
+    """
+    Write one synthetic subject under ``root/subject``.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Grid size; the voxel size is chosen so the grid covers the
+        Quadra FOV.
+    frames : int
+        0 → 3D PET; > 0 → dynamic PET with that many frames (and a
+        FrameDuration sidecar).
+    seed : int
+        Subjects with the same seed, name and shape are identical.
+
+    Returns
+    -------
+    paths : dict
+        The written files, keyed by role.
+    """
+
+    shape = tuple(int(s) for s in shape)
+    zooms = [fov / n for fov, n in zip(QUADRA_FOV_MM, shape)]
+    affine = np.diag(zooms + [1.0])
+    affine[:3, 3] = [-fov / 2 for fov in QUADRA_FOV_MM[:2]] + [0.0]
+
+    index = sum(ord(c) * 31 ** i for i, c in enumerate(subject)) % 100003
+    rng = np.random.default_rng([seed, index])
+
+    base = os.path.join(root, subject)
+    dirs = {d: os.path.join(base, d) for d in
+            ("features", "labels", "input", "reference", "predictions")}
+    for d in dirs.values():
+        os.makedirs(d, exist_ok=True)
+
+    # -----------------------------------------------------
+    # Volumes: labels and intensities computed slab by slab
+    # (bounded temporaries) into full in-memory volumes
+    # -----------------------------------------------------
+
+    body = np.zeros(shape, dtype=np.uint8)
+    total = np.zeros(shape, dtype=np.int16)
+    synthseg = np.zeros(shape, dtype=np.int16)
+    gt = np.zeros(shape, dtype=np.float32)
+    pred = np.zeros(shape, dtype=np.float32)
+    ct = np.zeros(shape, dtype=np.int16)
+    ct_pred = np.zeros(shape, dtype=np.int16)
+
+    # Systematic per-region error of the synthetic prediction
+    region_bias = {label: rng.normal(0.0, 0.05) for label in ACTIVITY}
+
+    for z0 in range(0, shape[2], SLAB_SLICES):
+        z1 = min(z0 + SLAB_SLICES, shape[2])
+        b, t, s = _slab_labels(shape, z0, z1)
+
+        body[..., z0:z1] = b
+        total[..., z0:z1] = t
+        synthseg[..., z0:z1] = s
+
+        activity = _lookup(ACTIVITY, t)
+        brain = s > 0
+        activity[brain] = _lookup(BRAIN_ACTIVITY, s[brain])
+        activity *= b
+        noise = rng.gamma(25.0, 1 / 25.0, size=activity.shape).astype(np.float32)
+        gt[..., z0:z1] = activity * noise
+
+        bias = 1.0 + _lookup(region_bias, t)
+        pred_noise = rng.normal(1.0, 0.08, size=activity.shape).astype(np.float32)
+        pred[..., z0:z1] = np.maximum(gt[..., z0:z1] * bias * pred_noise, 0)
+
+        hu = np.where(b, _lookup(HOUNSFIELD, t), AIR_HU).astype(np.int16)
+        ct[..., z0:z1] = hu
+        ct_pred[..., z0:z1] = np.where(
+            b, hu + rng.normal(0, 25, size=hu.shape), AIR_HU
+        ).astype(np.int16)
+
+    # -----------------------------------------------------
+    # Files
+    # -----------------------------------------------------
+
+    def save(data, directory, name, aff=affine):
+        path = os.path.join(directory, f"{subject}_{name}.nii.gz")
+        nib.save(nib.Nifti1Image(data, aff), path)
+        return path
+
+    paths = {}
+
+    if frames > 0:
+        durations = _frame_durations(frames)
+        pred_pet, gt_pet = _dynamic(pred, total, frames), _dynamic(gt, total, frames)
+    else:
+        durations = None
+        pred_pet, gt_pet = pred, gt
+
+    paths["pred_pet"] = save(pred_pet, dirs["features"], "ses-quadra_trc-18FFDG_rec-nacstatOSEM_pet")
+    paths["gt_pet"] = save(gt_pet, dirs["labels"], "ses-quadra_trc-18FFDG_rec-acstatOSEM_pet")
+    del pred_pet, gt_pet
+
+    if durations is not None:
+        for key in ("pred_pet", "gt_pet"):
+            _write_json(paths[key].replace(".nii.gz", ".json"),
+                        {"FrameDuration": durations.tolist()})
+
+    paths["ts_body"] = save(body, dirs["labels"], "ses-quadra_acq-LOWDOSE_ce-none_rec-ac_seg-body_space-individual_dseg")
+    paths["ts_total"] = save(total, dirs["labels"], "ses-quadra_acq-LOWDOSE_ce-none_rec-ac_seg-total_space-individual_dseg")
+    paths["synthseg"] = save(synthseg, dirs["labels"], "ses-vida_task-rest_acq-MPRAGE_seg-synthsegparc_space-individual_dseg")
+
+    paths["meta_json"] = os.path.join(dirs["features"], "constants.json")
+    _write_json(paths["meta_json"], {"PatientWeight": weight_kg, "InjectedRadioactivity": dose_mbq})
+
+    # kBq/ml per SUV unit
+    suv = dose_mbq * 1e3 / weight_kg
+
+    # Container input
+    paths["input_pet"] = save(pred, dirs["input"], "ses-quadra_trc-18FFDG_nacstat_pet")
+    paths.update(_write_mr_inputs(subject, dirs["input"], total, body, affine, rng))
+    _write_json(os.path.join(dirs["input"], "metadata.json"), {"suv": suv})
+
+    # Task 1/2 references and predictions
+    paths["ref_ct"] = save(ct, dirs["reference"], "ct")
+    paths["ref_pet"] = save(gt, dirs["reference"], "pet")
+    paths["ref_body"] = save(body, dirs["reference"], "seg-body_dseg")
+    with open(os.path.join(dirs["reference"], "suv.txt"), "w") as f:
+        f.write(f"{suv}\n")
+
+    paths["predicted_ct"] = os.path.join(dirs["predictions"], "predicted_ct.nii.gz")
+    nib.save(nib.Nifti1Image(ct_pred, affine), paths["predicted_ct"])
+    paths["reconstructed_pet"] = os.path.join(dirs["predictions"], "reconstructed_pet.nii.gz")
+    nib.save(nib.Nifti1Image(pred, affine), paths["reconstructed_pet"])
+
+    return paths
+
+
+def _frame_durations(frames):
+    # Short early frames, longer late frames (seconds)
+    return np.round(np.geomspace(10, 300, frames))
+
+
+def _dynamic(static, total, frames):
+    """
+    Dynamic PET whose time-integral shape follows the static image:
+    blood pool peaks early and washes out, tissue uptake rises.
+    """
+
+    t = np.linspace(0, 1, frames, dtype=np.float32)
+    blood = total == AORTA
+
+    dynamic = np.empty(static.shape + (frames,), dtype=np.float32)
+    for i, ti in enumerate(t):
+        tissue_curve = 1.0 - np.exp(-4.0 * ti) + 0.05
+        blood_curve = np.exp(-3.0 * ti) + 0.3
+        dynamic[..., i] = static * np.where(blood, blood_curve, tissue_curve)
+
+    return dynamic
+
+
+def _write_mr_inputs(subject, directory, total, body, affine, rng):
+    """
+    DIXON in/opposed phase (whole body, 4 overlapping z chunks, head)
+    and a topogram, derived from the labels.
+    """
+
+    fat = np.isin(total, (ADIPOSE,)).astype(np.float32)
+    water = body.astype(np.float32) - fat
+    inphase = (water * 300 + fat * 600) * rng.normal(1, 0.03, size=body.shape).astype(np.float32)
+    outphase = np.abs(water * 300 - fat * 600).astype(np.float32)
+
+    def save(data, name, aff=affine):
+        path = os.path.join(directory, f"{subject}_{name}.nii.gz")
+        nib.save(nib.Nifti1Image(data.astype(np.float32), aff), path)
+        return path
+
+    def shifted(z0):
+        aff = affine.copy()
+        aff[:3, 3] += affine[:3, 2] * z0
+        return aff
+
+    paths = {
+        "dixon_body_in": save(inphase, "ses-quadra_acq-DIXONbodyIN_T1w"),
+        "dixon_body_out": save(outphase, "ses-quadra_acq-DIXONbodyOUT_T1w"),
+    }
+
+    nz = body.shape[2]
+    step = nz // 4
+    overlap = max(1, step // 8)
+    for i in range(4):
+        z0 = max(0, i * step - overlap)
+        z1 = nz if i == 3 else min(nz, (i + 1) * step + overlap)
+        aff = shifted(z0)
+        paths[f"dixon_chunk{i + 1}_in"] = save(inphase[..., z0:z1], f"ses-quadra_acq-DIXONbodyIN_chunk-{i + 1}_T1w", aff)
+        paths[f"dixon_chunk{i + 1}_out"] = save(outphase[..., z0:z1], f"ses-quadra_acq-DIXONbodyOUT_chunk-{i + 1}_T1w", aff)
+
+    z_head = int(nz * 0.84)
+    paths["dixon_head_in"] = save(inphase[..., z_head:], "ses-quadra_acq-DIXONheadIN_T1w", shifted(z_head))
+    paths["dixon_head_out"] = save(outphase[..., z_head:], "ses-quadra_acq-DIXONheadOUT_T1w", shifted(z_head))
+
+    topogram = (body.sum(axis=1, dtype=np.float32) * 10)[:, None, :]
+    paths["topogram"] = save(topogram, "ses-quadra_acq-TOPOGRAM_rec-tr20f_Xray")
+
+    return paths
+
+
+def _write_json(path, data):
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
+
+
+def make_cohort(root, num_subjects, shape=SIZES["small"], frames=0, seed=0):
+    """
+    Write ``num_subjects`` phantoms named sub-000, sub-001, ...
+    Existing subjects are kept (delete ``root`` to regenerate).
+    """
+
+    subjects = [f"sub-{i:03d}" for i in range(num_subjects)]
+
+    for subject in subjects:
+        marker = os.path.join(root, subject, "reference", "suv.txt")
+        if not os.path.exists(marker):
+            make_phantom(root, subject, shape=shape, frames=frames, seed=seed)
+
+    return subjects
+
+
+# =========================================================
+# Main
+# =========================================================
+
+def parse_shape(value):
+    if value in SIZES:
+        return SIZES[value]
+    return tuple(int(v) for v in value.split(","))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Synthetic phantom generator")
+    parser.add_argument("root", help="Output directory")
+    parser.add_argument("--subjects", type=int, default=1, help="Number of subjects (default: 1)")
+    parser.add_argument("--size", default="small",
+                        help=f"One of {', '.join(SIZES)} or X,Y,Z (default: small)")
+    parser.add_argument("--frames", type=int, default=0, help="Frames of dynamic PET (default: 0 = 3D)")
+    parser.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+
+    subjects = make_cohort(args.root, args.subjects, parse_shape(args.size), args.frames, args.seed)
+    print(f"{len(subjects)} phantom(s) in {args.root}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,508 @@
+"""
+Subject and Cohort Evaluation
+
+Evaluates one subject, or fans a cohort of subjects out over a
+process pool and combines the per-subject results into cohort-level
+scores (including the cohort AUC of K for the brain outlier metric).
+"""
+
+import csv
+import glob
+import json
+import multiprocessing
+import os
+import resource
+
+import numpy as np
+import nibabel as nib
+
+from metrics import (
+    compute_whole_body_suv_mae,
+    compute_brain_k_values,
+    brain_outlier_score_from_k,
+    brain_outlier_case_scores,
+    bootstrap_indices,
+    bootstrap_mean,
+    compute_organ_bias_from_totalseg,
+    compute_tac_bias,
+    configure_cache,
+    configure_result_store,
+    configure_store,
+    get_cache,
+    profiled,
+    set_pet_dtype,
+    aggregate_profiles,
+    chrome_trace,
+    start_profiling,
+    stop_profiling,
+    summarize_spans,
+    load_frame_durations,
+    load_image,
+    sidecar_json_path,
+    VirtualDynamicImage,
+)
+
+
+METRICS = ["whole_body_mae", "brain_outlier", "organ_bias", "tac_bias"]
+
+METRIC_NAMES = {
+    "whole_body_mae": "Whole-body SUV MAE",
+    "brain_outlier": "Brain Outlier Score",
+    "organ_bias": "Organ Bias",
+    "tac_bias": "TAC Bias",
+}
+
+ORGAN_LABELS = {
+    "brain": 90,
+    "liver": 5,
+    "spleen": 1,
+    "heart": 52,
+    "pancreas": 10,
+    "muscle": 200,
+    "adipose": 201,
+    "extremities": 300,
+}
+
+AORTA_LABEL = 52
+TAC_BRAIN_LABELS = [3, 42, 10, 49, 8, 47]
+BRAIN_THRESHOLDS = (0.05, 0.10, 0.15)
+
+
+# =========================================================
+# Helper: Simulate 4D PET (for testing only)
+# =========================================================
+
+def expand_to_4d(pet_path, num_frames=8):
+    """
+    Expand 3D PET into 4D by repeating volume.
+    Used only for local testing when dynamic PET
+    is not available.
+
+    Returns an in-memory ``VirtualDynamicImage`` whose frames are
+    views of the 3D volume; nothing is copied or written to disk.
+    """
+
+    if len(nib.load(pet_path).shape) == 4:
+        return pet_path  # already dynamic
+
+    return VirtualDynamicImage(pet_path, num_frames)
+
+
+# =========================================================
+# Single Subject
+# =========================================================
+
+def subject_paths(root, subject):
+    """
+    Input file paths of one subject (adjust if naming changes).
+    """
+
+    subject_path = os.path.join(root, subject)
+
+    features_path = os.path.join(subject_path, "features")
+    labels_path = os.path.join(subject_path, "labels")
+
+    return {
+        "pred_pet": os.path.join(
+            features_path,
+            f"{subject}_ses-quadra_trc-18FFDG_rec-nacstatOSEM_pet.nii.gz"
+        ),
+        "gt_pet": os.path.join(
+            labels_path,
+            f"{subject}_ses-quadra_trc-18FFDG_rec-acstatOSEM_pet.nii.gz"
+        ),
+        "ts_body": os.path.join(
+            labels_path,
+            f"{subject}_ses-quadra_acq-LOWDOSE_ce-none_rec-ac_seg-body_space-individual_dseg.nii.gz"
+        ),
+        "ts_total": os.path.join(
+            labels_path,
+            f"{subject}_ses-quadra_acq-LOWDOSE_ce-none_rec-ac_seg-total_space-individual_dseg.nii.gz"
+        ),
+        "synthseg": os.path.join(
+            labels_path,
+            f"{subject}_ses-vida_task-rest_acq-MPRAGE_seg-synthsegparc_space-individual_dseg.nii.gz"
+        ),
+        "meta_json": os.path.join(features_path, "constants.json"),
+    }
+
+
+@profiled("subject")
+def evaluate_subject(root, subject, metrics=METRICS, pet_unit="kBq",
+                     test_4d=False, debug=False, slab_thickness=None,
+                     pred_pet=None):
+    """
+    Run the selected metrics on one subject.
+
+    ``pred_pet`` replaces the subject's predicted PET (e.g. one team's
+    submission); all other inputs come from ``root``.
+
+    ``slab_thickness`` streams the whole-body MAE in z-slabs of that
+    many slices instead of loading whole volumes.
+
+    Returns
+    -------
+    results : dict
+        Metric id → value, for every metric that could be computed.
+    brain_k_values : list of float or None
+        Per-threshold k values of this subject, needed to build the
+        cohort-level brain outlier score.
+    """
+
+    paths = subject_paths(root, subject)
+
+    pred_pet = pred_pet or paths["pred_pet"]
+    gt_pet = paths["gt_pet"]
+
+    # -----------------------------------------------------
+    # Optionally simulate dynamic PET (brain and TAC metrics;
+    # the static metrics of a repeated volume are those of
+    # the 3D volume itself)
+    # -----------------------------------------------------
+
+    pred_dynamic = pred_pet
+    gt_dynamic = gt_pet
+
+    if test_4d:
+        pred_dynamic = expand_to_4d(pred_pet)
+        gt_dynamic = expand_to_4d(gt_pet)
+
+    results = {}
+    brain_k_values = None
+
+    # =====================================================
+    # 1. Whole-body SUV MAE
+    # =====================================================
+
+    if "whole_body_mae" in metrics:
+
+        results["whole_body_mae"] = compute_whole_body_suv_mae(
+            pred_pet_path=pred_pet,
+            gt_pet_path=gt_pet,
+            body_mask_path=paths["ts_body"],
+            liver_mask_path=paths["ts_total"],
+            json_path=paths["meta_json"],
+            pet_unit=pet_unit,
+            debug=debug,
+            slab_thickness=slab_thickness,
+        )
+
+    # =====================================================
+    # 2. Brain Outlier Score
+    # =====================================================
+
+    if "brain_outlier" in metrics:
+
+        k_values = compute_brain_k_values(
+            pred_paths=[pred_dynamic],
+            gt_paths=[gt_dynamic],
+            brain_mask_paths=[paths["synthseg"]],
+            thresholds=BRAIN_THRESHOLDS
+        )
+
+        results["brain_outlier"] = brain_outlier_score_from_k(k_values)
+        brain_k_values = k_values[0].tolist()
+
+    # =====================================================
+    # 3. Organ Bias
+    # =====================================================
+
+    if "organ_bias" in metrics:
+
+        results["organ_bias"] = compute_organ_bias_from_totalseg(
+            pred_path=pred_pet,
+            gt_path=gt_pet,
+            totalseg_path=paths["ts_total"],
+            organ_label_dict=ORGAN_LABELS,
+            json_path=paths["meta_json"],
+            pet_unit=pet_unit
+        )
+
+    # =====================================================
+    # 4. TAC Bias (Dynamic Only)
+    # =====================================================
+
+    if "tac_bias" in metrics:
+
+        pet_shape = load_image(pred_dynamic).shape
+
+        if len(pet_shape) != 4:
+            print(f"TAC Bias skipped for {subject}: PET is not dynamic (4D).")
+        else:
+            frame_durations = load_frame_durations(
+                [
+                    sidecar_json_path(pred_pet),
+                    sidecar_json_path(gt_pet),
+                    paths["meta_json"],
+                ],
+                num_frames=pet_shape[-1],
+            )
+
+            results["tac_bias"] = compute_tac_bias(
+                pred_path=pred_dynamic,
+                gt_path=gt_dynamic,
+                totalseg_path=paths["ts_total"],
+                synthseg_path=paths["synthseg"],
+                frame_durations=frame_durations,
+                aorta_label=AORTA_LABEL,
+                brain_label_ids=TAC_BRAIN_LABELS
+            )
+
+    return results, brain_k_values
+
+
+# =========================================================
+# Cohort
+# =========================================================
+
+def resolve_subjects(root, subjects=None, subject_list=None, pattern=None):
+    """
+    Subject identifiers from an explicit list, a text file with one
+    subject per line, and/or a glob pattern matched under ``root``.
+    """
+
+    resolved = list(subjects or [])
+
+    if subject_list:
+        with open(subject_list, "r") as f:
+            resolved += [line.strip() for line in f if line.strip()]
+
+    if pattern:
+        matches = glob.glob(os.path.join(root, pattern))
+        resolved += sorted(
+            os.path.basename(m) for m in matches if os.path.isdir(m)
+        )
+
+    # Keep first occurrence, preserve order
+    return list(dict.fromkeys(resolved))
+
+
+def _configure_run(cache_bytes, precision, store_config, result_store=None):
+    """
+    Run-wide setup of the evaluating process: shrink the volume
+    cache, apply the precision policy and open the persistent volume
+    and result stores.
+    """
+
+    configure_cache(cache_bytes)
+    set_pet_dtype(precision)
+
+    if store_config is not None:
+        configure_store(*store_config)
+
+    if result_store is not None:
+        configure_result_store(result_store)
+
+
+def _init_worker(worker_mem_bytes, *settings):
+    """
+    Pool worker setup: ``_configure_run(*settings)``, then optionally
+    cap the address space so one oversized subject fails instead of
+    the node. Pool processes only: in the calling process the cap
+    would outlive the run.
+    """
+
+    _configure_run(*settings)
+
+    if worker_mem_bytes:
+        resource.setrlimit(
+            resource.RLIMIT_AS, (worker_mem_bytes, worker_mem_bytes)
+        )
+
+
+def _evaluate_task(task):
+    root, subject, metrics, pet_unit, test_4d, slab_thickness, profile = task
+
+    row = {"subject": subject, "error": None, "brain_k_values": None}
+
+    if profile is not None:
+        start_profiling(trace_memory=profile == "tracemalloc")
+
+    try:
+        results, brain_k_values = evaluate_subject(
+            root, subject, metrics, pet_unit=pet_unit, test_4d=test_4d,
+            slab_thickness=slab_thickness,
+        )
+        row.update({k: float(v) for k, v in results.items()})
+        row["brain_k_values"] = brain_k_values
+    except Exception as e:
+        row["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        # Subjects never share files, so nothing is worth keeping
+        get_cache().clear()
+
+        if profile is not None:
+            row["profile"] = subject_profile(subject, stop_profiling())
+
+    return row
+
+
+def subject_profile(subject, profiler):
+    """
+    JSON-serializable profile of one subject: its spans and their
+    per-name summary.
+    """
+
+    return {
+        "subject": subject,
+        "start": profiler.started,
+        "summary": summarize_spans(profiler.spans),
+        "spans": profiler.spans,
+    }
+
+
+def write_profiles(directory, profiles, trace=False):
+    """
+    Write ``<subject>.json`` per profile, their cohort aggregate to
+    ``cohort.json`` and optionally a Chrome trace to ``trace.json``.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+
+    for profile in profiles:
+        with open(os.path.join(directory, f"{profile['subject']}.json"), "w") as f:
+            json.dump(profile, f, indent=2)
+
+    with open(os.path.join(directory, "cohort.json"), "w") as f:
+        json.dump({
+            "num_subjects": len(profiles),
+            "spans": aggregate_profiles(profiles),
+        }, f, indent=2)
+
+    if trace:
+        with open(os.path.join(directory, "trace.json"), "w") as f:
+            json.dump(chrome_trace(profiles), f)
+
+
+def run_cohort(root, subjects, metrics=METRICS, workers=1, pet_unit="kBq",
+               test_4d=False, cache_mb=2048, worker_mem_mb=None,
+               max_tasks_per_child=None, precision="float32",
+               store_config=None, slab_thickness=None, result_store=None,
+               profile=None, bootstrap=None, bootstrap_seed=None):
+    """
+    Evaluate ``subjects`` on a pool of ``workers`` processes.
+
+    Returns
+    -------
+    rows : list of dict
+        One row per subject (in input order) with metric values,
+        per-threshold brain k values and an error message if the
+        subject failed.
+    cohort : dict
+        Mean of every metric over the successful subjects, except the
+        brain outlier score which is the AUC of K over all their
+        k values.
+
+    With ``profile`` ('tracemalloc' or 'rss': how peak memory is
+    measured), every row also holds the subject's profile under
+    ``"profile"``. With ``bootstrap`` (number of resamples), the
+    cohort also holds 95% confidence intervals.
+    """
+
+    tasks = [
+        (root, s, list(metrics), pet_unit, test_4d, slab_thickness, profile)
+        for s in subjects
+    ]
+    settings = (cache_mb * 1024 ** 2, precision, store_config, result_store)
+    worker_mem_bytes = worker_mem_mb * 1024 ** 2 if worker_mem_mb else None
+
+    if workers <= 1:
+        # In process: no address-space cap (see _init_worker)
+        _configure_run(*settings)
+        rows = [_evaluate_task(t) for t in tasks]
+    else:
+        with multiprocessing.Pool(
+            processes=workers,
+            initializer=_init_worker,
+            initargs=(worker_mem_bytes, *settings),
+            maxtasksperchild=max_tasks_per_child,
+        ) as pool:
+            rows = pool.map(_evaluate_task, tasks, chunksize=1)
+
+    return rows, summarize_cohort(rows, metrics, bootstrap, bootstrap_seed)
+
+
+def summarize_cohort(rows, metrics=METRICS, bootstrap=None, seed=None,
+                     confidence=0.95):
+    """
+    Combine per-subject rows into cohort-level scores.
+
+    Every score is a mean of per-subject values (for the brain outlier
+    score, the per-subject AUC-of-K areas). With ``bootstrap``
+    resamples, ``<metric>_ci_low`` / ``<metric>_ci_high`` give a
+    percentile confidence interval; all metrics measured on the same
+    subjects share the same resamples.
+    """
+
+    ok = [r for r in rows if r["error"] is None]
+    cohort = {"subject": "cohort", "num_subjects": len(ok)}
+
+    rng = np.random.default_rng(seed)
+    shared_indices = {}
+
+    for metric in metrics:
+        if metric == "brain_outlier":
+            k_values = [r["brain_k_values"] for r in ok if r["brain_k_values"]]
+            if not k_values:
+                continue
+            cohort[metric] = float(brain_outlier_score_from_k(k_values))
+            case_values = brain_outlier_case_scores(k_values)
+            subjects = tuple(r["subject"] for r in ok if r["brain_k_values"])
+        else:
+            values = [r[metric] for r in ok if metric in r]
+            if not values:
+                continue
+            cohort[metric] = float(np.mean(values))
+            case_values = values
+            subjects = tuple(r["subject"] for r in ok if metric in r)
+
+        if bootstrap:
+            if subjects not in shared_indices:
+                shared_indices[subjects] = bootstrap_indices(
+                    len(subjects), bootstrap, rng
+                )
+            result = bootstrap_mean(
+                case_values, confidence=confidence,
+                indices=shared_indices[subjects],
+            )
+            cohort[f"{metric}_ci_low"] = float(result.low)
+            cohort[f"{metric}_ci_high"] = float(result.high)
+
+    return cohort
+
+
+def write_results_table(path, rows, cohort, metrics=METRICS):
+    """
+    Write per-subject rows plus the cohort row (unless ``cohort`` is
+    None) as CSV, or as JSON if ``path`` ends with ``.json``.
+    """
+
+    rows = [{k: v for k, v in r.items() if k != "profile"} for r in rows]
+
+    if path.endswith(".json"):
+        data = {"subjects": rows}
+        if cohort is not None:
+            data["cohort"] = cohort
+        with open(path, "w") as f:
+            json.dump(data, f, indent=2)
+        return
+
+    thresholds = [f"brain_k_{t:.2f}" for t in BRAIN_THRESHOLDS]
+    intervals = [
+        f"{m}_ci_{side}" for m in metrics for side in ("low", "high")
+        if f"{m}_ci_{side}" in (cohort or {})
+    ]
+    fieldnames = ["subject"] + list(metrics) + intervals + thresholds + ["error"]
+
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore")
+        writer.writeheader()
+
+        for row in rows:
+            out = dict(row)
+            for name, k in zip(thresholds, row["brain_k_values"] or []):
+                out[name] = k
+            writer.writerow(out)
+
+        if cohort is not None:
+            writer.writerow(cohort)
@@ -6,51 +6,63 @@ correction challenge.
 
 Usage (from project root):
 
-    python -m evaluation_tool.eval \
+    python evaluation_tool/eval.py \
         --subject sub-000 \
         --root data \
         -all \
         --pet_unit kBq \
-        --debug
-"""
-
-import argparse
-import os
-import json
-import numpy as np
-import nibabel as nib
-
-from metrics import (
-    compute_whole_body_suv_mae,
-    compute_brain_outlier_score,
-    compute_organ_bias_from_totalseg,
-    compute_tac_bias,
-)
+        --debug \
+        --output sub-000.csv
 
+Cohort mode (subjects evaluated in parallel, one results table):
 
-# =========================================================
-# Helper: Simulate 4D PET (for testing only)
-# =========================================================
-
-def expand_to_4d(pet_path, num_frames=8):
-    """
-    Expand 3D PET into 4D by repeating volume.
-    Used only for local testing when dynamic PET
-    is not available.
-    """
-
-    img = nib.load(pet_path)
-    data = img.get_fdata()
+    python evaluation_tool/eval.py \
+        --subject_glob "sub-*" \
+        --root data \
+        -all \
+        --workers 16 \
+        --output results.csv
 
-    if data.ndim == 4:
-        return pet_path  # already dynamic
+Leaderboard mode (every team in submissions/<team>/<subject>/ scored
+against the same reference data, subject by subject):
 
-    data_4d = np.stack([data] * num_frames, axis=-1)
+    python evaluation_tool/eval.py \
+        --subject_glob "sub-*" \
+        --root data \
+        --submissions submissions \
+        -all \
+        --output leaderboard.csv
+"""
 
-    temp_path = pet_path.replace(".nii", "_4d.nii")
-    nib.save(nib.Nifti1Image(data_4d, img.affine), temp_path)
+import argparse
+import sys
 
-    return temp_path
+from metrics import (
+    configure_cache,
+    configure_result_store,
+    configure_store,
+    format_summary,
+    set_pet_dtype,
+    start_profiling,
+    stop_profiling,
+    PET_DTYPES,
+)
+from cohort import (
+    METRICS,
+    METRIC_NAMES,
+    evaluate_subject,
+    resolve_subjects,
+    run_cohort,
+    subject_profile,
+    write_profiles,
+    write_results_table,
+)
+from leaderboard import (
+    PREDICTION_NAME,
+    resolve_teams,
+    run_leaderboard,
+    write_leaderboard,
+)
 
 
 # =========================================================
@@ -65,10 +77,25 @@ def main():
 
     parser.add_argument(
         "--subject",
-        required=True,
         help="Subject identifier (e.g., sub-000)"
     )
 
+    parser.add_argument(
+        "--subjects",
+        nargs="+",
+        help="Evaluate several subjects as a cohort"
+    )
+
+    parser.add_argument(
+        "--subject_list",
+        help="Text file with one subject identifier per line (cohort mode)"
+    )
+
+    parser.add_argument(
+        "--subject_glob",
+        help="Glob matched against subject directories under --root (cohort mode)"
+    )
+
     parser.add_argument(
         "--root",
         required=True,
@@ -83,12 +110,7 @@ def main():
 
     parser.add_argument(
         "-specific_metric",
-        choices=[
-            "whole_body_mae",
-            "brain_outlier",
-            "organ_bias",
-            "tac_bias"
-        ],
+        choices=METRICS,
         help="Run specific metric only"
     )
 
@@ -111,130 +133,176 @@ def main():
         help="Enable debug output (SUV sanity check)"
     )
 
-    args = parser.parse_args()
+    parser.add_argument(
+        "--cache_mb",
+        type=int,
+        default=4096,
+        help="Memory budget of the volume cache in MB, per worker in cohort mode (default: 4096)"
+    )
 
-    subject_path = os.path.join(args.root, args.subject)
+    parser.add_argument(
+        "--precision",
+        default="float32",
+        choices=PET_DTYPES,
+        help="Dtype PET volumes are loaded in; reductions always use float64 (default: float32)"
+    )
 
-    features_path = os.path.join(subject_path, "features")
-    labels_path = os.path.join(subject_path, "labels")
+    parser.add_argument(
+        "--volume_store",
+        help="Directory of the persistent decompressed volume store for ground truth"
+    )
 
-    # -----------------------------------------------------
-    # Define file paths (adjust if naming changes)
-    # -----------------------------------------------------
+    parser.add_argument(
+        "--volume_store_gb",
+        type=float,
+        help="Size cap of the volume store in GB; least recently used volumes are evicted"
+    )
 
-    pred_pet = os.path.join(
-        features_path,
-        f"{args.subject}_ses-quadra_trc-18FFDG_rec-nacstatOSEM_pet.nii.gz"
+    parser.add_argument(
+        "--volume_store_verify",
+        default="stat",
+        choices=["stat", "hash"],
+        help="Staleness check of stored volumes: source size/mtime, or content hash (default: stat)"
     )
 
-    gt_pet = os.path.join(
-        labels_path,
-        f"{args.subject}_ses-quadra_trc-18FFDG_rec-acstatOSEM_pet.nii.gz"
+    parser.add_argument(
+        "--result_store",
+        help="SQLite file caching metric results by input content hash; unchanged subjects are not recomputed"
     )
 
-    ts_body = os.path.join(
-        labels_path,
-        f"{args.subject}_ses-quadra_acq-LOWDOSE_ce-none_rec-ac_seg-body_space-individual_dseg.nii.gz"
+    parser.add_argument(
+        "--slab_thickness",
+        type=int,
+        help="Stream the whole-body MAE in z-slabs of this many slices (bounded memory)"
     )
 
-    ts_total = os.path.join(
-        labels_path,
-        f"{args.subject}_ses-quadra_acq-LOWDOSE_ce-none_rec-ac_seg-total_space-individual_dseg.nii.gz"
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes in cohort mode (default: 1)"
     )
 
-    synthseg = os.path.join(
-        labels_path,
-        f"{args.subject}_ses-vida_task-rest_acq-MPRAGE_seg-synthsegparc_space-individual_dseg.nii.gz"
+    parser.add_argument(
+        "--worker_mem_mb",
+        type=int,
+        help="Hard address-space limit per worker process in MB (cohort mode, --workers > 1)"
     )
 
-    meta_json = os.path.join(features_path, "constants.json")
+    parser.add_argument(
+        "--max_tasks_per_child",
+        type=int,
+        help="Restart a worker after this many subjects to release memory (cohort mode)"
+    )
 
-    # -----------------------------------------------------
-    # Optionally simulate dynamic PET
-    # -----------------------------------------------------
+    parser.add_argument(
+        "--profile",
+        metavar="DIR",
+        help="Profile every metric and I/O call (wall/CPU time, bytes read, peak memory); "
+             "writes <subject>.json and cohort.json to DIR"
+    )
 
-    if args.test_4d:
-        pred_pet = expand_to_4d(pred_pet)
-        gt_pet = expand_to_4d(gt_pet)
+    parser.add_argument(
+        "--profile_memory",
+        default="tracemalloc",
+        choices=["tracemalloc", "rss"],
+        help="Peak memory of each span via tracemalloc (precise, slower) or process RSS only"
+    )
 
-    results = {}
+    parser.add_argument(
+        "--profile_trace",
+        action="store_true",
+        help="Also write DIR/trace.json for chrome://tracing or Perfetto"
+    )
 
-    # =====================================================
-    # 1. Whole-body SUV MAE
-    # =====================================================
+    parser.add_argument(
+        "--bootstrap",
+        type=int,
+        help="Bootstrap resamples for 95%% confidence intervals of the cohort scores (cohort mode)"
+    )
 
-    if args.all or args.specific_metric == "whole_body_mae":
+    parser.add_argument(
+        "--bootstrap_seed",
+        type=int,
+        help="Seed of the bootstrap resampling (default: random)"
+    )
 
-        results["Whole-body SUV MAE"] = compute_whole_body_suv_mae(
-            pred_pet_path=pred_pet,
-            gt_pet_path=gt_pet,
-            body_mask_path=ts_body,
-            liver_mask_path=ts_total,
-            json_path=meta_json,
-            pet_unit=args.pet_unit,
-            debug=args.debug
-        )
+    parser.add_argument(
+        "--submissions",
+        help="Directory of team submissions <team>/<subject>/<prediction_name>; "
+             "scores every team (leaderboard mode)"
+    )
 
-    # =====================================================
-    # 2. Brain Outlier Score
-    # =====================================================
+    parser.add_argument(
+        "--teams",
+        nargs="+",
+        help="Teams to score in leaderboard mode (default: every directory under --submissions)"
+    )
 
-    if args.all or args.specific_metric == "brain_outlier":
+    parser.add_argument(
+        "--prediction_name",
+        default=PREDICTION_NAME,
+        help=f"File name of a submitted PET (default: {PREDICTION_NAME})"
+    )
+
+    parser.add_argument(
+        "--output",
+        help="Write the results table to this file (.csv or .json)"
+    )
+
+    args = parser.parse_args()
+
+    if args.all:
+        metrics = METRICS
+    elif args.specific_metric:
+        metrics = [args.specific_metric]
+    else:
+        metrics = []
 
-        results["Brain Outlier Score"] = compute_brain_outlier_score(
-            pred_paths=[pred_pet],
-            gt_paths=[gt_pet],
-            brain_mask_paths=[synthseg]
+    if args.volume_store:
+        args.store_config = (
+            args.volume_store,
+            int(args.volume_store_gb * 1024 ** 3) if args.volume_store_gb else None,
+            args.volume_store_verify,
         )
+        configure_store(*args.store_config)
+    else:
+        args.store_config = None
 
-    # =====================================================
-    # 3. Organ Bias
-    # =====================================================
+    if args.result_store:
+        configure_result_store(args.result_store)
+
+    cohort_mode = args.subjects or args.subject_list or args.subject_glob
 
-    if args.all or args.specific_metric == "organ_bias":
-
-        organ_labels = {
-            "brain": 90,
-            "liver": 5,
-            "spleen": 1,
-            "heart": 52,
-            "pancreas": 10,
-            "muscle": 200,
-            "adipose": 201,
-            "extremities": 300,
-        }
-
-        results["Organ Bias"] = compute_organ_bias_from_totalseg(
-            pred_path=pred_pet,
-            gt_path=gt_pet,
-            totalseg_path=ts_total,
-            organ_label_dict=organ_labels,
-            json_path=meta_json,
-            pet_unit=args.pet_unit
+    if args.submissions and (cohort_mode or args.subject):
+        run_leaderboard_mode(args, metrics)
+    elif cohort_mode:
+        run_cohort_mode(args, metrics)
+    elif args.subject:
+        run_subject_mode(args, metrics)
+    else:
+        parser.error(
+            "one of --subject, --subjects, --subject_list or --subject_glob is required"
         )
 
-    # =====================================================
-    # 4. TAC Bias (Dynamic Only)
-    # =====================================================
 
-    if args.all or args.specific_metric == "tac_bias":
+def run_subject_mode(args, metrics):
 
-        pet_data = nib.load(pred_pet).get_fdata()
+    configure_cache(args.cache_mb * 1024 ** 2)
+    set_pet_dtype(args.precision)
 
-        if pet_data.ndim != 4:
-            print("TAC Bias skipped: PET is not dynamic (4D).")
-        else:
-            frame_durations = np.array([4.0] * pet_data.shape[-1])
+    if args.profile:
+        start_profiling(trace_memory=args.profile_memory == "tracemalloc")
 
-            results["TAC Bias"] = compute_tac_bias(
-                pred_path=pred_pet,
-                gt_path=gt_pet,
-                totalseg_path=ts_total,
-                synthseg_path=synthseg,
-                frame_durations=frame_durations,
-                aorta_label=52,
-                brain_label_ids=[3, 42, 10, 49, 8, 47]
-            )
+    results, brain_k_values = evaluate_subject(
+        args.root,
+        args.subject,
+        metrics,
+        pet_unit=args.pet_unit,
+        test_4d=args.test_4d,
+        debug=args.debug,
+        slab_thickness=args.slab_thickness,
+    )
 
     # =====================================================
     # Print Results
@@ -247,11 +315,153 @@ def main():
     if not results:
         print("No metric selected.")
     else:
-        for name, value in results.items():
-            print(f"{name:<25}: {value:.6f}")
+        for metric, value in results.items():
+            print(f"{METRIC_NAMES[metric]:<25}: {value:.6f}")
+
+    print("====================================================\n")
+
+    if args.profile:
+        profile = subject_profile(args.subject, stop_profiling())
+        write_profiles(args.profile, [profile], trace=args.profile_trace)
+        print(format_summary(profile["summary"]))
+        print(f"\nProfile written to {args.profile}")
+
+    if args.output:
+        row = {"subject": args.subject, "error": None,
+               "brain_k_values": brain_k_values}
+        row.update({k: float(v) for k, v in results.items()})
+        # One subject: its own row, no cohort row
+        write_results_table(args.output, [row], None, metrics)
+        print(f"Results written to {args.output}")
+
+
+def run_cohort_mode(args, metrics):
+
+    subjects = resolve_subjects(
+        args.root,
+        subjects=args.subjects,
+        subject_list=args.subject_list,
+        pattern=args.subject_glob,
+    )
+
+    if not subjects:
+        print("No subjects found.")
+        sys.exit(1)
+
+    rows, cohort = run_cohort(
+        args.root,
+        subjects,
+        metrics,
+        workers=args.workers,
+        pet_unit=args.pet_unit,
+        test_4d=args.test_4d,
+        cache_mb=args.cache_mb,
+        worker_mem_mb=args.worker_mem_mb,
+        max_tasks_per_child=args.max_tasks_per_child,
+        precision=args.precision,
+        store_config=args.store_config,
+        slab_thickness=args.slab_thickness,
+        result_store=args.result_store,
+        profile=args.profile_memory if args.profile else None,
+        bootstrap=args.bootstrap,
+        bootstrap_seed=args.bootstrap_seed,
+    )
+
+    # =====================================================
+    # Print Results
+    # =====================================================
+
+    print("\n================ Cohort Results ====================")
+    print(f"Subjects: {cohort['num_subjects']} / {len(subjects)} evaluated")
+    print("----------------------------------------------------")
+
+    for row in rows:
+        if row["error"] is not None:
+            print(f"[FAILED] {row['subject']}: {row['error']}")
+
+    if not metrics:
+        print("No metric selected.")
+    else:
+        for metric in metrics:
+            if metric in cohort:
+                line = f"{METRIC_NAMES[metric]:<25}: {cohort[metric]:.6f}"
+                if f"{metric}_ci_low" in cohort:
+                    line += (f"  [{cohort[f'{metric}_ci_low']:.6f}, "
+                             f"{cohort[f'{metric}_ci_high']:.6f}]")
+                print(line)
+
+    print("====================================================\n")
+
+    if args.profile:
+        profiles = [row["profile"] for row in rows if "profile" in row]
+        write_profiles(args.profile, profiles, trace=args.profile_trace)
+        print(f"Profiles of {len(profiles)} subjects written to {args.profile}")
+
+    if args.output:
+        write_results_table(args.output, rows, cohort, metrics)
+        print(f"Results table written to {args.output}")
+
+
+def run_leaderboard_mode(args, metrics):
+
+    subjects = resolve_subjects(
+        args.root,
+        subjects=(args.subjects or []) + ([args.subject] if args.subject else []),
+        subject_list=args.subject_list,
+        pattern=args.subject_glob,
+    )
+    teams = resolve_teams(args.submissions, args.teams)
+
+    if not subjects or not teams:
+        print("No subjects or teams found.")
+        sys.exit(1)
+
+    rows, standings = run_leaderboard(
+        args.root,
+        args.submissions,
+        subjects,
+        teams,
+        metrics,
+        workers=args.workers,
+        pet_unit=args.pet_unit,
+        test_4d=args.test_4d,
+        cache_mb=args.cache_mb,
+        worker_mem_mb=args.worker_mem_mb,
+        max_tasks_per_child=args.max_tasks_per_child,
+        precision=args.precision,
+        store_config=args.store_config,
+        slab_thickness=args.slab_thickness,
+        result_store=args.result_store,
+        prediction_name=args.prediction_name,
+    )
+
+    # =====================================================
+    # Print Results
+    # =====================================================
+
+    print("\n================ Leaderboard =======================")
+    print(f"Teams: {len(teams)}, subjects: {len(subjects)}")
+
+    for row in rows:
+        if row["error"] is not None:
+            print(f"[FAILED] {row['team']} / {row['subject']}: {row['error']}")
+
+    for team, cohort in standings.items():
+        print("----------------------------------------------------")
+        print(f"Team: {team} ({cohort['num_subjects']} / {len(subjects)} evaluated)")
+        if not cohort["complete"]:
+            print("Not ranked, missing: " + " ".join(cohort["missing_subjects"]))
+            continue
+        for metric in metrics:
+            if metric in cohort:
+                print(f"{METRIC_NAMES[metric]:<25}: {cohort[metric]:.6f}")
 
     print("====================================================\n")
 
+    if args.output:
+        write_leaderboard(args.output, rows, standings, metrics)
+        print(f"Leaderboard written to {args.output}")
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
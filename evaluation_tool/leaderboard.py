@@ -0,0 +1,235 @@
+"""
+Leaderboard Evaluation
+
+Scores the submissions of many teams against one set of reference
+data. Subjects are processed subject-major: a subject's ground truth,
+masks and derived structures (body mask, superior liver slice, label
+indices, reference TACs) are loaded once and every team's prediction
+for that subject is streamed through all metrics before the next
+subject is touched, so reference I/O does not grow with the number of
+teams.
+
+Submissions are laid out as ``<submissions>/<team>/<subject>/<name>``,
+the layout written by the Task 2 pipeline.
+"""
+
+import csv
+import json
+import multiprocessing
+import os
+
+from metrics import get_cache
+from cohort import (
+    BRAIN_THRESHOLDS,
+    METRICS,
+    _configure_run,
+    _init_worker,
+    evaluate_subject,
+    summarize_cohort,
+)
+
+
+PREDICTION_NAME = "reconstructed_pet.nii.gz"
+
+
+# =========================================================
+# Submissions
+# =========================================================
+
+def resolve_teams(submissions, teams=None):
+    """
+    Team identifiers: ``teams`` if given, else every directory
+    under ``submissions``.
+    """
+
+    if teams:
+        return list(dict.fromkeys(teams))
+
+    return sorted(
+        name for name in os.listdir(submissions)
+        if os.path.isdir(os.path.join(submissions, name))
+    )
+
+
+def submission_path(submissions, team, subject, name=PREDICTION_NAME):
+    """
+    Predicted PET of one team for one subject.
+    """
+    return os.path.join(submissions, team, subject, name)
+
+
+# =========================================================
+# Subject-major evaluation
+# =========================================================
+
+def evaluate_subject_teams(root, subject, predictions, metrics=METRICS,
+                           pet_unit="kBq", test_4d=False, slab_thickness=None):
+    """
+    Run the selected metrics for every team's prediction of one
+    subject.
+
+    ``predictions`` maps team → predicted PET path. Reference data
+    stay in the volume cache for all teams; each prediction is dropped
+    from the cache once scored.
+
+    Returns
+    -------
+    rows : list of dict
+        One row per team, as in ``run_cohort`` plus a ``"team"`` key.
+    """
+
+    cache = get_cache()
+    rows = []
+
+    for team, pred_pet in predictions.items():
+        row = {"team": team, "subject": subject, "error": None,
+               "brain_k_values": None}
+
+        try:
+            if not os.path.exists(pred_pet):
+                raise FileNotFoundError(f"No submission: {pred_pet}")
+
+            results, brain_k_values = evaluate_subject(
+                root, subject, metrics, pet_unit=pet_unit, test_4d=test_4d,
+                slab_thickness=slab_thickness, pred_pet=pred_pet,
+            )
+            row.update({k: float(v) for k, v in results.items()})
+            row["brain_k_values"] = brain_k_values
+        except Exception as e:
+            row["error"] = f"{type(e).__name__}: {e}"
+        finally:
+            cache.drop(pred_pet)
+
+        rows.append(row)
+
+    return rows
+
+
+def _evaluate_subject_task(task):
+    root, subject, predictions, metrics, pet_unit, test_4d, slab_thickness = task
+
+    try:
+        return evaluate_subject_teams(
+            root, subject, predictions, metrics, pet_unit=pet_unit,
+            test_4d=test_4d, slab_thickness=slab_thickness,
+        )
+    finally:
+        # Only this subject's reference data are in the cache
+        get_cache().clear()
+
+
+def run_leaderboard(root, submissions, subjects, teams, metrics=METRICS,
+                    workers=1, pet_unit="kBq", test_4d=False, cache_mb=2048,
+                    worker_mem_mb=None, max_tasks_per_child=None,
+                    precision="float32", store_config=None,
+                    slab_thickness=None, result_store=None,
+                    prediction_name=PREDICTION_NAME):
+    """
+    Evaluate every team on every subject, one subject per task on a
+    pool of ``workers`` processes.
+
+    Returns
+    -------
+    rows : list of dict
+        One row per (team, subject), subject-major, with metric values,
+        brain k values and an error message if the evaluation failed.
+    standings : dict
+        Team → cohort scores over all ``subjects`` (see
+        ``summarize_cohort``), with ``"complete"`` and
+        ``"missing_subjects"`` keys. Scores over a subset of the
+        subjects are not comparable, so a team with a missing or
+        failed subject is not scored: its entry only reports
+        ``complete=False`` and the missing subjects.
+    """
+
+    tasks = [
+        (
+            root, subject,
+            {t: submission_path(submissions, t, subject, prediction_name)
+             for t in teams},
+            list(metrics), pet_unit, test_4d, slab_thickness,
+        )
+        for subject in subjects
+    ]
+    settings = (cache_mb * 1024 ** 2, precision, store_config, result_store)
+    worker_mem_bytes = worker_mem_mb * 1024 ** 2 if worker_mem_mb else None
+
+    if workers <= 1:
+        # In process: no address-space cap (see _init_worker)
+        _configure_run(*settings)
+        results = [_evaluate_subject_task(t) for t in tasks]
+    else:
+        with multiprocessing.Pool(
+            processes=workers,
+            initializer=_init_worker,
+            initargs=(worker_mem_bytes, *settings),
+            maxtasksperchild=max_tasks_per_child,
+        ) as pool:
+            results = pool.map(_evaluate_subject_task, tasks, chunksize=1)
+
+    rows = [row for subject_rows in results for row in subject_rows]
+
+    standings = {
+        team: team_standing([r for r in rows if r["team"] == team], metrics)
+        for team in teams
+    }
+
+    return rows, standings
+
+
+def team_standing(rows, metrics=METRICS):
+    """
+    Cohort scores of one team from its rows (one per subject), or
+    only the list of missing subjects if any subject failed.
+    """
+
+    missing = [r["subject"] for r in rows if r["error"] is not None]
+
+    if missing:
+        return {
+            "subject": "cohort",
+            "num_subjects": len(rows) - len(missing),
+            "complete": False,
+            "missing_subjects": missing,
+        }
+
+    return {
+        **summarize_cohort(rows, metrics),
+        "complete": True,
+        "missing_subjects": [],
+    }
+
+
+def write_leaderboard(path, rows, standings, metrics=METRICS):
+    """
+    Write the team × subject × metric table as CSV (one row per team
+    and subject, plus one ``cohort`` row per team; the cohort row of
+    an incomplete team has no scores and lists the missing subjects
+    under ``error``), or as JSON if ``path`` ends with ``.json``.
+    """
+
+    if path.endswith(".json"):
+        with open(path, "w") as f:
+            json.dump({"rows": rows, "teams": standings}, f, indent=2)
+        return
+
+    thresholds = [f"brain_k_{t:.2f}" for t in BRAIN_THRESHOLDS]
+    fieldnames = ["team", "subject"] + list(metrics) + thresholds + ["error"]
+
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore")
+        writer.writeheader()
+
+        for row in rows:
+            out = dict(row)
+            for name, k in zip(thresholds, row["brain_k_values"] or []):
+                out[name] = k
+            writer.writerow(out)
+
+        for team, cohort in standings.items():
+            out = {"team": team, **cohort}
+            if not cohort["complete"]:
+                out["error"] = "Incomplete, missing: " + " ".join(
+                    cohort["missing_subjects"]
+                )
+            writer.writerow(out)
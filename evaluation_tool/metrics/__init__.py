@@ -5,6 +5,54 @@ Exposes all evaluation metrics.
 """
 
 from .whole_body_mae import compute_whole_body_suv_mae
-from .brain_outlier import compute_brain_outlier_score
+from .brain_outlier import (
+    compute_brain_outlier_score,
+    compute_brain_k_values,
+    brain_outlier_score_from_k,
+    brain_outlier_case_scores,
+)
+from .bootstrap import (
+    BootstrapResult,
+    bootstrap_brain_outlier_score,
+    bootstrap_indices,
+    bootstrap_mean,
+    bootstrap_means,
+)
 from .organ_bias import compute_organ_bias_from_totalseg
-from .tac_bias import compute_tac_bias
\ No newline at end of file
+from .tac_bias import compute_tac_bias
+from .volume_cache import (
+    configure_cache,
+    get_cache,
+    load_image,
+    VirtualDynamicImage,
+)
+from .label_stats import (
+    LabelIndex,
+    SparseLabelIndex,
+    compute_label_stats,
+    load_label_index,
+)
+from .seg_index import (
+    SegmentationIndex,
+    load_segmentation_index,
+    stored_segmentation_index,
+)
+from .common import load_frame_durations, sidecar_json_path
+from .precision import get_pet_dtype, set_pet_dtype, PET_DTYPES
+from .volume_store import VolumeStore, configure_store, get_store, load_nifti
+from .result_store import (
+    ResultStore,
+    cached_metric,
+    configure_result_store,
+    get_result_store,
+)
+from .profiling import (
+    aggregate_profiles,
+    chrome_trace,
+    format_summary,
+    profiled,
+    span,
+    start_profiling,
+    stop_profiling,
+    summarize_spans,
+)
@@ -0,0 +1,96 @@
+"""
+Bootstrap confidence intervals
+
+Every cohort score is a mean of per-case values (the brain outlier
+score through ``brain_outlier_case_scores``), so a bootstrap resample
+of the cohort is a mean over resampled cases. All resamples are drawn
+as one (num_resamples, num_cases) index array and reduced in a single
+gather + mean, processed in blocks to bound memory.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+from .brain_outlier import brain_outlier_case_scores
+
+
+DEFAULT_RESAMPLES = 10000
+
+# Elements of the resample index array reduced at a time
+BLOCK_ELEMENTS = 1 << 24
+
+
+class BootstrapResult(namedtuple("BootstrapResult", ["estimate", "low", "high", "samples"])):
+    """
+    Point estimate, percentile confidence interval and the resampled
+    estimates.
+    """
+
+
+def bootstrap_indices(num_cases, num_resamples=DEFAULT_RESAMPLES, seed=None):
+    """
+    (num_resamples, num_cases) case indices drawn with replacement.
+    ``seed`` may be an int or a ``np.random.Generator``.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    return rng.integers(0, num_cases, size=(num_resamples, num_cases))
+
+
+def bootstrap_means(case_values, indices):
+    """
+    Mean of ``case_values`` over every resample row of ``indices``.
+
+    ``case_values`` may have trailing dimensions (e.g. several metrics
+    per case, shape (num_cases, num_metrics)); the result then has
+    shape (num_resamples, num_metrics).
+    """
+
+    case_values = np.asarray(case_values, dtype=np.float64)
+    num_resamples, num_cases = indices.shape
+
+    block = max(1, BLOCK_ELEMENTS // max(1, num_cases))
+    means = np.empty((num_resamples,) + case_values.shape[1:])
+
+    for start in range(0, num_resamples, block):
+        rows = indices[start:start + block]
+        means[start:start + block] = case_values[rows].mean(axis=1)
+
+    return means
+
+
+def bootstrap_mean(case_values, num_resamples=DEFAULT_RESAMPLES, seed=None,
+                   confidence=0.95, indices=None):
+    """
+    Bootstrap CI of the mean of per-case values.
+
+    Pass ``indices`` to reuse the same resamples across metrics
+    (paired intervals).
+    """
+
+    case_values = np.asarray(case_values, dtype=np.float64)
+
+    if indices is None:
+        indices = bootstrap_indices(len(case_values), num_resamples, seed)
+
+    samples = bootstrap_means(case_values, indices)
+    tail = (1.0 - confidence) / 2 * 100
+
+    low, high = np.percentile(samples, [tail, 100 - tail], axis=0)
+
+    return BootstrapResult(case_values.mean(axis=0), low, high, samples)
+
+
+def bootstrap_brain_outlier_score(k_values, num_resamples=DEFAULT_RESAMPLES,
+                                  seed=None, confidence=0.95, indices=None):
+    """
+    Bootstrap CI of the brain outlier score from a
+    (num_cases, num_thresholds) k-value table.
+    """
+
+    return bootstrap_mean(
+        brain_outlier_case_scores(k_values), num_resamples, seed,
+        confidence, indices,
+    )
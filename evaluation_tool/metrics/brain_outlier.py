@@ -3,25 +3,68 @@ Brain outlier robustness metric.
 """
 
 import numpy as np
-from .common import compute_k_value, compute_auc_of_K
+from .common import compute_auc_of_K, compute_k_values, k_value_areas
 
 
-def compute_brain_outlier_score(pred_paths, gt_paths, brain_mask_paths):
+DEFAULT_THRESHOLDS = (0.05, 0.10, 0.15)
+
+
+def compute_brain_outlier_score(pred_paths, gt_paths, brain_mask_paths,
+                                thresholds=DEFAULT_THRESHOLDS):
     """
     Compute final brain outlier score averaged over
     5%, 10%, 15% thresholds.
     """
 
-    thresholds = [0.05, 0.10, 0.15]
-    auc_scores = []
+    k_values = compute_brain_k_values(
+        pred_paths, gt_paths, brain_mask_paths, thresholds
+    )
+
+    return brain_outlier_score_from_k(k_values)
+
+
+def compute_brain_k_values(pred_paths, gt_paths, brain_mask_paths,
+                           thresholds=DEFAULT_THRESHOLDS):
+    """
+    Compute k values for every case and threshold in one pass per case.
+
+    Returns
+    -------
+    k_values : ndarray, shape (num_cases, num_thresholds)
+    """
+
+    k_values = [
+        compute_k_values(pred, gt, mask, thresholds=thresholds)
+        for pred, gt, mask in zip(pred_paths, gt_paths, brain_mask_paths)
+    ]
+
+    return np.array(k_values).reshape(-1, len(thresholds))
+
+
+def brain_outlier_score_from_k(k_values):
+    """
+    Cohort score from a (num_cases, num_thresholds) k-value table:
+    AUC of K per threshold, averaged over thresholds.
+
+    Equal (up to rounding) to the mean of the per-case scores of
+    ``brain_outlier_case_scores``.
+    """
+
+    k_values = np.asarray(k_values)
+
+    auc_scores = [
+        compute_auc_of_K(k_values[:, i]) for i in range(k_values.shape[1])
+    ]
+
+    return np.mean(auc_scores)
 
-    for threshold in thresholds:
-        k_values = []
 
-        for pred, gt, mask in zip(pred_paths, gt_paths, brain_mask_paths):
-            k = compute_k_value(pred, gt, mask, threshold=threshold)
-            k_values.append(k)
+def brain_outlier_case_scores(k_values):
+    """
+    Per-case contribution to the brain outlier score: the AUC-of-K
+    area of each k value, averaged over thresholds.
+    """
 
-        auc_scores.append(compute_auc_of_K(k_values))
+    k_values = np.asarray(k_values, dtype=np.float64)
 
-    return np.mean(auc_scores)
\ No newline at end of file
+    return k_value_areas(k_values).reshape(len(k_values), -1).mean(axis=1)
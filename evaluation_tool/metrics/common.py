@@ -2,14 +2,29 @@
 Common utilities used across metrics.
 """
 
+import json
+import os
+import re
+
 import numpy as np
 import nibabel as nib
 
+from .precision import ACCUM_DTYPE, get_pet_dtype
+from .volume_cache import get_cache, load_image, load_static_frame
+from .label_stats import load_label_index
+from .seg_index import load_segmentation_index
+from .volume_store import get_store
+from .result_store import cached_metric
+from .profiling import profiled, span
+
 
 # =========================================================
 # Brain Outlier Utilities
 # =========================================================
 
+# Cases integrated together by k_value_areas (~8 MB of steps per block)
+AREA_BLOCK_CASES = 1024
+
 def compute_k_value(pred_path, gt_path, brain_mask_path,
                     threshold=0.05, epsilon=1e-6):
     """
@@ -18,40 +33,105 @@ def compute_k_value(pred_path, gt_path, brain_mask_path,
     k = fraction of brain voxels with relative error < threshold
     """
 
-    pred = nib.load(pred_path).get_fdata()
-    gt = nib.load(gt_path).get_fdata()
-    brain_mask = nib.load(brain_mask_path).get_fdata() > 0
+    return compute_k_values(
+        pred_path, gt_path, brain_mask_path,
+        thresholds=[threshold], epsilon=epsilon
+    )[0]
+
+
+@profiled("metric")
+@cached_metric(version="1")
+def compute_k_values(pred_path, gt_path, brain_mask_path,
+                     thresholds=(0.05, 0.10, 0.15), epsilon=1e-6):
+    """
+    Compute k values for a single case at several thresholds.
+
+    Only the brain voxels (from the mask's segmentation index) are
+    gathered from the volumes; their relative errors are sorted so
+    that the count below each threshold is a binary search,
+    independent of the number of thresholds.
+
+    Returns
+    -------
+    k_values : ndarray
+        One k value per threshold, in the order given.
+    """
 
     # If 4D, use first frame (static metric)
-    if pred.ndim == 4:
-        pred = pred[..., 0]
-        gt = gt[..., 0]
+    pred = load_static_frame(pred_path)
+    gt = load_static_frame(gt_path, persist=True)
+    brain = load_segmentation_index(brain_mask_path)
 
-    valid_mask = brain_mask & (np.abs(gt) > epsilon)
-    num_valid = np.sum(valid_mask)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+
+    brain_voxels = brain.region_voxels()
+    gt_brain = brain.gather(gt, brain_voxels)
+
+    valid = np.abs(gt_brain) > epsilon
+    num_valid = np.sum(valid)
 
     if num_valid == 0:
-        return 0.0
+        return np.zeros(len(thresholds))
+
+    # Errors in float64, on the (small) set of valid brain voxels
+    pred_valid = brain.gather(pred, brain_voxels[valid]).astype(ACCUM_DTYPE)
+    gt_valid = gt_brain[valid].astype(ACCUM_DTYPE)
 
-    relative_error = np.abs(pred - gt) / (np.abs(gt) + epsilon)
+    relative_error = np.abs(pred_valid - gt_valid) / (np.abs(gt_valid) + epsilon)
+    relative_error.sort()
 
-    return np.sum(relative_error[valid_mask] < threshold) / num_valid
+    # Number of errors strictly below each threshold (NaNs sort last)
+    below = np.searchsorted(relative_error, thresholds, side="left")
+
+    return below / num_valid
 
 
 def compute_auc_of_K(k_values, num_points=1000):
     """
     Compute AUC of K(x):
         K(x) = fraction of cases where k > x
+
+    K is sampled on ``num_points`` points of [0, 1] (one binary search
+    per point over the sorted k values) and integrated with the
+    trapezoidal rule. Both steps are linear in the cases, so the AUC
+    is also the mean of the per-case areas of ``k_value_areas``.
+    """
+
+    k_values = np.sort(np.asarray(k_values, dtype=np.float64).ravel())
+    x_values = np.linspace(0, 1, num_points)
+
+    # Cases with k > x (NaNs sort last and never count)
+    num_valid = np.searchsorted(k_values, np.inf, side="right")
+    above = num_valid - np.searchsorted(k_values[:num_valid], x_values, side="right")
+
+    return np.trapezoid(above / len(k_values), x_values)
+
+
+def k_value_areas(k_values, num_points=1000):
+    """
+    Trapezoidal area under the step 1[k > x] on the ``num_points``
+    grid of [0, 1], for every k value (any shape).
+
+    The mean of these areas over cases is the AUC of K, so cohort and
+    bootstrap scores are means of per-case areas. Each area is the
+    trapezoidal integral of its own step, exactly as for a single-case
+    ``compute_auc_of_K``; cases are integrated in blocks of
+    ``AREA_BLOCK_CASES`` to bound the step arrays.
     """
 
+    k_values = np.asarray(k_values, dtype=np.float64)
+    flat = k_values.ravel()
     x_values = np.linspace(0, 1, num_points)
-    K_values = []
 
-    for x in x_values:
-        Kx = np.sum(np.array(k_values) > x) / len(k_values)
-        K_values.append(Kx)
+    areas = np.empty(flat.shape)
 
-    return np.trapezoid(K_values, x_values)
+    for start in range(0, flat.size, AREA_BLOCK_CASES):
+        block = flat[start:start + AREA_BLOCK_CASES, None]
+        areas[start:start + AREA_BLOCK_CASES] = np.trapezoid(
+            (block > x_values).astype(np.float64), x_values, axis=-1
+        )
+
+    return areas.reshape(k_values.shape)
 
 
 # =========================================================
@@ -62,20 +142,143 @@ def integrate_tac(tac, frame_durations):
     """
     Compute time-integrated activity (AUC).
     """
-    return np.sum(tac * frame_durations)
+    return np.sum(tac * frame_durations, dtype=ACCUM_DTYPE)
 
 
-def compute_region_auc(pet_4d, mask, frame_durations):
+def load_frame_durations(json_paths, num_frames, default_duration=4.0):
     """
-    Compute integrated TAC (AUC) for one region.
+    Frame durations (s) of a dynamic PET from metadata.
+
+    The first JSON in ``json_paths`` that exists and has a
+    ``FrameDuration`` list (BIDS PET sidecar convention) is used.
+    Without one, every frame gets ``default_duration``.
+    """
+
+    for json_path in json_paths:
+        if not json_path or not os.path.exists(json_path):
+            continue
+
+        with open(json_path, "r") as f:
+            meta = json.load(f)
+
+        if "FrameDuration" not in meta:
+            continue
+
+        durations = np.asarray(meta["FrameDuration"], dtype=np.float64)
+
+        if len(durations) != num_frames:
+            raise ValueError(
+                f"{json_path}: {len(durations)} frame durations "
+                f"for {num_frames} frames"
+            )
+
+        return durations
+
+    print(
+        f"[WARNING] No FrameDuration metadata found, "
+        f"assuming {default_duration} s frames."
+    )
+
+    return np.full(num_frames, default_duration)
+
+
+def sidecar_json_path(nifti_path):
+    """
+    BIDS sidecar JSON next to a NIfTI file.
+    """
+    return re.sub(r"\.nii(\.gz)?$", ".json", nifti_path)
+
+
+def iter_frames(pet, dtype=None, persist=False):
+    """
+    Yield the frames of a 4D PET one at a time.
+
+    Frames are read through the nibabel array proxy with the file kept
+    open, so a gzip'd volume is decompressed once, front to back, and
+    only one frame is in memory at a time. With ``persist`` and a
+    configured volume store, frames are slices of the stored memmap.
+    ``pet`` may also be an image object such as ``VirtualDynamicImage``.
+    """
+
+    dtype = get_pet_dtype() if dtype is None else dtype
+    store = get_store()
+
+    if isinstance(pet, (str, os.PathLike)):
+        if persist and store is not None:
+            data = store.load(pet, dtype)
+        else:
+            data = nib.load(pet, keep_file_open=True).dataobj
+    else:
+        data = load_image(pet).dataobj
+
+    for t in range(data.shape[-1]):
+        with span("read_frame", "io"):
+            frame = np.asarray(data[..., t], dtype=dtype)
+        yield frame
+
+
+def compute_region_tacs(frames, label_indices):
+    """
+    Mean TAC of every region of each ``LabelIndex``.
+
+    All regions of an index are reduced together in one vectorized
+    step per frame; ``frames`` may be a generator, so only the
+    current frame needs to be in memory.
+
+    Returns
+    -------
+    tacs : list of ndarray, shape (num_regions, T)
+        One array per label index.
+    """
+
+    sums = [[] for _ in label_indices]
+
+    for frame in frames:
+        for region_sums, index in zip(sums, label_indices):
+            region_sums.append(index.sums(frame)[0])
+
+    tacs = []
+
+    for region_sums, index in zip(sums, label_indices):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            tacs.append(np.stack(region_sums, axis=-1) / index.counts[:, None])
+
+    return tacs
+
+
+def load_region_tacs(pet, regions, persist=False):
+    """
+    Mean TACs of a 4D PET for ``regions``, a list of
+    ``(label_path, label_ids)`` pairs (one ``LabelIndex`` each).
+
+    For a PET file the TACs are kept in the volume cache, so reference
+    TACs are computed once however many predictions are compared to
+    them.
     """
 
-    T = pet_4d.shape[-1]
-    tac = []
+    indices = [load_label_index(path, ids) for path, ids in regions]
 
-    for t in range(T):
-        tac.append(np.mean(pet_4d[..., t][mask]))
+    def build():
+        return compute_region_tacs(iter_frames(pet, persist=persist), indices)
+
+    if not isinstance(pet, (str, os.PathLike)):
+        return build()
+
+    key = (
+        os.path.abspath(pet), "region_tacs", np.dtype(get_pet_dtype()).str,
+        tuple((os.path.abspath(path), tuple(int(i) for i in ids))
+              for path, ids in regions),
+    )
+
+    return get_cache().get(key, build)
+
+
+def compute_region_auc(pet_4d, mask, frame_durations):
+    """
+    Compute integrated TAC (AUC) for one region.
+    """
 
-    tac = np.array(tac)
+    # One gather of all frames: (num_voxels, T)
+    tac = np.mean(pet_4d[mask], axis=0, dtype=ACCUM_DTYPE)
 
-    return integrate_tac(tac, frame_durations)
\ No newline at end of file
+    return integrate_tac(tac, frame_durations)
@@ -0,0 +1,240 @@
+"""
+Label statistics
+
+Per-label voxel count, sum and sum of squares for any number of
+labels in a single pass over a label image (``np.bincount`` on a
+compact label index), shared by the organ and TAC metrics. Label
+files are reduced through their segmentation index, touching only
+the voxels of the requested labels.
+"""
+
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from .volume_cache import get_cache, load_labels
+from .seg_index import load_segmentation_index
+from .profiling import profiled, span
+
+
+# Voxels reduced per bincount call; bounds the int64 / float64
+# temporaries that bincount creates internally.
+CHUNK_VOXELS = 1 << 22
+
+
+class LabelStats(namedtuple("LabelStats", ["label_ids", "count", "sum", "sumsq"])):
+    """
+    Per-label reductions, aligned with ``label_ids``.
+
+    ``sum`` and ``sumsq`` have shape (num_value_arrays, num_labels).
+    """
+
+    @property
+    def mean(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.sum / self.count
+
+
+class LabelIndex:
+    """
+    Label image compacted to positions in a list of requested labels.
+
+    Every voxel holds 1 + the position of its label in ``label_ids``,
+    or 0 if its label was not requested, so all labels are reduced
+    together by one ``np.bincount``.
+    """
+
+    def __init__(self, labels, label_ids):
+        labels = np.asarray(labels)
+
+        requested = np.asarray(list(label_ids), dtype=np.int64)
+        unique_ids, positions = np.unique(requested, return_inverse=True)
+
+        self.label_ids = requested
+        self.shape = labels.shape
+        self._positions = positions
+        self._order = "F" if labels.flags.f_contiguous else "C"
+        self._index = _compact_index(labels, unique_ids).ravel(order=self._order)
+        self._minlength = len(unique_ids) + 1
+
+        self.counts = self._reduce(lambda idx, _: np.bincount(
+            idx, minlength=self._minlength
+        ))[..., 1:][positions]
+
+    @property
+    def nbytes(self):
+        return self._index.nbytes
+
+    @profiled("stage", "reduce")
+    def sums(self, *values):
+        """
+        Per-label sums of each value array, shape (len(values), num_labels).
+        """
+        return self._reduce_values(values, squares=False)[0]
+
+    @profiled("stage", "reduce")
+    def stats(self, *values):
+        """
+        Per-label count, sum and sum of squares of each value array.
+        """
+        sums, sumsq = self._reduce_values(values, squares=True)
+        return LabelStats(self.label_ids, self.counts, sums, sumsq)
+
+    def _reduce_values(self, values, squares):
+        flat = [self._ravel(v) for v in values]
+
+        def reduce_chunk(idx, sl):
+            out = []
+            for v in flat:
+                w = v[sl]
+                out.append(np.bincount(idx, weights=w, minlength=self._minlength))
+                if squares:
+                    out.append(np.bincount(
+                        idx, weights=np.square(w, dtype=np.float64),
+                        minlength=self._minlength
+                    ))
+            return np.stack(out)
+
+        reduced = self._reduce(reduce_chunk)[:, 1:][:, self._positions]
+
+        if squares:
+            return reduced[0::2], reduced[1::2]
+        return reduced, None
+
+    def _ravel(self, values):
+        values = np.asarray(values)
+        if values.shape != self.shape:
+            raise ValueError(
+                f"Value shape {values.shape} does not match label shape {self.shape}"
+            )
+        return values.ravel(order=self._order)
+
+    def _reduce(self, reduce_chunk):
+        total = None
+        for start in range(0, self._index.size, CHUNK_VOXELS):
+            sl = slice(start, start + CHUNK_VOXELS)
+            part = reduce_chunk(self._index[sl], sl)
+            total = part if total is None else total + part
+        return total
+
+
+class SparseLabelIndex:
+    """
+    ``LabelIndex`` over the voxel lists of a ``SegmentationIndex``:
+    only the voxels of the requested labels are gathered and reduced
+    (``np.add.reduceat`` over the label segments).
+    """
+
+    def __init__(self, seg_index, label_ids):
+        self.label_ids = np.asarray(list(label_ids), dtype=np.int64)
+        self.shape = seg_index.shape
+        self._seg_index = seg_index
+
+        positions = seg_index.positions(self.label_ids)
+        self._present = np.nonzero(positions >= 0)[0]
+
+        segments = [seg_index.label_segment(p) for p in positions[self._present]]
+        lengths = np.array([len(s) for s in segments], dtype=np.int64)
+
+        self.counts = np.zeros(len(self.label_ids), dtype=np.int64)
+        self.counts[self._present] = lengths
+
+        self._voxels = np.concatenate(segments) if segments else seg_index.voxels[:0]
+        self._starts = (np.cumsum(lengths) - lengths).astype(np.intp)
+        # reduceat needs non-empty segments
+        self._nonempty = lengths > 0
+
+    @property
+    def nbytes(self):
+        return self._voxels.nbytes
+
+    @profiled("stage", "reduce")
+    def sums(self, *values):
+        """
+        Per-label sums of each value array, shape (len(values), num_labels).
+        """
+        return self._reduce_values(values, squares=False)[0]
+
+    @profiled("stage", "reduce")
+    def stats(self, *values):
+        """
+        Per-label count, sum and sum of squares of each value array.
+        """
+        sums, sumsq = self._reduce_values(values, squares=True)
+        return LabelStats(self.label_ids, self.counts, sums, sumsq)
+
+    def _reduce_values(self, values, squares):
+        sums = np.zeros((len(values), len(self.label_ids)))
+        sumsq = np.zeros_like(sums) if squares else None
+
+        present = self._present[self._nonempty]
+        starts = self._starts[self._nonempty]
+
+        if not present.size:
+            return sums, sumsq
+
+        for i, v in enumerate(values):
+            w = self._seg_index.gather(v, self._voxels).astype(np.float64)
+            sums[i, present] = np.add.reduceat(w, starts)
+            if squares:
+                sumsq[i, present] = np.add.reduceat(np.square(w), starts)
+
+        return sums, sumsq
+
+
+def _compact_index(labels, unique_ids):
+    """
+    Map label values to 1 + position in ``unique_ids`` (0 = other).
+    """
+
+    max_id = int(unique_ids.max()) if unique_ids.size else 0
+
+    # Slot max_id + 1 (also reached through index -1) means "other"
+    lut = np.zeros(max_id + 2, dtype=np.min_scalar_type(len(unique_ids)))
+    lut[unique_ids[unique_ids >= 0]] = np.nonzero(unique_ids >= 0)[0] + 1
+
+    if np.issubdtype(labels.dtype, np.integer):
+        if np.issubdtype(labels.dtype, np.unsignedinteger):
+            codes = np.minimum(labels, max_id + 1)
+        else:
+            codes = np.clip(labels, -1, max_id + 1)
+    else:
+        with np.errstate(invalid="ignore"):
+            codes = labels.astype(np.int64)
+        # Non-integral (or non-finite) values match no label
+        codes[codes != labels] = -1
+        np.clip(codes, -1, max_id + 1, out=codes)
+
+    return lut[codes]
+
+
+def compute_label_stats(labels, label_ids, *values):
+    """
+    Count, sum and sum of squares of each value array for every label
+    in ``label_ids``, in one pass over ``labels``.
+    """
+    return LabelIndex(labels, label_ids).stats(*values)
+
+
+def load_label_index(label_path, label_ids):
+    """
+    Cached per-label reducer of a label image for the given labels: a
+    ``SparseLabelIndex`` over its segmentation index, or a dense
+    ``LabelIndex`` when background (label <= 0) is requested.
+    """
+
+    label_ids = tuple(int(i) for i in label_ids)
+    key = (os.path.abspath(label_path), "label_index", label_ids)
+
+    def build():
+        if all(i > 0 for i in label_ids):
+            seg_index = load_segmentation_index(label_path)
+            with span("label_index"):
+                return SparseLabelIndex(seg_index, label_ids)
+
+        labels = load_labels(label_path)
+        with span("label_index"):
+            return LabelIndex(labels, label_ids)
+
+    return get_cache().get(key, build)
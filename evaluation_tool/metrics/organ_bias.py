@@ -3,10 +3,15 @@ Organ bias metric (SUV-mean MARE).
 """
 
 import numpy as np
-import nibabel as nib
-from .suv_utils import load_pet_as_suv
+from .suv_utils import suv_norm_factor
+from .label_stats import load_label_index
+from .volume_cache import load_volume
+from .result_store import cached_metric
+from .profiling import profiled
 
 
+@profiled("metric")
+@cached_metric(version="1")
 def compute_organ_bias_from_totalseg(
     pred_path,
     gt_path,
@@ -19,27 +24,37 @@ def compute_organ_bias_from_totalseg(
     """
     Compute mean absolute relative error (MARE)
     of SUV-mean across specified organs.
+
+    All organs are reduced together in one pass over the
+    segmentation, so the cost hardly depends on the number
+    of organs. Sums accumulate in float64 on the raw PET and
+    the organ means are scaled to SUV afterwards.
     """
 
-    pred = load_pet_as_suv(pred_path, json_path, pet_unit)
-    gt = load_pet_as_suv(gt_path, json_path, pet_unit)
+    pred = load_volume(pred_path)
+    gt = load_volume(gt_path, persist=True)
+    norm_factor = suv_norm_factor(json_path, pet_unit)
 
-    seg = nib.load(totalseg_path).get_fdata()
+    index = load_label_index(totalseg_path, organ_label_dict.values())
 
-    mare_values = []
+    if pred.ndim == 4:
+        # Dynamic PET: organ means over all voxels of all frames
+        pred_sums, gt_sums = sum(
+            index.sums(pred[..., t], gt[..., t]) for t in range(pred.shape[-1])
+        )
+        counts = index.counts * pred.shape[-1]
+    else:
+        pred_sums, gt_sums = index.sums(pred, gt)
+        counts = index.counts
 
-    for _, label_id in organ_label_dict.items():
-        mask = seg == label_id
-        if np.sum(mask) == 0:
-            continue
+    present = counts > 0
 
-        pred_mean = np.mean(pred[mask])
-        gt_mean = np.mean(gt[mask])
+    if not np.any(present):
+        raise ValueError("No valid organs found.")
 
-        mare = np.abs(pred_mean - gt_mean) / (np.abs(gt_mean) + epsilon)
-        mare_values.append(mare)
+    pred_mean = pred_sums[present] / counts[present] * norm_factor
+    gt_mean = gt_sums[present] / counts[present] * norm_factor
 
-    if not mare_values:
-        raise ValueError("No valid organs found.")
+    mare_values = np.abs(pred_mean - gt_mean) / (np.abs(gt_mean) + epsilon)
 
-    return np.mean(mare_values)
\ No newline at end of file
+    return np.mean(mare_values)
@@ -0,0 +1,39 @@
+"""
+Precision policy
+
+PET volumes are loaded as float32 (configurable) and label maps in
+their native integer dtype. Reductions accumulate in float64
+(``ACCUM_DTYPE``), so the reported metrics stay numerically
+equivalent to an all-float64 computation at half the memory.
+"""
+
+import numpy as np
+
+
+ACCUM_DTYPE = np.float64
+
+PET_DTYPES = ("float32", "float64")
+
+_pet_dtype = np.dtype(np.float32)
+
+
+def get_pet_dtype():
+    """
+    Dtype PET volumes are loaded in.
+    """
+    return _pet_dtype
+
+
+def set_pet_dtype(dtype):
+    """
+    Load PET volumes as ``dtype`` ('float32' or 'float64') from now on.
+    """
+
+    global _pet_dtype
+
+    dtype = np.dtype(dtype)
+
+    if dtype.name not in PET_DTYPES:
+        raise ValueError(f"PET dtype must be one of {PET_DTYPES}, got {dtype}")
+
+    _pet_dtype = dtype
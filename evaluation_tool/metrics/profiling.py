@@ -0,0 +1,321 @@
+"""
+Profiling
+
+Opt-in instrumentation of the metric functions and the I/O calls
+below them. Every instrumented call records a span with its wall
+time, CPU time, bytes read by the process and peak memory (traced
+with tracemalloc, which includes numpy buffers, and the process
+high-water RSS). Spans can be summarized per name, aggregated over
+a cohort and exported as a Chrome trace (chrome://tracing,
+https://ui.perfetto.dev).
+
+When profiling is off, instrumented functions cost one global check.
+"""
+
+import functools
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class Profiler:
+    """
+    Collects finished spans. ``hooks`` are called with every span
+    dict as it finishes (the programmatic hook).
+    """
+
+    def __init__(self, trace_memory=True, hooks=()):
+        self.trace_memory = trace_memory
+        self.hooks = list(hooks)
+        self.spans = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._origin = time.perf_counter()
+        self.started = time.time()
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    @contextmanager
+    def span(self, name, category):
+        stack = self._stack()
+
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+            tracemalloc.reset_peak()
+        else:
+            current = 0
+
+        frame = {"peak": current}
+        stack.append(frame)
+
+        read_start = _bytes_read()
+        cpu_start = time.thread_time()
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            cpu = time.thread_time() - cpu_start
+            read_end = _bytes_read()
+            stack.pop()
+
+            span = {
+                "name": name,
+                "category": category,
+                "depth": len(stack),
+                "start": start - self._origin,
+                "wall": end - start,
+                "cpu": cpu,
+                "bytes_read": (
+                    None if read_start is None else read_end - read_start
+                ),
+                "max_rss": _max_rss(),
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+            }
+
+            if self.trace_memory:
+                peak = max(frame["peak"], tracemalloc.get_traced_memory()[1])
+                # Memory allocated on top of what was live at span start
+                span["peak_traced"] = peak - current
+                if stack:
+                    stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+                tracemalloc.reset_peak()
+
+            with self._lock:
+                self.spans.append(span)
+
+            for hook in self.hooks:
+                hook(span)
+
+
+def _bytes_read():
+    """
+    Bytes this process read through read() syscalls so far (Linux;
+    None elsewhere). Reads of memory-mapped files are not counted.
+    """
+
+    try:
+        with open("/proc/self/io", "rb") as f:
+            for line in f:
+                if line.startswith(b"rchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def _max_rss():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+# =========================================================
+# Run-wide profiler
+# =========================================================
+
+_profiler = None
+
+# Whether start_profiling started tracemalloc (and stop_profiling must
+# stop it), as opposed to finding it already tracing for the caller
+_owns_tracemalloc = False
+
+
+def get_profiler():
+    """
+    The active profiler, or None if profiling is off.
+    """
+    return _profiler
+
+
+def start_profiling(trace_memory=True, hooks=()):
+    """
+    Start recording spans into a new profiler and return it.
+    ``trace_memory`` starts tracemalloc (slower allocations) unless
+    it is already tracing.
+    """
+
+    global _profiler, _owns_tracemalloc
+
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _owns_tracemalloc = True
+
+    _profiler = Profiler(trace_memory, hooks)
+
+    return _profiler
+
+
+def stop_profiling():
+    """
+    Stop recording; returns the profiler with its spans. tracemalloc
+    is stopped only if ``start_profiling`` started it.
+    """
+
+    global _profiler, _owns_tracemalloc
+
+    profiler, _profiler = _profiler, None
+
+    if _owns_tracemalloc:
+        tracemalloc.stop()
+        _owns_tracemalloc = False
+
+    return profiler
+
+
+@contextmanager
+def span(name, category="stage"):
+    """
+    Record the enclosed block as a span when profiling is on.
+    """
+
+    if _profiler is None:
+        yield
+        return
+
+    with _profiler.span(name, category):
+        yield
+
+
+def profiled(category, name=None):
+    """
+    Record every call of the decorated function as a span.
+    """
+
+    def decorate(func):
+        label = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return func(*args, **kwargs)
+
+            with _profiler.span(label, category):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+# =========================================================
+# Reports
+# =========================================================
+
+def summarize_spans(spans):
+    """
+    Per span name: number of calls, total wall/CPU time, bytes read
+    and the largest peak memory.
+    """
+
+    summary = {}
+
+    for s in spans:
+        entry = summary.setdefault(s["name"], {
+            "category": s["category"], "calls": 0, "wall": 0.0,
+            "cpu": 0.0, "bytes_read": 0, "peak_traced": 0, "max_rss": 0,
+        })
+        entry["calls"] += 1
+        entry["wall"] += s["wall"]
+        entry["cpu"] += s["cpu"]
+        entry["bytes_read"] += s["bytes_read"] or 0
+        entry["peak_traced"] = max(entry["peak_traced"], s.get("peak_traced", 0))
+        entry["max_rss"] = max(entry["max_rss"], s["max_rss"])
+
+    return summary
+
+
+def format_summary(summary):
+    """
+    Text table of a span summary, slowest first.
+    """
+
+    width = max([len(name) for name in summary] + [4]) + 2
+    lines = [
+        f"{'span':<{width}}{'calls':>7}{'wall s':>9}{'cpu s':>9}"
+        f"{'read MB':>10}{'peak MB':>10}"
+    ]
+
+    for name, e in sorted(summary.items(), key=lambda kv: -kv[1]["wall"]):
+        lines.append(
+            f"{name:<{width}}{e['calls']:>7}{e['wall']:>9.3f}{e['cpu']:>9.3f}"
+            f"{e['bytes_read'] / 1024 ** 2:>10.1f}"
+            f"{e['peak_traced'] / 1024 ** 2:>10.1f}"
+        )
+
+    return "\n".join(lines)
+
+
+def aggregate_profiles(profiles):
+    """
+    Cohort view of per-subject profiles (dicts with a ``summary``):
+    for every span name, the distribution over subjects of its
+    per-subject wall time, CPU time, bytes read and peak memory.
+    """
+
+    per_name = {}
+
+    for profile in profiles:
+        for name, entry in profile["summary"].items():
+            per_name.setdefault(name, []).append(entry)
+
+    cohort = {}
+
+    for name, entries in per_name.items():
+        cohort[name] = {"category": entries[0]["category"], "subjects": len(entries)}
+        for field in ("wall", "cpu", "bytes_read", "peak_traced", "max_rss"):
+            values = np.array([e[field] for e in entries], dtype=np.float64)
+            cohort[name][field] = {
+                "total": float(values.sum()),
+                "mean": float(values.mean()),
+                "p50": float(np.percentile(values, 50)),
+                "p95": float(np.percentile(values, 95)),
+                "max": float(values.max()),
+            }
+
+    return cohort
+
+
+def chrome_trace(profiles):
+    """
+    Chrome trace event document of per-subject profiles (dicts with
+    ``subject``, ``start`` epoch time and ``spans``); one complete
+    event per span, on a common timeline.
+    """
+
+    events = []
+    t0 = min((p["start"] for p in profiles), default=0.0)
+
+    for profile in profiles:
+        for s in profile["spans"]:
+            events.append({
+                "name": s["name"],
+                "cat": s["category"],
+                "ph": "X",
+                "ts": (profile["start"] - t0 + s["start"]) * 1e6,
+                "dur": s["wall"] * 1e6,
+                "pid": s["pid"],
+                "tid": s["tid"],
+                "args": {
+                    "subject": profile["subject"],
+                    "cpu_s": s["cpu"],
+                    "bytes_read": s["bytes_read"],
+                    "peak_traced": s.get("peak_traced"),
+                },
+            })
+
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
@@ -0,0 +1,280 @@
+"""
+Result store
+
+Persistent cache of metric results for incremental re-evaluation.
+A result is keyed by the metric name, a version tag of the metric
+function, the PET precision and the arguments of the call, where
+every input file enters through the SHA-256 of its content. A
+resubmitted, byte-identical prediction is therefore served from the
+store; a changed input or a bumped metric version is recomputed.
+
+File digests are remembered per (path, size, mtime), so unchanged
+ground truth is hashed once.
+"""
+
+import functools
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from .precision import get_pet_dtype
+from .volume_store import _file_sha256
+
+
+class ResultStore:
+    """
+    SQLite file of pickled metric results and file digests. Safe to
+    share between the processes and threads of a cohort run.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        self._conn = None
+        self._pid = None
+        self._digests = {}
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+    def _connection(self):
+        # sqlite connections must not cross a fork
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, metric TEXT, version TEXT, "
+                "value BLOB, created REAL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS digests ("
+                "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+                "sha256 TEXT)"
+            )
+            conn.commit()
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    # -----------------------------------------------------
+    # Results
+    # -----------------------------------------------------
+
+    def get(self, key):
+        """
+        (True, value) for a stored result, else (False, None).
+        """
+
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT value FROM results WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return False, None
+
+            self.hits += 1
+
+        return True, pickle.loads(row[0])
+
+    def put(self, key, metric, version, value):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                (key, metric, version, blob, time.time()),
+            )
+            conn.commit()
+
+    def prune(self, metric, keep_version):
+        """
+        Delete results of ``metric`` computed by other versions.
+        """
+
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "DELETE FROM results WHERE metric = ? AND version != ?",
+                (metric, keep_version),
+            )
+            conn.commit()
+
+    # -----------------------------------------------------
+    # File digests
+    # -----------------------------------------------------
+
+    def file_digest(self, path):
+        """
+        SHA-256 of a file, recomputed only when its size or mtime changed.
+        """
+
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        stamp = (st.st_size, st.st_mtime_ns)
+
+        with self._lock:
+            cached = self._digests.get(path)
+            if cached is not None and cached[0] == stamp:
+                return cached[1]
+
+            row = self._connection().execute(
+                "SELECT size, mtime_ns, sha256 FROM digests WHERE path = ?",
+                (path,),
+            ).fetchone()
+
+        if row is not None and tuple(row[:2]) == stamp:
+            digest = row[2]
+        else:
+            digest = _file_sha256(path)
+            with self._lock:
+                conn = self._connection()
+                conn.execute(
+                    "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?)",
+                    (path, stamp[0], stamp[1], digest),
+                )
+                conn.commit()
+
+        with self._lock:
+            self._digests[path] = (stamp, digest)
+
+        return digest
+
+
+# =========================================================
+# Cache keys
+# =========================================================
+
+def _token(value, store):
+    """
+    JSON-serializable identity of an argument value; files are
+    identified by content.
+    """
+
+    if isinstance(value, (str, os.PathLike)) and os.path.isfile(value):
+        return ["file", store.file_digest(value)]
+
+    if isinstance(value, np.ndarray):
+        digest = hashlib.sha256(np.ascontiguousarray(value).tobytes()).hexdigest()
+        return ["array", value.dtype.str, list(value.shape), digest]
+
+    if isinstance(value, dict):
+        return ["dict", [[_token(k, store), _token(v, store)]
+                         for k, v in sorted(value.items(), key=lambda kv: repr(kv[0]))]]
+
+    if isinstance(value, (list, tuple)):
+        return ["seq", [_token(v, store) for v in value]]
+
+    if isinstance(value, np.generic):
+        return value.item()
+
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+
+    # Dynamic stand-ins (VirtualDynamicImage) are a file repeated over frames
+    if hasattr(value, "path") and hasattr(value, "num_frames"):
+        return ["virtual4d", _token(value.path, store), value.num_frames]
+
+    # nibabel images: the file they were loaded from
+    get_filename = getattr(value, "get_filename", None)
+    filename = get_filename() if get_filename is not None else None
+    if filename and os.path.isfile(filename):
+        return ["image", store.file_digest(filename)]
+
+    dataobj = getattr(value, "dataobj", None)
+    if dataobj is not None:
+        return ["image", _token(np.asanyarray(dataobj), store),
+                _token(np.asarray(value.affine), store)]
+
+    raise TypeError(f"Cannot build a result key from {type(value).__name__}")
+
+
+def result_key(metric, version, arguments, store):
+    payload = json.dumps(
+        [metric, version, get_pet_dtype().str,
+         [[name, _token(value, store)] for name, value in arguments]],
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def cached_metric(version, name=None, ignore=()):
+    """
+    Serve results of the decorated metric from the configured result
+    store. Bump ``version`` whenever the metric's output changes;
+    arguments in ``ignore`` do not affect the result (e.g. debug flags).
+    """
+
+    def decorate(func):
+        metric = name or f"{func.__module__.rsplit('.', 1)[-1]}.{func.__name__}"
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            store = _store
+            if store is None:
+                return func(*args, **kwargs)
+
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = [
+                (k, v) for k, v in bound.arguments.items() if k not in ignore
+            ]
+
+            key = result_key(metric, version, arguments, store)
+            found, value = store.get(key)
+            if found:
+                return value
+
+            value = func(*args, **kwargs)
+            store.put(key, metric, version, value)
+
+            return value
+
+        wrapper.metric_name = metric
+        wrapper.metric_version = version
+
+        return wrapper
+
+    return decorate
+
+
+# =========================================================
+# Run-wide store
+# =========================================================
+
+_store = None
+
+if os.environ.get("EVAL_RESULT_STORE"):
+    _store = ResultStore(os.environ["EVAL_RESULT_STORE"])
+
+
+def get_result_store():
+    """
+    The configured result store, or None if results are not cached.
+    """
+    return _store
+
+
+def configure_result_store(path):
+    """
+    Cache metric results in the SQLite file at ``path`` (None disables
+    it). Also configurable through the EVAL_RESULT_STORE environment
+    variable.
+    """
+
+    global _store
+
+    _store = ResultStore(path) if path else None
+
+    return _store
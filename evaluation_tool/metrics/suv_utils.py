@@ -5,11 +5,15 @@ Provides conversion of PET activity concentration to SUV.
 """
 
 import json
-import nibabel as nib
 import numpy as np
 
+from .precision import ACCUM_DTYPE
+from .volume_cache import load_volume
+from .profiling import profiled
 
-def load_pet_as_suv(pet_path, json_path, pet_unit="kBq"):
+
+@profiled("stage", "suv_conversion")
+def load_pet_as_suv(pet_path, json_path, pet_unit="kBq", persist=False):
     """
     Convert PET activity concentration to SUV.
 
@@ -24,11 +28,28 @@ def load_pet_as_suv(pet_path, json_path, pet_unit="kBq"):
     pet_unit : str
         'kBq'  → PET stored in kBq/mL (final challenge data)
         'Bq'   → PET stored in Bq/mL (training data)
+    persist : bool
+        True for ground-truth PET, which may then be served from
+        the persistent volume store.
 
     Returns
     -------
     pet_suv : ndarray
-        PET volume converted to SUV.
+        PET volume converted to SUV, in the PET dtype of the
+        precision policy. Only the raw volume is kept in the volume
+        cache; the scaled copy belongs to the caller. Metrics reduce
+        the raw volume and apply ``suv_norm_factor`` to the result
+        instead.
+    """
+
+    norm_factor = suv_norm_factor(json_path, pet_unit)
+
+    return load_volume(pet_path, persist=persist) * norm_factor
+
+
+def suv_norm_factor(json_path, pet_unit="kBq"):
+    """
+    Factor converting PET activity concentration to SUV.
     """
 
     with open(json_path, "r") as f:
@@ -37,8 +58,6 @@ def load_pet_as_suv(pet_path, json_path, pet_unit="kBq"):
     weight_kg = meta["PatientWeight"]
     dose_mbq = meta["InjectedRadioactivity"]
 
-    pet = nib.load(pet_path).get_fdata()
-
     if pet_unit == "kBq":
         scale = 1e3
     elif pet_unit == "Bq":
@@ -46,16 +65,16 @@ def load_pet_as_suv(pet_path, json_path, pet_unit="kBq"):
     else:
         raise ValueError("pet_unit must be 'kBq' or 'Bq'")
 
-    norm_factor = weight_kg / (dose_mbq * scale)
+    return weight_kg / (dose_mbq * scale)
 
-    return pet * norm_factor
 
-
-def suv_sanity_check(pet_suv, body_mask, name="PET"):
+def suv_sanity_check(pet, body_mask, name="PET", norm_factor=1.0):
     """
     Debug helper to verify SUV magnitude (~1 inside body).
+
+    ``pet`` is in SUV, or raw activity with its ``norm_factor``.
     """
-    mean_suv = np.mean(pet_suv[body_mask])
+    mean_suv = np.mean(pet[body_mask], dtype=ACCUM_DTYPE) * norm_factor
     print(f"[DEBUG] {name} mean SUV (body): {mean_suv:.4f}")
 
     if mean_suv < 0.01 or mean_suv > 50:
@@ -3,10 +3,15 @@ TAC bias metric.
 """
 
 import numpy as np
-import nibabel as nib
-from .common import compute_region_auc
+from .common import compute_region_tacs, integrate_tac, iter_frames, load_region_tacs
+from .label_stats import load_label_index
+from .volume_cache import load_image
+from .result_store import cached_metric
+from .profiling import profiled
 
 
+@profiled("metric")
+@cached_metric(version="1")
 def compute_tac_bias(
     pred_path,
     gt_path,
@@ -19,36 +24,36 @@ def compute_tac_bias(
 ):
     """
     Compute TAC bias as MARE of integrated AUC values.
+
+    Pred and GT (paths or image objects such as
+    ``VirtualDynamicImage``) are streamed frame by frame, so peak
+    memory is about one frame plus the label indices. The reference
+    TACs are cached per GT file.
     """
 
-    pred = nib.load(pred_path).get_fdata()
-    gt = nib.load(gt_path).get_fdata()
-    ts_seg = nib.load(totalseg_path).get_fdata()
-    synthseg = nib.load(synthseg_path).get_fdata()
+    shape = load_image(pred_path).shape
 
-    assert pred.ndim == 4
-    assert len(frame_durations) == pred.shape[-1]
+    assert len(shape) == 4
+    assert len(frame_durations) == shape[-1]
 
-    mare_values = []
+    # Aorta, then brain regions
+    regions = [(totalseg_path, [aorta_label]), (synthseg_path, brain_label_ids)]
+    indices = [load_label_index(path, ids) for path, ids in regions]
 
-    # Aorta
-    aorta_mask = ts_seg == aorta_label
-    if np.sum(aorta_mask) > 0:
-        auc_pred = compute_region_auc(pred, aorta_mask, frame_durations)
-        auc_gt = compute_region_auc(gt, aorta_mask, frame_durations)
-        mare_values.append(np.abs(auc_pred - auc_gt) / (np.abs(auc_gt) + epsilon))
+    tacs_pred = compute_region_tacs(iter_frames(pred_path), indices)
+    tacs_gt = load_region_tacs(gt_path, regions, persist=True)
+
+    mare_values = []
 
-    # Brain regions
-    for label_id in brain_label_ids:
-        region_mask = synthseg == label_id
-        if np.sum(region_mask) == 0:
-            continue
+    for index, region_pred, region_gt in zip(indices, tacs_pred, tacs_gt):
+        present = index.counts > 0
 
-        auc_pred = compute_region_auc(pred, region_mask, frame_durations)
-        auc_gt = compute_region_auc(gt, region_mask, frame_durations)
-        mare_values.append(np.abs(auc_pred - auc_gt) / (np.abs(auc_gt) + epsilon))
+        for tac_pred, tac_gt in zip(region_pred[present], region_gt[present]):
+            auc_pred = integrate_tac(tac_pred, frame_durations)
+            auc_gt = integrate_tac(tac_gt, frame_durations)
+            mare_values.append(np.abs(auc_pred - auc_gt) / (np.abs(auc_gt) + epsilon))
 
     if not mare_values:
         raise ValueError("No valid TAC regions found.")
 
-    return np.mean(mare_values)
\ No newline at end of file
+    return np.mean(mare_values)
@@ -0,0 +1,364 @@
+"""
+Volume cache
+
+Keeps decoded NIfTI volumes and arrays derived from them (SUV-scaled
+PET, boolean masks) in memory for the duration of an evaluation run,
+so each file is decompressed once no matter how many metrics use it.
+
+Loads marked ``persist`` (ground truth and label maps) are served from
+the persistent volume store when one is configured.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import nibabel as nib
+
+from .precision import get_pet_dtype
+from .profiling import span
+from .volume_store import decode_volume, get_store, is_file_backed
+
+
+DEFAULT_MAX_BYTES = int(os.environ.get("EVAL_CACHE_MB", "4096")) * 1024 ** 2
+
+
+class VolumeCache:
+    """
+    LRU cache of read-only arrays bounded by a memory budget.
+
+    Keys are tuples whose first element is the absolute path of the
+    source file, so everything derived from one file can be dropped
+    together with ``drop``.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = int(max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.RLock()
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def get(self, key, factory):
+        """
+        Return the cached value for ``key``, computing it with
+        ``factory()`` on a miss.
+        """
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+
+        value = factory()
+
+        if isinstance(value, np.ndarray):
+            value.flags.writeable = False
+
+        self._insert(key, value)
+
+        return value
+
+    def peek(self, key):
+        """
+        Cached value for ``key``, or None; does not count as a use.
+        """
+
+        with self._lock:
+            return self._entries.get(key)
+
+    def drop(self, path):
+        """
+        Remove every entry derived from ``path``.
+        """
+
+        path = os.path.abspath(path)
+
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == path]:
+                self._nbytes -= _sizeof(self._entries.pop(key))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def _insert(self, key, value):
+        size = _sizeof(value)
+
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                return
+
+            while self._entries and self._nbytes + size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._nbytes -= _sizeof(evicted)
+
+            self._entries[key] = value
+            self._nbytes += size
+
+
+def _sizeof(value):
+    # Memory-mapped store files live in the page cache, not the budget
+    if isinstance(value, np.ndarray) and is_file_backed(value):
+        return 0
+    return int(getattr(value, "nbytes", 0))
+
+
+# =========================================================
+# Run-wide cache
+# =========================================================
+
+_cache = VolumeCache()
+
+
+def get_cache():
+    """
+    Return the cache shared by all metric functions.
+    """
+    return _cache
+
+
+def configure_cache(max_bytes):
+    """
+    Change the memory budget of the shared cache, evicting
+    entries if the new budget is smaller.
+    """
+
+    _cache.max_bytes = int(max_bytes)
+
+    with _cache._lock:
+        while _cache._entries and _cache._nbytes > _cache.max_bytes:
+            _, evicted = _cache._entries.popitem(last=False)
+            _cache._nbytes -= _sizeof(evicted)
+
+
+# =========================================================
+# Virtual dynamic volumes
+# =========================================================
+
+class BroadcastArrayProxy:
+    """
+    Read-only ``dataobj``-like view of a 3D array repeated along a
+    fourth (frame) axis. Indexing returns views; nothing is copied.
+    """
+
+    def __init__(self, data, num_frames):
+        self._view = np.broadcast_to(
+            data[..., np.newaxis], data.shape + (num_frames,)
+        )
+
+    @property
+    def shape(self):
+        return self._view.shape
+
+    @property
+    def ndim(self):
+        return self._view.ndim
+
+    @property
+    def dtype(self):
+        return self._view.dtype
+
+    def __getitem__(self, key):
+        return self._view[key]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self._view, dtype=dtype)
+
+
+class VirtualDynamicImage:
+    """
+    Dynamic PET made of one 3D volume repeated ``num_frames`` times.
+
+    Stands in for real dynamic data when testing the TAC and brain
+    metrics: frames are views of the cached 3D volume, so nothing is
+    copied or written to disk.
+    """
+
+    def __init__(self, path, num_frames=8):
+        img = nib.load(path)
+
+        if len(img.shape) != 3:
+            raise ValueError(f"{path} is not a 3D volume")
+
+        self.path = path
+        self.num_frames = num_frames
+        self.affine = img.affine
+        self.header = img.header
+        self.shape = img.shape + (num_frames,)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def dataobj(self):
+        return BroadcastArrayProxy(load_volume(self.path), self.num_frames)
+
+    def get_fdata(self, dtype=np.float64):
+        return np.asarray(self.dataobj[...], dtype=dtype)
+
+
+def load_image(source):
+    """
+    Image for a volume source: a file path or an image object
+    (e.g. ``VirtualDynamicImage``) that is passed through.
+    """
+
+    if isinstance(source, (str, os.PathLike)):
+        return nib.load(source)
+
+    return source
+
+
+# =========================================================
+# Cached loaders
+# =========================================================
+
+def _decode(path, dtype, persist):
+    """
+    Decode a volume (``dtype=None``: on-disk dtype), through the
+    persistent store if requested and configured.
+    """
+
+    store = get_store()
+
+    if persist and store is not None:
+        return store.load(path, dtype)
+
+    return decode_volume(path, dtype)
+
+
+def load_volume(source, dtype=None, persist=False):
+    """
+    Load a NIfTI volume as a read-only array of ``dtype``
+    (default: the PET dtype of the precision policy).
+
+    ``persist`` marks inputs that never change between submissions
+    (ground truth), which may be served from the persistent store.
+    A ``VirtualDynamicImage`` is returned as a broadcast view of its
+    cached 3D volume.
+    """
+
+    dtype = np.dtype(get_pet_dtype() if dtype is None else dtype)
+
+    if isinstance(source, VirtualDynamicImage):
+        return source.dataobj[...].astype(dtype, copy=False)
+
+    key = (os.path.abspath(source), "volume", dtype.str)
+
+    return _cache.get(key, lambda: _decode(source, dtype, persist))
+
+
+def load_static_frame(source, dtype=None, persist=False):
+    """
+    Load the static (3D) image of a volume source.
+
+    3D volumes are returned whole; for dynamic PET only the first
+    frame is read.
+    """
+
+    dtype = np.dtype(get_pet_dtype() if dtype is None else dtype)
+
+    if isinstance(source, VirtualDynamicImage):
+        return load_volume(source.path, dtype)
+
+    img = nib.load(source)
+
+    if len(img.shape) == 3:
+        return load_volume(source, dtype, persist)
+
+    key = (os.path.abspath(source), "frame0", dtype.str)
+    store = get_store()
+
+    if persist and store is not None:
+        return _cache.get(key, lambda: store.load(source, dtype)[..., 0])
+
+    return _cache.get(
+        key, lambda: np.asarray(img.dataobj[..., 0], dtype=dtype)
+    )
+
+
+def load_labels(path):
+    """
+    Load a label image in its native (integer) dtype, without the
+    float64 upcast of ``get_fdata``. Label maps are ground truth and
+    go through the persistent store when one is configured.
+    """
+
+    key = (os.path.abspath(path), "labels")
+
+    return _cache.get(key, lambda: _decode(path, None, persist=True))
+
+
+def load_mask(path):
+    """
+    Load a label image as a read-only boolean mask (label > 0).
+    """
+
+    key = (os.path.abspath(path), "mask")
+
+    def build():
+        labels = load_labels(path)
+        with span("mask"):
+            return labels > 0
+
+    return _cache.get(key, build)
+
+
+def iter_slabs(source, z_ranges, thickness, dtype=None, persist=False):
+    """
+    Yield ``(z0, z1, slab)`` for consecutive z-slabs of at most
+    ``thickness`` slices covering each ``(z_start, z_stop)`` range.
+
+    ``source`` is an in-memory array or a NIfTI path; ``dtype=None``
+    keeps the on-disk dtype (label maps). For a path, slabs are sliced
+    from the cached volume if it is already in memory, else from the
+    persistent store (``persist``), else read through the nibabel
+    array proxy with the file kept open, so only a slab at a time is
+    decoded into memory.
+    """
+
+    if isinstance(source, np.ndarray):
+        yield from _slice_slabs(source, z_ranges, thickness, dtype)
+        return
+
+    path = os.path.abspath(source)
+
+    if dtype is None:
+        key = (path, "labels")
+    else:
+        dtype = np.dtype(dtype)
+        key = (path, "volume", dtype.str)
+
+    data = _cache.peek(key)
+    store = get_store()
+
+    if data is None and persist and store is not None:
+        data = store.load(source, dtype)
+
+    if data is None:
+        data = nib.load(source, keep_file_open=True).dataobj
+
+    yield from _slice_slabs(data, z_ranges, thickness, dtype)
+
+
+def _slice_slabs(data, z_ranges, thickness, dtype):
+    for z_start, z_stop in z_ranges:
+        for z0 in range(z_start, z_stop, thickness):
+            z1 = min(z0 + thickness, z_stop)
+            with span("read_slab", "io"):
+                slab = np.asarray(data[:, :, z0:z1], dtype=dtype)
+            yield z0, z1, slab
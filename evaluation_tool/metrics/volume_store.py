@@ -0,0 +1,340 @@
+"""
+Persistent volume store
+
+On-disk cache of decompressed NIfTI volumes. Each source is converted
+once into an uncompressed ``.npy`` file and later loads are served as
+read-only ``np.memmap`` arrays, with no gzip decoding. Intended for
+inputs that never change between submissions (ground-truth PET,
+TotalSegmentator and SynthSeg label maps).
+
+Entries are invalidated when the source size/mtime changes (or, with
+``verify="hash"``, when its content hash changes) and evicted least
+recently used once the store exceeds its size cap.
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+
+import numpy as np
+import nibabel as nib
+
+from .profiling import profiled
+
+
+VERIFY_MODES = ("stat", "hash")
+
+
+class VolumeStore:
+    """
+    Directory of memory-mappable volumes keyed by source path and dtype
+    (or by a tag, for arrays derived from a source).
+
+    Parameters
+    ----------
+    root : str
+        Store directory (created if missing).
+    max_bytes : int or None
+        Size cap of all stored arrays; None means unbounded.
+    verify : str
+        'stat' → an entry is stale when the source size or mtime changed.
+        'hash' → additionally accept a changed stat if the SHA-256 of the
+                 source is unchanged (e.g. files copied or touched).
+    """
+
+    def __init__(self, root, max_bytes=None, verify="stat"):
+        if verify not in VERIFY_MODES:
+            raise ValueError(f"verify must be one of {VERIFY_MODES}")
+
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.verify = verify
+
+        os.makedirs(self.root, exist_ok=True)
+
+    # -----------------------------------------------------
+    # Loading
+    # -----------------------------------------------------
+
+    @profiled("io", "store_load")
+    def load(self, path, dtype=None):
+        """
+        Read-only memmap of a NIfTI volume, decoding and storing it
+        on first use. ``dtype=None`` keeps the on-disk dtype.
+        """
+
+        dtype_tag = "native" if dtype is None else np.dtype(dtype).str
+
+        return self._load_entry(
+            path, dtype_tag, lambda: (decode_volume(path, dtype), {})
+        )[0]
+
+    def load_derived(self, path, tag, build):
+        """
+        Read-only memmap and metadata dict of an array derived from
+        ``path`` (e.g. a segmentation index). ``build()`` returns
+        (array, JSON-serializable metadata) and runs on first use or
+        when the source changed.
+        """
+
+        return self._load_entry(path, tag, build)
+
+    def has_derived(self, path, tag):
+        """
+        True if a derived array of ``path`` is stored and its source is
+        unchanged, i.e. ``load_derived`` would not build it.
+        """
+
+        path = os.path.abspath(path)
+        entry = self._entry_name(path, tag)
+
+        return (
+            self._fresh_meta(path, os.path.join(self.root, entry + ".json")) is not None
+            and os.path.exists(os.path.join(self.root, entry + ".npy"))
+        )
+
+    def _load_entry(self, path, tag, build):
+        path = os.path.abspath(path)
+        entry = self._entry_name(path, tag)
+
+        array_path = os.path.join(self.root, entry + ".npy")
+        meta_path = os.path.join(self.root, entry + ".json")
+
+        meta = self._fresh_meta(path, meta_path)
+
+        if meta is not None and os.path.exists(array_path):
+            # Touch the metadata file: its mtime is the LRU timestamp
+            os.utime(meta_path)
+            return np.load(array_path, mmap_mode="r"), meta.get("derived", {})
+
+        data, derived = build()
+
+        if self.max_bytes is not None and data.nbytes > self.max_bytes:
+            return data, derived
+
+        _atomic_write(array_path, lambda f: np.save(f, data))
+        _atomic_write(meta_path, lambda f: f.write(json.dumps({
+            "source": path,
+            "dtype": tag,
+            "nbytes": int(data.nbytes),
+            "shape": list(data.shape),
+            "derived": derived,
+            **self._fingerprint(path),
+        }).encode()))
+
+        self._enforce_cap(keep=entry)
+
+        return np.load(array_path, mmap_mode="r"), derived
+
+    def load_image(self, path, dtype=None):
+        """
+        NIfTI image with the header/affine of ``path`` whose data is
+        the stored memmap. The image keeps ``path`` as its filename,
+        so it can still be identified by its source file.
+        """
+
+        img = nib.load(path)
+        stored = nib.Nifti1Image(self.load(path, dtype), img.affine, img.header)
+        stored.set_filename(str(path))
+
+        return stored
+
+    # -----------------------------------------------------
+    # Staleness
+    # -----------------------------------------------------
+
+    def _fingerprint(self, path):
+        st = os.stat(path)
+        fp = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+        if self.verify == "hash":
+            fp["sha256"] = _file_sha256(path)
+
+        return fp
+
+    def _fresh_meta(self, path, meta_path):
+        """
+        Metadata of an entry whose source is unchanged, else None.
+        """
+
+        try:
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        st = os.stat(path)
+
+        if meta["size"] == st.st_size and meta["mtime_ns"] == st.st_mtime_ns:
+            return meta
+
+        if self.verify != "hash" or "sha256" not in meta:
+            return None
+
+        if meta["size"] != st.st_size or meta["sha256"] != _file_sha256(path):
+            return None
+
+        # Same content, new stat: remember it so the hash is not redone
+        meta["mtime_ns"] = st.st_mtime_ns
+        _atomic_write(meta_path, lambda f: f.write(json.dumps(meta).encode()))
+
+        return meta
+
+    # -----------------------------------------------------
+    # Eviction
+    # -----------------------------------------------------
+
+    def entries(self):
+        """
+        (entry name, nbytes, last access time) of every stored volume.
+        """
+
+        found = []
+
+        for name in os.listdir(self.root):
+            if not name.endswith(".json"):
+                continue
+
+            meta_path = os.path.join(self.root, name)
+
+            try:
+                with open(meta_path, "r") as f:
+                    nbytes = json.load(f)["nbytes"]
+                atime = os.stat(meta_path).st_mtime
+            except (OSError, ValueError, KeyError):
+                continue
+
+            found.append((name[:-len(".json")], nbytes, atime))
+
+        return found
+
+    def _enforce_cap(self, keep=None):
+        if self.max_bytes is None:
+            return
+
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        total = sum(e[1] for e in entries)
+
+        for name, nbytes, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+
+            self.remove(name)
+            total -= nbytes
+
+    def remove(self, name):
+        # Readers that already mapped the file keep a valid mapping
+        for ext in (".json", ".npy"):
+            try:
+                os.remove(os.path.join(self.root, name + ext))
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _entry_name(path, dtype_tag):
+        key = f"{path}|{dtype_tag}".encode()
+        stem = os.path.basename(path).split(".nii")[0]
+        return f"{stem}-{hashlib.sha1(key).hexdigest()[:16]}"
+
+
+@profiled("io", "decode")
+def decode_volume(path, dtype=None):
+    """
+    Decode a NIfTI volume; ``dtype=None`` keeps the on-disk dtype
+    (label maps stay integer).
+    """
+
+    img = nib.load(path)
+
+    if dtype is None:
+        return np.asanyarray(img.dataobj)
+
+    return img.get_fdata(dtype=np.dtype(dtype))
+
+
+def _file_sha256(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def _atomic_write(path, write):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        # mkstemp creates 0600 files; the store may be shared
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def is_file_backed(array):
+    """
+    True if ``array`` is (a view of) a memory-mapped file.
+    """
+
+    base = array
+    while isinstance(base, np.ndarray):
+        base = base.base
+
+    return isinstance(base, mmap.mmap)
+
+
+# =========================================================
+# Run-wide store
+# =========================================================
+
+_store = None
+
+if os.environ.get("EVAL_VOLUME_STORE"):
+    _max_gb = os.environ.get("EVAL_VOLUME_STORE_GB")
+    _store = VolumeStore(
+        os.environ["EVAL_VOLUME_STORE"],
+        max_bytes=int(float(_max_gb) * 1024 ** 3) if _max_gb else None,
+        verify=os.environ.get("EVAL_VOLUME_STORE_VERIFY", "stat"),
+    )
+
+
+def get_store():
+    """
+    The configured store, or None if volumes are decoded directly.
+    """
+    return _store
+
+
+def configure_store(root, max_bytes=None, verify="stat"):
+    """
+    Serve persistent loads from a store at ``root`` (None disables it).
+    Also configurable through the EVAL_VOLUME_STORE, EVAL_VOLUME_STORE_GB
+    and EVAL_VOLUME_STORE_VERIFY environment variables.
+    """
+
+    global _store
+
+    _store = VolumeStore(root, max_bytes, verify) if root else None
+
+    return _store
+
+
+def load_nifti(path, dtype=None):
+    """
+    NIfTI image served from the configured store, or ``nib.load``
+    when no store is configured.
+    """
+
+    if _store is None:
+        return nib.load(path)
+
+    return _store.load_image(path, dtype)
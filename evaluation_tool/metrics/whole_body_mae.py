@@ -2,11 +2,20 @@
 Whole-body SUV MAE metric.
 """
 
+import os
+
 import numpy as np
 import nibabel as nib
-from .suv_utils import load_pet_as_suv, suv_sanity_check
+from .suv_utils import suv_norm_factor, suv_sanity_check
+from .precision import ACCUM_DTYPE, get_pet_dtype
+from .volume_cache import get_cache, iter_slabs, load_mask, load_volume
+from .seg_index import load_segmentation_index
+from .result_store import cached_metric
+from .profiling import profiled, span
 
 
+@profiled("metric")
+@cached_metric(version="1", ignore=("debug", "slab_thickness"))
 def compute_whole_body_suv_mae(
     pred_pet_path,
     gt_pet_path,
@@ -16,33 +25,157 @@ def compute_whole_body_suv_mae(
     pet_unit="kBq",
     exclusion_cm=4.0,
     debug=False,
+    slab_thickness=None,
 ):
     """
     Compute voxel-wise MAE of SUV inside body,
     excluding ±4 cm around superior liver slice.
+
+    The absolute error is accumulated in float64 on the raw PET
+    values and scaled to SUV afterwards (SUV scaling is linear).
+
+    With ``slab_thickness`` (slices), the volumes are streamed in
+    z-slabs instead of loaded whole: the superior liver slice is
+    found first, then the slabs outside the exclusion band are
+    reduced one at a time (the band itself is never read), so peak
+    memory is a few slabs. Without it, whole volumes are loaded
+    through the shared volume cache for reuse by other metrics and
+    only the body voxels listed by the body mask's segmentation index
+    are gathered; the superior liver slice comes from the liver
+    mask's index.
     """
 
-    pred = load_pet_as_suv(pred_pet_path, json_path, pet_unit)
-    gt = load_pet_as_suv(gt_pet_path, json_path, pet_unit)
+    norm_factor = suv_norm_factor(json_path, pet_unit)
 
-    body_mask = nib.load(body_mask_path).get_fdata() > 0
-    liver_mask = nib.load(liver_mask_path).get_fdata() > 0
+    header = nib.load(pred_pet_path).header
+    num_slices = header.get_data_shape()[2]
+
+    slice_thickness_mm = header.get_zooms()[2]
+    exclusion_slices = int(round((exclusion_cm * 10.0) / slice_thickness_mm))
 
     if debug:
-        suv_sanity_check(pred, body_mask, "Prediction")
-        suv_sanity_check(gt, body_mask, "Ground Truth")
+        suv_sanity_check(
+            load_volume(pred_pet_path),
+            load_mask(body_mask_path), "Prediction", norm_factor
+        )
+        suv_sanity_check(
+            load_volume(gt_pet_path, persist=True),
+            load_mask(body_mask_path), "Ground Truth", norm_factor
+        )
 
-    slice_thickness_mm = nib.load(pred_pet_path).header.get_zooms()[2]
-    exclusion_slices = int(round((exclusion_cm * 10.0) / slice_thickness_mm))
+    if slab_thickness is None:
+        abs_error_sum, count = _indexed_abs_error(
+            pred_pet_path, gt_pet_path, body_mask_path, liver_mask_path,
+            num_slices, exclusion_slices,
+        )
+    else:
+        abs_error_sum, count = _streamed_abs_error(
+            pred_pet_path, gt_pet_path, body_mask_path, liver_mask_path,
+            num_slices, exclusion_slices, slab_thickness,
+        )
+
+    return abs_error_sum / count * norm_factor
+
+
+def _indexed_abs_error(pred_path, gt_path, body_mask_path, liver_mask_path,
+                       num_slices, exclusion_slices):
+    """
+    Sum and count of the absolute errors over the body voxels outside
+    the exclusion band, gathered through the segmentation indices of
+    the body and liver masks. Whole volumes go through the shared
+    volume cache for reuse by other metrics.
+    """
+
+    liver = load_segmentation_index(liver_mask_path)
+
+    if not len(liver.label_ids):
+        raise ValueError("Liver mask is empty.")
 
-    superior_slice = np.max(np.where(liver_mask)[2])
+    superior_slice = liver.superior_slice
 
     z_min = max(0, superior_slice - exclusion_slices)
-    z_max = min(pred.shape[2], superior_slice + exclusion_slices)
+    z_max = min(num_slices, superior_slice + exclusion_slices)
+
+    body = load_segmentation_index(body_mask_path)
+    voxels = body.region_voxels()
+
+    pred = load_volume(pred_path)
+    gt = load_volume(gt_path, persist=True)
+
+    with span("reduce"):
+        # Flat Fortran-order index -> z index
+        z = voxels // (body.shape[0] * body.shape[1])
+        voxels = voxels[(z < z_min) | (z >= z_max)]
+
+        pred = body.gather(pred, voxels)
+        gt = body.gather(gt, voxels)
+
+        abs_error = np.abs(pred.astype(ACCUM_DTYPE) - gt.astype(ACCUM_DTYPE))
+
+    return np.sum(abs_error), abs_error.size
+
+
+def _streamed_abs_error(pred_path, gt_path, body_mask_path, liver_mask_path,
+                        num_slices, exclusion_slices, thickness):
+    """
+    Sum and count of the absolute errors over the body voxels outside
+    the exclusion band, reading the volumes in z-slabs: the superior
+    liver slice is found first, then the slabs outside the band are
+    reduced one at a time (the band itself is never read).
+    """
+
+    superior_slice = get_cache().get(
+        (os.path.abspath(liver_mask_path), "superior_slice"),
+        lambda: find_superior_slice(liver_mask_path, num_slices, thickness),
+    )
+
+    z_min = max(0, superior_slice - exclusion_slices)
+    z_max = min(num_slices, superior_slice + exclusion_slices)
+
+    eval_ranges = [(0, z_min), (z_max, num_slices)]
+    pet_dtype = get_pet_dtype()
+
+    slabs = zip(
+        iter_slabs(pred_path, eval_ranges, thickness, pet_dtype),
+        iter_slabs(gt_path, eval_ranges, thickness, pet_dtype, persist=True),
+        iter_slabs(body_mask_path, eval_ranges, thickness, persist=True),
+    )
+
+    abs_error_sum = np.float64(0.0)
+    count = 0
+
+    for (_, _, pred_slab), (_, _, gt_slab), (_, _, body_slab) in slabs:
+        with span("reduce"):
+            in_body = body_slab > 0
+
+            abs_error = np.abs(
+                pred_slab[in_body].astype(ACCUM_DTYPE)
+                - gt_slab[in_body].astype(ACCUM_DTYPE)
+            )
+
+            abs_error_sum += np.sum(abs_error)
+            count += abs_error.size
+
+    return abs_error_sum, count
+
+
+def find_superior_slice(liver_mask, num_slices, thickness):
+    """
+    Highest z index containing liver (label > 0), scanning the mask
+    (an array or a label file) in z-slabs.
+    """
+
+    superior_slice = None
+
+    for z0, _, slab in iter_slabs(
+        liver_mask, [(0, num_slices)], thickness, persist=True
+    ):
+        z_with_liver = np.nonzero(np.any(slab > 0, axis=(0, 1)))[0]
 
-    exclusion_mask = np.zeros_like(body_mask, dtype=bool)
-    exclusion_mask[:, :, z_min:z_max] = True
+        if z_with_liver.size:
+            superior_slice = z0 + int(z_with_liver[-1])
 
-    eval_mask = body_mask & (~exclusion_mask)
+    if superior_slice is None:
+        raise ValueError("Liver mask is empty.")
 
-    return np.mean(np.abs(pred - gt)[eval_mask])
\ No newline at end of file
+    return superior_slice
@@ -0,0 +1,186 @@
+"""Assembly of a subject's inputs into one channel-stacked array on a common grid.
+
+The PET, the stitched DIXON body chunks, the full-body and head DIXON and the topogram are decoded
+concurrently, resampled onto the grid of a reference input (the PET by default: predictions live there) and
+stacked as float32 (channel, x, y, z), together with a validity mask per channel (voxels the channel's
+inputs cover). Overlapping DIXON chunks are blended with weights that ramp down towards each chunk's z ends,
+so there is no seam. The topogram, a projection with a singleton axis, is broadcast along that axis.
+
+With a cache directory the result is written once as .npy files keyed by the content hashes of the inputs
+and later runs memory-map them instead of decompressing the gzip'd inputs again.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from resample import resample
+from utils import get_input_images, load_input_images
+
+# Channel name -> input images (several: chunks blended along z)
+CHANNELS = {
+    "nacstat_pet": ("nacstat_pet",),
+    "dixon_in": tuple(f"dixon_body_chunk{i}_inhase" for i in range(1, 5)),
+    "dixon_out": tuple(f"dixon_body_chunk{i}_outphase" for i in range(1, 5)),
+    "dixon_body_in": ("dixon_body_full_inphase",),
+    "dixon_body_out": ("dixon_body_full_outphase",),
+    "dixon_head_in": ("dixon_head_inphase",),
+    "dixon_head_out": ("dixon_head_outphase",),
+    "topogram": ("topogram",),
+}
+
+# Bump when the assembled layout or the blending changes, to invalidate cached assemblies
+ASSEMBLY_VERSION = "1"
+
+HASH_BLOCK_BYTES = 1 << 20
+
+
+@dataclass
+class AssembledInputs:
+    data: np.ndarray  # float32 (channel, x, y, z); 0 where invalid
+    valid: np.ndarray  # bool (channel, x, y, z)
+    channels: tuple[str, ...]
+    affine: np.ndarray
+
+    def __getitem__(self, channel):
+        return self.data[self.channels.index(channel)]
+
+    def mask(self, channel):
+        return self.valid[self.channels.index(channel)]
+
+
+def file_digest(path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(HASH_BLOCK_BYTES):
+            h.update(block)
+    return h.hexdigest()
+
+
+def assembly_key(paths: dict, channels: dict, reference: str) -> str:
+    """Hash of the input contents, the channel layout and the reference grid input."""
+    names = sorted({name for sources in channels.values() for name in sources} | {reference})
+    with ThreadPoolExecutor() as executor:  # hashlib releases the GIL on large blocks
+        digests = dict(zip(names, executor.map(lambda name: file_digest(paths[name]), names)))
+    payload = json.dumps([ASSEMBLY_VERSION, reference, {k: list(v) for k, v in channels.items()}, digests],
+                         sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _projection_affine(source_shape, source_affine, target_affine):
+    """Target affine shifted along the target axis matching the source's singleton axis, so that axis maps onto
+    the source plane; the resampled slab is then broadcast along it."""
+    axis = source_shape.index(1)
+    matrix = np.linalg.inv(source_affine) @ target_affine
+    target_axis = int(np.argmax(np.abs(matrix[axis, :3])))
+    shift = np.eye(4)
+    shift[target_axis, 3] = -matrix[axis, 3] / matrix[axis, target_axis]
+    return target_affine @ shift, target_axis
+
+
+def _feather(num_slices):
+    """Blending weight of every z slice of a chunk: ramps from the ends to the middle, positive everywhere."""
+    z = np.arange(num_slices, dtype=np.float32)
+    return np.minimum(z + 0.5, num_slices - 0.5 - z)
+
+
+def _resample_channel(images, target_shape, target_affine):
+    """One channel on the target grid: (values with 0 where invalid, validity mask)."""
+    if len(images) == 1:
+        img = images[0]
+        data = img.get_fdata(dtype=np.float32)
+        if 1 in img.shape[:3]:
+            affine, axis = _projection_affine(img.shape[:3], img.affine, target_affine)
+            slab_shape = tuple(1 if a == axis else n for a, n in enumerate(target_shape))
+            slab = resample(data, img.affine, slab_shape, affine, fill=np.nan)
+            values = np.broadcast_to(slab, target_shape)
+        else:
+            values = resample(data, img.affine, target_shape, target_affine, fill=np.nan)
+        valid = np.isfinite(values)
+        return np.where(valid, values, 0).astype(np.float32, copy=False), valid
+
+    total = np.zeros(target_shape, dtype=np.float32)
+    weights = np.zeros(target_shape, dtype=np.float32)
+    for img in images:
+        data = img.get_fdata(dtype=np.float32)
+        weight = np.broadcast_to(_feather(data.shape[2]), data.shape)
+        values = resample(data, img.affine, target_shape, target_affine, fill=np.nan)
+        weight = resample(weight, img.affine, target_shape, target_affine, fill=0)
+        covered = np.isfinite(values)
+        weight = np.where(covered, weight, 0)
+        total += np.where(covered, values, 0) * weight
+        weights += weight
+    valid = weights > 0
+    return np.divide(total, weights, out=np.zeros_like(total), where=valid), valid
+
+
+def _assemble(images, channels, reference, directory=None):
+    """Assemble into arrays, or into .npy files in `directory` (one channel in memory at a time)."""
+    ref = images[reference]
+    shape = ref.shape[:3]
+    full_shape = (len(channels),) + shape
+    if directory is None:
+        data = np.empty(full_shape, dtype=np.float32)
+        valid = np.empty(full_shape, dtype=bool)
+    else:
+        data = np.lib.format.open_memmap(directory / "data.npy", "w+", np.float32, full_shape)
+        valid = np.lib.format.open_memmap(directory / "valid.npy", "w+", bool, full_shape)
+    for c, sources in enumerate(channels.values()):
+        data[c], valid[c] = _resample_channel([images[name] for name in sources], shape, ref.affine)
+    return AssembledInputs(data, valid, tuple(channels), ref.affine)
+
+
+def load_assembly(directory) -> AssembledInputs:
+    """Memory-map a cached assembly."""
+    directory = Path(directory)
+    meta = json.loads((directory / "meta.json").read_text())
+    return AssembledInputs(np.load(directory / "data.npy", mmap_mode="r"),
+                           np.load(directory / "valid.npy", mmap_mode="r"),
+                           tuple(meta["channels"]), np.asarray(meta["affine"]))
+
+
+def assemble_inputs(input_dir, channels=CHANNELS, reference="nacstat_pet", cache_dir=None) -> AssembledInputs:
+    """Channel-stacked inputs of a subject on the grid of `reference`.
+
+    With `cache_dir`, the assembly is looked up under `<cache_dir>/<key>` (see `assembly_key`) and
+    memory-mapped; on a miss it is built there, written to a temporary directory and renamed into place, so
+    concurrent runs never see a partial assembly.
+    """
+    names = list(dict.fromkeys([reference] + [name for sources in channels.values() for name in sources]))
+
+    if cache_dir is None:
+        with load_input_images(input_dir, names=names) as images:
+            return _assemble(images, channels, reference)
+
+    cache_dir = Path(cache_dir)
+    directory = cache_dir / assembly_key(get_input_images(input_dir), channels, reference)
+    if (directory / "meta.json").exists():
+        return load_assembly(directory)
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp = Path(tempfile.mkdtemp(prefix=f".{directory.name}.", dir=cache_dir))
+    try:
+        with load_input_images(input_dir, names=names) as images:
+            assembled = _assemble(images, channels, reference, tmp)
+        assembled.data.flush()
+        assembled.valid.flush()
+        (tmp / "meta.json").write_text(json.dumps({
+            "channels": list(assembled.channels),
+            "affine": assembled.affine.tolist(),
+            "input_dir": str(Path(input_dir).resolve()),
+        }))
+        del assembled
+        os.replace(tmp, directory)
+    except OSError:
+        # Another run finished the same assembly first
+        if not (directory / "meta.json").exists():
+            raise
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return load_assembly(directory)
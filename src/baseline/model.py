@@ -1,28 +1,50 @@
-from utils import get_input_images, get_input_metadata
-import nibabel as nib
-import sys
+from utils import get_input_images, get_input_metadata, open_uncompressed, save_prediction
+from tiling import sliding_window_inference
+import argparse
+import tempfile
+import numpy as np
 
+# Patch the model runs on; the whole-body FOV is processed tile by tile
+PATCH_SIZE = (128, 128, 128)
+HU_water = 0
 
-def main(input_dir, output_ct_path):
-    """Baseline method that fills a PET-derived body region with the HU value of water (0 HU)."""
-    input_images = get_input_images(input_dir)
-    metadata = get_input_metadata(input_dir)
-    suv = metadata["suv"]
-    nacstat_pet = nib.load(input_images["nacstat_pet"])
-    arr = nacstat_pet.get_fdata() / suv
-    body_mask = arr > 0.1
-    HU_water = 0
-    ct_pred_arr = body_mask * HU_water
-    ct_pred = nib.Nifti1Image(ct_pred_arr, nacstat_pet.affine, nacstat_pet.header)
-    nib.save(ct_pred, output_ct_path)
 
+def predict_patch(pet_suv_patch):
+    """Per-patch model: water inside the body."""
+    body_mask = pet_suv_patch > 0.1
+    return body_mask.astype(np.float32) * HU_water
 
-if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: python model.py <input_dir> <output_ct_path>")
-        sys.exit(1)
 
-    input_dir = sys.argv[1]
-    output_ct_path = sys.argv[2]
-    main(input_dir, output_ct_path)
+def main(input_dir, output_ct_path, dtype=np.int16, compresslevel=6, threads=None, tmp_dir=None):
+    """Baseline method that fills a PET-derived body region with the HU value of water (0 HU).
+
+    The prediction must be on the PET grid; models working on another grid (DIXON, CT) map their output with
+    `resample_to_image(prediction, nacstat_pet)`. It is stored as `dtype` (scaled int16 by default); see
+    `save_prediction` for the output options. The PET is read patch by patch from an uncompressed copy and the
+    prediction is accumulated in temporary files, both in `tmp_dir` (default: the system temporary directory).
+    """
+    suv = get_input_metadata(input_dir)["suv"]
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        # The baseline only needs the PET
+        nacstat_pet = open_uncompressed(get_input_images(input_dir)["nacstat_pet"], tmp)
+        # Air-only patches (no voxel above 0.1 SUV) are skipped and stay at the background value
+        ct_pred_arr = sliding_window_inference(
+            lambda patch: predict_patch(patch / suv), nacstat_pet.dataobj, PATCH_SIZE,
+            mask=lambda patch: np.any(patch / suv > 0.1), background=0.0, tmp_dir=tmp,
+        )
+        save_prediction(ct_pred_arr, nacstat_pet, output_ct_path, dtype, compresslevel, threads)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage="python model.py <input_dir> <output_ct_path> [options]")
+    parser.add_argument("input_dir")
+    parser.add_argument("output_ct_path", help="Predicted CT; .nii.gz is compressed, .nii is not")
+    parser.add_argument("--dtype", default="int16", choices=["int16", "float32"],
+                        help="Stored dtype; int16 is scaled with slope/intercept (default: int16)")
+    parser.add_argument("--compresslevel", type=int, default=6, choices=range(10), metavar="0-9",
+                        help="gzip level of a .nii.gz output (default: 6)")
+    parser.add_argument("--threads", type=int, help="Compression threads (default: all cores)")
+    parser.add_argument("--tmp_dir", help="Directory of the uncompressed input and the prediction accumulators")
+    args = parser.parse_args()
 
+    main(args.input_dir, args.output_ct_path, np.dtype(args.dtype), args.compresslevel, args.threads, args.tmp_dir)
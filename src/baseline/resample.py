@@ -0,0 +1,295 @@
+"""
+Resampling
+
+Maps volumes between voxel grids (shape + affine). The mapping from
+target voxels to source voxels and the interpolation indices and
+weights are computed once per (source grid, target grid, order) and
+cached as a plan, so resampling every subject and modality between
+the same grids is a gather.
+
+Grids related by an axis-aligned affine (scaling, flips, axis
+permutations, translation; the usual case between scanner grids) get
+separable per-axis plans of a few KB; oblique grids get a per-voxel
+plan. Voxels mapping outside the source are set to ``fill``.
+"""
+from collections import OrderedDict
+import threading
+
+import nibabel as nib
+import numpy as np
+
+ORDERS = ("nearest", "linear")
+
+# Memory budget of the cached plans
+PLAN_CACHE_BYTES = 2 << 30
+
+# Target voxels per step when building a per-voxel plan
+PLAN_CHUNK_VOXELS = 1 << 22
+
+# Relative tolerance for treating an affine entry as zero / two affines as equal
+AFFINE_TOLERANCE = 1e-6
+
+
+def same_grid(shape_a, affine_a, shape_b, affine_b) -> bool:
+    """
+    True if both grids have the same spatial shape and affines equal
+    up to ``AFFINE_TOLERANCE``.
+    """
+    return tuple(shape_a[:3]) == tuple(shape_b[:3]) and np.allclose(affine_a, affine_b, rtol=0,
+                                                                        atol=AFFINE_TOLERANCE * np.abs(affine_b).max())
+
+
+def _axis_plan(coords, size, order):
+    """
+    1D indices and weights of a separable plan along one axis.
+
+    Returns
+    -------
+    low, high : ndarray
+        Source indices (``high`` is None for nearest neighbour).
+    weight : ndarray or None
+        Interpolation weight of ``high``.
+    valid : ndarray of bool
+        Target positions inside the source.
+    """
+    if order == "nearest":
+        index = np.floor(coords + 0.5).astype(np.intp)
+        valid = (index >= 0) & (index < size)
+        return np.clip(index, 0, size - 1), None, None, valid
+    # Coordinates on the last voxel (up to rounding) interpolate within [size - 2, size - 1]
+    valid = (coords > -AFFINE_TOLERANCE) & (coords < size - 1 + AFFINE_TOLERANCE)
+    coords = np.clip(coords, 0, size - 1)
+    low = np.minimum(np.floor(coords).astype(np.intp), max(size - 2, 0))
+    high = np.minimum(low + 1, size - 1)
+    weight = (coords - low).astype(np.float32)
+    return low, high, weight, valid
+
+
+class SeparablePlan:
+    """
+    Plan for an axis-aligned mapping.
+
+    The source is transposed to the target axis order, then every
+    axis is interpolated independently.
+    """
+
+    def __init__(self, source_shape, target_shape, matrix, order):
+        self.order = order
+        self.target_shape = tuple(target_shape)
+        # Source axis feeding each target axis
+        self.axes = tuple(int(np.argmax(np.abs(matrix[:3, j]))) for j in range(3))
+        self.axis_plans = [
+            _axis_plan(matrix[a, j] * np.arange(target_shape[j]) + matrix[a, 3], source_shape[a], order)
+            for j, a in enumerate(self.axes)
+        ]
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for plan in self.axis_plans for a in plan if a is not None)
+
+    def apply(self, data, fill=0):
+        data = np.asanyarray(data)
+        data = data.transpose(self.axes + tuple(range(3, data.ndim)))
+        if self.order == "nearest":
+            out = data[np.ix_(*(plan[0] for plan in self.axis_plans))]
+        else:
+            out = data
+            # Axes that shrink the volume most first, so later passes touch fewer voxels
+            for axis in sorted(range(3), key=lambda a: len(self.axis_plans[a][0]) / max(data.shape[a], 1)):
+                low, high, weight, _ = self.axis_plans[axis]
+                shape = [1] * out.ndim
+                shape[axis] = -1
+                weight = weight.reshape(shape)
+                lower = out.take(low, axis=axis).astype(np.float32, copy=False)
+                upper = out.take(high, axis=axis).astype(np.float32, copy=False)
+                out = lower + (upper - lower) * weight
+        for axis, (*_, valid) in enumerate(self.axis_plans):
+            if not valid.all():
+                out[(slice(None),) * axis + (~valid,)] = fill
+        return out
+
+
+class VoxelPlan:
+    """
+    Plan for a general (oblique) mapping.
+
+    Holds the source corner indices and weights of every target voxel
+    inside the source.
+    """
+
+    def __init__(self, source_shape, target_shape, matrix, order):
+        self.order = order
+        self.target_shape = tuple(target_shape)
+        size = np.asarray(source_shape[:3])[:, None]
+        indices, weights, valids = [], [], []
+        # Built in chunks of target voxels to bound the float64 temporaries
+        num_voxels = int(np.prod(target_shape))
+        for start in range(0, num_voxels, PLAN_CHUNK_VOXELS):
+            flat = np.arange(start, min(start + PLAN_CHUNK_VOXELS, num_voxels))
+            grid = np.stack(np.unravel_index(flat, target_shape)).astype(np.float64)
+            coords = matrix[:3, :3] @ grid + matrix[:3, 3:4]
+            if order == "nearest":
+                index = np.floor(coords + 0.5)
+                valid = np.all((index >= 0) & (index < size), axis=0)
+                indices.append(index[:, valid].astype(np.int32))
+            else:
+                valid = np.all((coords > -AFFINE_TOLERANCE) & (coords < size - 1 + AFFINE_TOLERANCE), axis=0)
+                coords = np.clip(coords[:, valid], 0, size - 1)
+                low = np.minimum(np.floor(coords), np.maximum(size - 2, 0))
+                indices.append(low.astype(np.int32))
+                weights.append((coords - low).astype(np.float32))
+            valids.append(flat[valid])
+        self.index = np.concatenate(indices, axis=1)
+        self.weight = np.concatenate(weights, axis=1) if weights else None
+        self.valid = np.concatenate(valids)
+
+    @property
+    def nbytes(self):
+        return self.index.nbytes + self.valid.nbytes + (0 if self.weight is None else self.weight.nbytes)
+
+    def apply(self, data, fill=0):
+        data = np.asanyarray(data)
+        trailing = data.shape[3:]
+        dtype = data.dtype if self.order == "nearest" else np.float32
+        out = np.full((int(np.prod(self.target_shape)),) + trailing, fill, dtype=dtype)
+        i, j, k = self.index
+        if self.order == "nearest":
+            out[self.valid] = data[i, j, k]
+        else:
+            wi, wj, wk = (w.reshape((-1,) + (1,) * len(trailing)) for w in self.weight)
+            # Clamped upper corners; their weight is 0 where the clamp applies
+            i1, j1, k1 = (np.minimum(a + 1, n - 1) for a, n in zip(self.index, data.shape[:3]))
+            result = np.zeros((len(self.valid),) + trailing, dtype=np.float32)
+            for ci, fi in ((i, 1 - wi), (i1, wi)):
+                for cj, fj in ((j, 1 - wj), (j1, wj)):
+                    for ck, fk in ((k, 1 - wk), (k1, wk)):
+                        result += data[ci, cj, ck] * (fi * fj * fk)
+            out[self.valid] = result
+        return out.reshape(self.target_shape + trailing, order="C")
+
+
+class PlanCache:
+    """
+    LRU cache of resampling plans bounded by a memory budget.
+
+    The most recent plan is kept even if it alone exceeds the budget.
+    """
+
+    def __init__(self, max_bytes=PLAN_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        with self._lock:
+            if key in self._plans:
+                self._plans.move_to_end(key)
+                return self._plans[key]
+        plan = build()
+        with self._lock:
+            self._plans[key] = plan
+            while len(self._plans) > 1 and sum(p.nbytes for p in self._plans.values()) > self.max_bytes:
+                self._plans.popitem(last=False)
+        return plan
+
+    def clear(self):
+        with self._lock:
+            self._plans.clear()
+
+
+_plans = PlanCache()
+
+
+def get_plan_cache() -> PlanCache:
+    """
+    Process-wide plan cache.
+    """
+    return _plans
+
+
+def _grid_key(shape, affine):
+    return tuple(int(n) for n in shape[:3]), tuple(np.round(np.asarray(affine, dtype=np.float64), 6).ravel())
+
+
+def resampling_plan(source_shape, source_affine, target_shape, target_affine, order="linear"):
+    """
+    Cached plan mapping a volume on the source grid onto the target grid.
+
+    Parameters
+    ----------
+    source_shape, target_shape : tuple
+        Grid shapes (only the first three dimensions are used).
+    source_affine, target_affine : array_like, shape (4, 4)
+        Voxel-to-world affines.
+    order : {"nearest", "linear"}
+        Interpolation order.
+
+    Returns
+    -------
+    plan : SeparablePlan or VoxelPlan
+        Call ``plan.apply(data, fill)`` to resample.
+    """
+    if order not in ORDERS:
+        raise ValueError(f"order must be one of {ORDERS}, got {order!r}")
+    source_shape, target_shape = tuple(source_shape[:3]), tuple(target_shape[:3])
+    key = (_grid_key(source_shape, source_affine), _grid_key(target_shape, target_affine), order)
+
+    def build():
+        # Target voxel -> world -> source voxel
+        matrix = np.linalg.inv(np.asarray(source_affine, dtype=np.float64)) @ np.asarray(target_affine, dtype=np.float64)
+        linear = np.abs(matrix[:3, :3])
+        nonzero = linear > AFFINE_TOLERANCE * linear.max()
+        if np.all(nonzero.sum(axis=0) == 1) and np.all(nonzero.sum(axis=1) == 1):
+            return SeparablePlan(source_shape, target_shape, matrix, order)
+        return VoxelPlan(source_shape, target_shape, matrix, order)
+
+    return _plans.get(key, build)
+
+
+def resample(data, source_affine, target_shape, target_affine, order="linear", fill=0):
+    """
+    Resample ``data`` from its grid onto the target grid.
+
+    Parameters
+    ----------
+    data : array_like
+        3D volume, or 3D + trailing dimensions such as frames.
+    source_affine : array_like, shape (4, 4)
+        Affine of ``data``.
+    target_shape, target_affine
+        Target grid.
+    order : {"nearest", "linear"}
+        Linear interpolation returns float32; nearest keeps the dtype
+        (use it for label maps).
+    fill : scalar
+        Value of target voxels outside the source.
+
+    Returns
+    -------
+    out : ndarray
+        ``data`` itself if the grids already match.
+    """
+    data = np.asanyarray(data)
+    if same_grid(data.shape, source_affine, target_shape, target_affine):
+        return data
+    return resampling_plan(data.shape, source_affine, target_shape, target_affine, order).apply(data, fill)
+
+
+def resample_to_image(img, reference, order="linear", fill=0):
+    """
+    ``img`` on the grid of ``reference`` (e.g. a DIXON-grid prediction
+    on the PET grid), as a new NIfTI image with the reference affine.
+
+    ``img`` is returned unchanged if the grids already match. See
+    ``resample`` for ``order`` and ``fill``.
+    """
+    if same_grid(img.shape, img.affine, reference.shape, reference.affine):
+        return img
+    data = np.asanyarray(img.dataobj) if order == "nearest" else img.get_fdata(dtype=np.float32)
+    out = resample(data, img.affine, reference.shape[:3], reference.affine, order, fill)
+    header = img.header.copy()
+    header.set_data_dtype(out.dtype)
+    resampled = nib.Nifti1Image(out, reference.affine, header)
+    resampled.set_qform(reference.affine, code=1)
+    resampled.set_sform(reference.affine, code=1)
+    return resampled
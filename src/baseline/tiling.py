@@ -0,0 +1,123 @@
+"""Sliding-window (tiled) inference over volumes larger than a model can process at once.
+
+The volume is covered by patches of `patch_size` overlapping by `overlap` voxels per axis. Patches entirely
+outside a mask (e.g. the PET-derived body mask: air makes up much of the FOV) are skipped and keep the
+`background` value. The next patches are gathered on a thread pool while the model runs on the current one.
+Predictions are accumulated with Gaussian or linear blending weights into float32 arrays backed by temporary
+files (or arrays given by the caller), so with an image read patch by patch (a memmap or a nibabel proxy of an
+uncompressed file) resident memory is bounded by the patch size.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from itertools import product
+import tempfile
+
+import numpy as np
+
+BLENDING = ("gaussian", "linear", "constant")
+
+# Voxels normalized at a time when dividing the accumulated predictions by the weight sums
+NORMALIZE_VOXELS = 1 << 22
+
+
+def patch_starts(size, patch, overlap):
+    """Start indices along one axis: stride patch - overlap, with the last patch flush with the end."""
+    if patch >= size:
+        return [0]
+    stride = max(patch - overlap, 1)
+    starts = list(range(0, size - patch, stride))
+    return starts + [size - patch]
+
+
+def patch_grid(shape, patch_size, overlap):
+    """Slices of all patches covering a volume of `shape`."""
+    patch_size = tuple(min(p, n) for p, n in zip(patch_size, shape))
+    axes = [[slice(s, s + p) for s in patch_starts(n, p, o)] for n, p, o in zip(shape, patch_size, overlap)]
+    return [tuple(slices) for slices in product(*axes)]
+
+
+def blending_weights(patch_size, mode="gaussian", sigma_scale=0.125):
+    """Per-voxel weight of a patch prediction when stitching: highest at the centre, so patch borders, where a
+    network sees the least context, contribute least. Positive everywhere."""
+    if mode not in BLENDING:
+        raise ValueError(f"blending must be one of {BLENDING}, got {mode!r}")
+    profiles = []
+    for n in patch_size:
+        x = np.arange(n, dtype=np.float32)
+        if mode == "gaussian":
+            sigma = max(n * sigma_scale, 1e-3)
+            profile = np.exp(-0.5 * ((x - (n - 1) / 2) / sigma) ** 2)
+        elif mode == "linear":
+            profile = np.minimum(x + 1, n - x)
+        else:
+            profile = np.ones(n, dtype=np.float32)
+        profiles.append(profile / profile.max())
+    weights = profiles[0][:, None, None] * profiles[1][None, :, None] * profiles[2][None, None, :]
+    return np.maximum(weights, 1e-6).astype(np.float32)
+
+
+def scratch_array(shape, tmp_dir=None):
+    """Zero-filled float32 array backed by an unlinked temporary file in `tmp_dir`: pages are written back to
+    disk under memory pressure instead of counting as resident memory, and the file is freed with the array."""
+    with tempfile.TemporaryFile(dir=tmp_dir) as f:
+        # The mapping keeps its own descriptor, so the file can be closed here
+        return np.memmap(f, dtype=np.float32, mode="w+", shape=tuple(shape))
+
+
+def sliding_window_inference(predict, image, patch_size, overlap=None, mask=None, blending="gaussian",
+                             out=None, weight_sums=None, background=0.0, prefetch=2, workers=2, tmp_dir=None):
+    """Run `predict` on overlapping patches of `image` and stitch the results into one volume.
+
+    `image` is a 3D array or (x, y, z, channel) array of any array-like (e.g. a memmap or a nibabel proxy);
+    `predict` maps an image patch to a prediction of the patch's spatial shape. `mask` is an array of the
+    spatial shape, or a function of an image patch returning whether to run the model on it; patches without
+    any voxel of the mask are skipped and set to `background`. `out` is a float32 array of the spatial shape
+    and the blending weight sums are accumulated in `weight_sums`, another such array; both default to
+    `scratch_array`s in `tmp_dir` (pass `np.zeros` arrays to keep them in memory). Returns `out`.
+    """
+    shape = tuple(image.shape[:3])
+    patch_size = tuple(min(p, n) for p, n in zip(patch_size, shape))
+    overlap = tuple(p // 4 for p in patch_size) if overlap is None else tuple(overlap)
+    weights = blending_weights(patch_size, blending)
+
+    if out is None:
+        out = scratch_array(shape, tmp_dir)
+    else:
+        out[...] = 0
+    if weight_sums is None:
+        weight_sums = scratch_array(shape, tmp_dir)
+    else:
+        weight_sums[...] = 0
+
+    select = mask if callable(mask) else None
+    patches = [p for p in patch_grid(shape, patch_size, overlap) if mask is None or select is not None or np.any(mask[p])]
+
+    def read(slices):
+        return slices, np.asarray(image[slices], dtype=np.float32)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="patch") as executor:
+        pending = deque()
+        queued = iter(patches)
+        for slices in queued:
+            pending.append(executor.submit(read, slices))
+            if len(pending) > prefetch:
+                break
+        while pending:
+            slices, patch = pending.popleft().result()
+            nxt = next(queued, None)
+            if nxt is not None:
+                pending.append(executor.submit(read, nxt))
+            if select is not None and not select(patch):
+                continue
+            prediction = np.asarray(predict(patch), dtype=np.float32)
+            out[slices] += prediction * weights
+            weight_sums[slices] += weights
+
+    # Normalized in slabs along the first axis, so the temporaries stay small
+    step = max(NORMALIZE_VOXELS // max(shape[1] * shape[2], 1), 1)
+    for start in range(0, shape[0], step):
+        slab, slab_weights = out[start:start + step], weight_sums[start:start + step]
+        covered = slab_weights > 0
+        np.divide(slab, slab_weights, out=slab, where=covered)
+        slab[~covered] = background
+    return out
@@ -1,5 +1,17 @@
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import gzip
+import io
 import json
+import os
+import shutil
+
+import nibabel as nib
+import numpy as np
+
+from resample import resample, resample_to_image, resampling_plan, same_grid  # noqa: F401
 
 def find_file(input_dir, pattern):
     """Find a single file matching the given pattern in the input directory."""
@@ -35,3 +47,160 @@ def get_input_metadata(input_dir):
     with open(metadata_file, "r") as f:
         metadata = json.load(f)
     return metadata
+
+
+def load_image(path):
+    """Load a NIfTI file fully into memory (decompression happens here)."""
+    img = nib.load(path)
+    data = np.asanyarray(img.dataobj)
+    return nib.Nifti1Image(data, img.affine, img.header)
+
+
+class PrefetchedImages(Mapping):
+    """Mapping of input name to in-memory image, decoded concurrently on a thread pool.
+
+    All images start decoding immediately (zlib releases the GIL, so gzip'd inputs
+    inflate in parallel). Looking up a name only waits for that image, so model code
+    can start on the PET while the MRI chunks are still being decoded.
+    """
+
+    def __init__(self, paths, max_workers=None):
+        max_workers = max_workers or min(len(paths), os.cpu_count() or 1) or 1
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        # Submitted in the order given, so list the images needed first first
+        self._futures = {name: executor.submit(load_image, path) for name, path in paths.items()}
+        # No more work will be submitted; queued loads still run
+        executor.shutdown(wait=False)
+
+    def __getitem__(self, name):
+        return self._futures[name].result()
+
+    def __iter__(self):
+        return iter(self._futures)
+
+    def __len__(self):
+        return len(self._futures)
+
+    def future(self, name):
+        """The future of an image, e.g. to check `.done()` or add a callback."""
+        return self._futures[name]
+
+    def close(self):
+        """Cancel the loads that have not started yet."""
+        for future in self._futures.values():
+            future.cancel()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_input_images(input_dir, names=None, max_workers=None):
+    """Start decoding the input images (all, or only `names`, in that order) concurrently.
+
+    Returns a PrefetchedImages mapping; indexing it blocks until that image is decoded.
+    """
+    paths = get_input_images(input_dir)
+    if names is not None:
+        paths = {name: paths[name] for name in names}
+    return PrefetchedImages(paths, max_workers=max_workers)
+
+
+# Uncompressed bytes per gzip member of a parallel write
+GZIP_CHUNK_BYTES = 4 << 20
+
+
+def open_uncompressed(path, tmp_dir):
+    """Open a NIfTI file so that slicing its `dataobj` reads only the requested voxels (through a memory map).
+
+    A `.nii.gz` file cannot be sliced without inflating everything before the slice, so it is first inflated,
+    streamed in GZIP_CHUNK_BYTES blocks, to an uncompressed copy in `tmp_dir`.
+    """
+    path = Path(path)
+    if path.name.endswith(".gz"):
+        target = Path(tmp_dir) / path.name[:-len(".gz")]
+        with gzip.open(path, "rb") as src, open(target, "wb") as dst:
+            shutil.copyfileobj(src, dst, GZIP_CHUNK_BYTES)
+        path = target
+    return nib.load(path, mmap=True)
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    """Write-only file object that gzips what is written to `fileobj` in independent members.
+
+    Writes are cut into GZIP_CHUNK_BYTES blocks compressed on `threads` threads (zlib releases the GIL); at most
+    two blocks per thread are in flight, so memory stays bounded whatever the total size. A multi-member file is
+    a valid gzip stream for gzip/zlib readers (nibabel, ITK, `gunzip`). It cannot seek: nibabel pads up to the
+    data offset with zeros instead.
+    """
+
+    def __init__(self, fileobj, compresslevel=6, threads=None):
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.threads = threads or os.cpu_count() or 1
+        self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="gzip")
+        self._members = deque()
+        self._buffer = bytearray()
+        self._pos = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = memoryview(data).cast("B")
+        self._buffer += data
+        self._pos += len(data)
+        while len(self._buffer) >= GZIP_CHUNK_BYTES:
+            self._submit(bytes(self._buffer[:GZIP_CHUNK_BYTES]))
+            del self._buffer[:GZIP_CHUNK_BYTES]
+        return len(data)
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET and offset == self._pos:
+            return self._pos
+        raise OSError("ParallelGzipWriter cannot seek")
+
+    def _submit(self, block):
+        if len(self._members) >= 2 * self.threads:
+            self.fileobj.write(self._members.popleft().result())
+        self._members.append(self._executor.submit(gzip.compress, block, self.compresslevel, mtime=0))
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._buffer or not self._pos:
+                self._submit(bytes(self._buffer))
+                self._buffer.clear()
+            while self._members:
+                self.fileobj.write(self._members.popleft().result())
+        finally:
+            self._executor.shutdown(cancel_futures=True)
+            super().close()
+
+
+def save_prediction(data, reference, output_path, dtype=np.int16, compresslevel=6, threads=None):
+    """Save a predicted volume with the geometry of `reference`.
+
+    With an integer `dtype` the values are stored with a slope/intercept chosen by nibabel to cover their
+    range, so readers get floats back transparently (int16: about 16x less raw data than float64). A `.nii`
+    path is written uncompressed; a `.nii.gz` path is gzip'd at `compresslevel` on `threads` threads (see
+    `ParallelGzipWriter`). Either way nibabel writes the header and then the data one scaled slab at a time,
+    so `data` (e.g. a memmap) is never copied whole.
+    """
+    img = nib.Nifti1Image(data, reference.affine, reference.header)
+    if dtype is not None:
+        img.set_data_dtype(dtype)
+
+    output_path = str(output_path)
+    if not output_path.endswith(".gz"):
+        nib.save(img, output_path)
+        return
+
+    with open(output_path, "wb") as f, ParallelGzipWriter(f, compresslevel, threads) as gz:
+        img.to_file_map({"image": nib.FileHolder(fileobj=gz)})
@@ -0,0 +1,242 @@
+"""Long-lived worker: load the model once, then process a stream of jobs.
+
+A job is a JSON object {"id": ..., "input_dir": ..., "output": ...}; the model is called as
+``predict(input_dir, output_ct_path)``, the interface of ``model.main``. Jobs come from:
+
+- stdin: one job per line, one result per line on stdout
+- a spool directory: job files dropped in ``<spool>/queue`` are claimed by an atomic rename to
+  ``<spool>/running`` and their results written to ``<spool>/done``; several workers may share a spool.
+  A claimed file carries its worker's random token and is touched while the job runs; claims no longer
+  touched (their worker died) are put back in the queue
+- a Unix socket: each connection sends jobs as JSON lines and receives one result line per job
+
+Outputs are written to a temporary file next to the target and renamed into place, so a reader never
+sees a partial file. Every result reports the job's latency.
+"""
+from pathlib import Path
+import argparse
+import importlib
+import io
+import json
+import os
+import signal
+import socketserver
+import sys
+import threading
+import time
+import traceback
+import uuid
+
+
+def load_model(spec="model"):
+    """Predict function of a model module: the result of its ``load_model()`` if it defines one (load
+    weights there, once), else its ``main``. ``spec`` is ``module`` or ``module:function``."""
+    module_name, _, attr = spec.partition(":")
+    module = importlib.import_module(module_name)
+    if attr:
+        return getattr(module, attr)
+    if hasattr(module, "load_model"):
+        return module.load_model()
+    return module.main
+
+
+def temporary_path(path: Path) -> Path:
+    """Hidden sibling of ``path`` with the same suffixes, so writers pick the same format."""
+    suffixes = "".join(path.suffixes)
+    stem = path.name[:len(path.name) - len(suffixes)] if suffixes else path.name
+    return path.with_name(f".{stem}.tmp-{os.getpid()}{suffixes}")
+
+
+def run_job(predict, job: dict) -> dict:
+    """Run one job, writing its output atomically. Never raises; failures are reported in the result."""
+    start = time.perf_counter()
+    result = {"id": job.get("id"), "output": job.get("output")}
+    tmp = None
+    try:
+        output = Path(job["output"])
+        output.parent.mkdir(parents=True, exist_ok=True)
+        tmp = temporary_path(output)
+        predict(job["input_dir"], str(tmp))
+        os.replace(tmp, output)
+        result["status"] = "ok"
+    except Exception as e:
+        result["status"] = "failed"
+        result["error"] = f"{type(e).__name__}: {e}"
+        traceback.print_exc(file=sys.stderr)
+        if tmp is not None:
+            tmp.unlink(missing_ok=True)
+    result["latency"] = round(time.perf_counter() - start, 4)
+    return result
+
+
+def parse_job(line: str, default_id) -> dict:
+    job = json.loads(line)
+    job.setdefault("id", default_id)
+    return job
+
+
+# Sources
+
+
+def serve_stdin(predict, stdin=sys.stdin, stdout=sys.stdout):
+    """Jobs as JSON lines on stdin, results as JSON lines on stdout, until end of input."""
+    for number, line in enumerate(stdin):
+        if not line.strip():
+            continue
+        try:
+            result = run_job(predict, parse_job(line, number))
+        except (json.JSONDecodeError, AttributeError) as e:
+            result = {"id": number, "status": "failed", "error": f"Invalid job: {e}", "latency": 0.0}
+        print(json.dumps(result), file=stdout, flush=True)
+
+
+def _age(path: Path):
+    try:
+        return path.stat().st_mtime_ns, path.name
+    except FileNotFoundError:  # claimed by another worker meanwhile
+        return 0, path.name
+
+
+def _job_name(claimed: Path) -> str:
+    """Queue file name of a claimed ``<stem>@<token>.json`` job."""
+    return claimed.stem.rsplit("@", 1)[0] + claimed.suffix
+
+
+def _is_stale(claimed: Path, stale_after: float) -> bool:
+    """A claim is stale if it was not touched for ``stale_after`` seconds. Its owner is not checked: host names
+    and PIDs do not identify a worker across containers or PID namespaces; only the heartbeat tells it runs."""
+    try:
+        # Renames and touches update ctime, so this is the time of the last claim or heartbeat
+        return time.time() - claimed.stat().st_ctime > stale_after
+    except FileNotFoundError:
+        return False
+
+
+def requeue_stale(spool: str | Path, stale_after: float = 600.0) -> list[Path]:
+    """Move the stale claims of ``<spool>/running`` back to ``<spool>/queue``; returns the requeued jobs."""
+    spool = Path(spool)
+    requeued = []
+    for claimed in sorted((spool / "running").glob("*.json")):
+        if not _is_stale(claimed, stale_after):
+            continue
+        try:
+            requeued.append(claimed.rename(spool / "queue" / _job_name(claimed)))
+        except FileNotFoundError:  # requeued or finished meanwhile
+            continue
+        print(f"Requeued stale job {claimed.name}", file=sys.stderr, flush=True)
+    return requeued
+
+
+class _Heartbeat:
+    """Touch ``path`` every ``interval`` seconds on a background thread while in the ``with`` block."""
+
+    def __init__(self, path: Path, interval: float):
+        self.path, self.interval = path, interval
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stop.wait(self.interval):
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
+
+
+def serve_spool(predict, spool: str | Path, poll: float = 1.0, exit_when_empty: bool = False,
+                stale_after: float = 600.0):
+    """Claim and run ``<spool>/queue/*.json`` jobs oldest first; results go to ``<spool>/done``.
+
+    Claims are named ``<job>@<token>.json`` with a random token of this worker, and touched every
+    ``stale_after / 4`` seconds while their job runs. Stale claims in ``<spool>/running`` (see
+    ``requeue_stale``) are requeued on startup and whenever the queue is empty."""
+    spool = Path(spool)
+    token = uuid.uuid4().hex
+    queue, running, done = (spool / name for name in ("queue", "running", "done"))
+    for directory in (queue, running, done):
+        directory.mkdir(parents=True, exist_ok=True)
+    requeue_stale(spool, stale_after)
+    while True:
+        claimed = None
+        for path in sorted(queue.glob("*.json"), key=_age):
+            try:
+                # Atomic: exactly one worker wins the rename
+                claimed = path.rename(running / f"{path.stem}@{token}{path.suffix}")
+                break
+            except FileNotFoundError:
+                continue
+        if claimed is None:
+            if requeue_stale(spool, stale_after):
+                continue
+            if exit_when_empty:
+                return
+            time.sleep(poll)
+            continue
+        name = _job_name(claimed)
+        with _Heartbeat(claimed, stale_after / 4):
+            try:
+                result = run_job(predict, parse_job(claimed.read_text(), Path(name).stem))
+            except (json.JSONDecodeError, AttributeError) as e:
+                result = {"id": Path(name).stem, "status": "failed", "error": f"Invalid job: {e}", "latency": 0.0}
+        tmp = done / f".{name}.tmp"
+        tmp.write_text(json.dumps(result))
+        os.replace(tmp, done / name)
+        claimed.unlink()
+        print(json.dumps(result), file=sys.stderr, flush=True)
+
+
+def serve_socket(predict, socket_path: str | Path):
+    """Serve jobs on a Unix socket, one connection at a time (the model need not be thread-safe)."""
+    socket_path = Path(socket_path)
+    socket_path.unlink(missing_ok=True)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            serve_stdin(predict, io.TextIOWrapper(self.rfile), io.TextIOWrapper(self.wfile, write_through=True))
+
+    with socketserver.UnixStreamServer(str(socket_path), Handler) as server:
+        try:
+            server.serve_forever()
+        finally:
+            socket_path.unlink(missing_ok=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Persistent model worker")
+    parser.add_argument("source", choices=["stdin", "spool", "socket"])
+    parser.add_argument("path", nargs="?", help="Spool directory or socket path")
+    parser.add_argument("--model", default="model",
+                        help="Model module (uses its load_model() or main) or module:function (default: model)")
+    parser.add_argument("--poll", type=float, default=1.0, help="Spool polling interval in seconds")
+    parser.add_argument("--exit_when_empty", action="store_true", help="Stop once the spool queue is empty")
+    parser.add_argument("--stale_after", type=float, default=600.0,
+                        help="Requeue spool jobs whose claim was not touched for this many seconds")
+    args = parser.parse_args()
+    if args.source != "stdin" and not args.path:
+        parser.error(f"{args.source} needs a path")
+
+    # docker stop: leave through the normal exit path (cleans up the socket)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    start = time.perf_counter()
+    predict = load_model(args.model)
+    print(f"Model {args.model} loaded in {time.perf_counter() - start:.2f} s", file=sys.stderr, flush=True)
+
+    if args.source == "stdin":
+        serve_stdin(predict)
+    elif args.source == "spool":
+        serve_spool(predict, args.path, args.poll, args.exit_when_empty, args.stale_after)
+    else:
+        serve_socket(predict, args.path)
+
+
+if __name__ == "__main__":
+    main()
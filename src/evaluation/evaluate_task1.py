@@ -1,20 +1,45 @@
-from metrics import mae_ct
-import sys
+from metrics import HU_BIN_NAMES, ct_error_stats, mae_ct
+import argparse
 from pathlib import Path
-from nibabel import nib
+import nibabel as nib
 
-def evaluate_study(prediction_ct_path, label_dir_path):
+import repo_path  # noqa: F401
+from evaluation_tool.metrics.volume_store import load_nifti
+from src.baseline.resample import resample_to_image
+
+def load_study(prediction_ct_path, label_dir_path, resample=False):
     prediction_ct = nib.load(prediction_ct_path)
     label_dir = Path(label_dir_path)
-    label_ct = nib.load(next(label_dir.glob("*ct.nii.gz")))
-    label_seg = nib.load(next(label_dir.glob("*seg-body_dseg.nii.gz")))
+    label_ct = load_nifti(next(label_dir.glob("*ct.nii.gz")))
+    label_seg = load_nifti(next(label_dir.glob("*seg-body_dseg.nii.gz")))
     
+    if resample:
+        # Opt-in: a prediction on another grid is mapped onto the label grid (trilinear; outside the field of view: air)
+        prediction_ct = resample_to_image(prediction_ct, label_ct, fill=-1024)
     assert prediction_ct.shape == label_ct.shape, "Prediction and label CT scans must have the same shape."
 
-    mae = mae_ct(prediction_ct, label_ct, label_seg)
+    return prediction_ct, label_ct, label_seg
+
+def evaluate_study(prediction_ct_path, label_dir_path, resample=False):
+    mae = mae_ct(*load_study(prediction_ct_path, label_dir_path, resample))
 
     return mae
 
+def evaluate_study_stats(prediction_ct_path, label_dir_path, resample=False):
+    """All body-region error statistics of ``ct_error_stats`` (one pass over the volumes)."""
+    return ct_error_stats(*load_study(prediction_ct_path, label_dir_path, resample))
+
 if __name__ == "__main__":
-    mae = evaluate_study(sys.argv[1], sys.argv[2])
-    print(f"Mean Absolute Error (MAE) within body region: {mae}")
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Task 1 evaluation: CT error statistics within the body region")
+    parser.add_argument("prediction", help="Predicted CT")
+    parser.add_argument("label_dir", help="Directory of the reference CT and body segmentation")
+    parser.add_argument("--resample", action="store_true",
+                        help="Resample a prediction on another grid onto the reference grid instead of rejecting it")
+    args = parser.parse_args()
+
+    stats = evaluate_study_stats(args.prediction, args.label_dir, args.resample)
+    print(f"Mean Absolute Error (MAE) within body region: {stats['mae']}")
+    print(f"Bias within body region: {stats['bias']}")
+    print(f"Root Mean Square Error (RMSE) within body region: {stats['rmse']}")
+    for name in HU_BIN_NAMES:
+        print(f"MAE {name} ({stats[f'count_{name}']} voxels): {stats[f'mae_{name}']}")
@@ -1,23 +1,48 @@
-from metrics import mae_suv_pet
-import sys
+from metrics import mae_suv_pet, pet_error_stats
+import argparse
 from pathlib import Path
-from nibabel import nib
+import nibabel as nib
 
-def evaluate_study(prediction_pet_path, label_dir_path):
+import repo_path  # noqa: F401
+from evaluation_tool.metrics.volume_store import load_nifti
+from src.baseline.resample import resample_to_image
+
+def load_study(prediction_pet_path, label_dir_path, resample=False):
     prediction_pet = nib.load(prediction_pet_path)
     label_dir = Path(label_dir_path)
-    label_pet = nib.load(next(label_dir.glob("*pet.nii.gz")))
-    label_seg = nib.load(next(label_dir.glob("*seg-body_dseg.nii.gz")))
+    label_pet = load_nifti(next(label_dir.glob("*pet.nii.gz")))
+    label_seg = load_nifti(next(label_dir.glob("*seg-body_dseg.nii.gz")))
 
     with open(label_dir / "suv.txt", "r") as f:
         suv = float(f.read().strip())
 
+    if resample:
+        # Opt-in: a prediction on another grid is mapped onto the label grid (trilinear)
+        prediction_pet = resample_to_image(prediction_pet, label_pet)
     assert prediction_pet.shape == label_pet.shape, "Prediction and label PET scans must have the same shape."
 
-    mae = mae_suv_pet(prediction_pet, label_pet, label_seg, suv)
+    return prediction_pet, label_pet, label_seg, suv
+
+
+def evaluate_study(prediction_pet_path, label_dir_path, resample=False):
+    mae = mae_suv_pet(*load_study(prediction_pet_path, label_dir_path, resample))
     return mae
 
 
+def evaluate_study_stats(prediction_pet_path, label_dir_path, resample=False):
+    """All body-region error statistics of ``pet_error_stats`` (one pass over the volumes)."""
+    return pet_error_stats(*load_study(prediction_pet_path, label_dir_path, resample))
+
+
 if __name__ == "__main__":
-    mae = evaluate_study(sys.argv[1], sys.argv[2])
-    print(f"Mean Absolute Error (MAE) within body region: {mae}")
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Task 2 evaluation: PET error statistics within the body region")
+    parser.add_argument("prediction", help="Predicted attenuation-corrected PET")
+    parser.add_argument("label_dir", help="Directory of the reference PET and body segmentation")
+    parser.add_argument("--resample", action="store_true",
+                        help="Resample a prediction on another grid onto the reference grid instead of rejecting it")
+    args = parser.parse_args()
+
+    stats = evaluate_study_stats(args.prediction, args.label_dir, args.resample)
+    print(f"Mean Absolute Error (MAE) within body region: {stats['mae']}")
+    print(f"Bias within body region: {stats['bias']}")
+    print(f"Root Mean Square Error (RMSE) within body region: {stats['rmse']}")
@@ -1,35 +1,186 @@
 import sys
+import numpy as np
 import nibabel as nib
 from pathlib import Path
 
-def mae_ct(prediction_ct, label_ct, label_seg):
-    """Calculate Mean Absolute Error (MAE) between predicted CT and label CT within the body region."""
+import repo_path  # noqa: F401
+from evaluation_tool.metrics.result_store import cached_metric
+from evaluation_tool.metrics.seg_index import stored_segmentation_index
 
-    pred_data = prediction_ct.get_fdata()
-    label_data = label_ct.get_fdata()
-    seg_data = label_seg.get_fdata()
+# Images are loaded as float32 and label maps in their native dtype;
+# means are accumulated in float64.
+IMAGE_DTYPE = np.float32
+ACCUM_DTYPE = np.float64
 
-    # Create a mask for the body region (assuming body is labeled with 1 in seg)
-    body_mask = seg_data > 0
+# Reference HU ranges of the per-tissue CT MAE
+HU_BIN_EDGES = (-200.0, -30.0, 200.0)
+HU_BIN_NAMES = ("air_lung", "fat", "soft_tissue", "bone")
 
-    # Calculate MAE only within the body region
-    mae = abs(pred_data[body_mask] - label_data[body_mask]).mean()
-    
-    return mae
+# Joint histogram of reference value x error: (low, high, bins) of each axis; values outside go to the edge bins
+CT_HISTOGRAM = ((-1024.0, 2048.0, 64), (-1000.0, 1000.0, 100))
+SUV_HISTOGRAM = ((0.0, 20.0, 80), (-5.0, 5.0, 100))
 
+# Voxels per z-slab of the single-pass reducer
+CHUNK_VOXELS = 1 << 22
 
-def mae_suv_pet(prediction_pet, label_pet, label_seg, suv_constant):
-    """Calculate Mean Absolute Error (MAE) between predicted CT and label CT within the body region."""
 
-    pred_data = prediction_pet.get_fdata() / suv_constant
-    label_data = label_pet.get_fdata() / suv_constant
-    seg_data = label_seg.get_fdata()
+class ErrorStats:
+    """Error statistics of a prediction against a reference, accumulated in one pass over chunks of voxels.
+
+    Bias, MAE and RMSE are accumulated in float64. ``bin_edges`` split the MAE by reference value into ``bin_names``
+    ranges, and ``histogram`` ((low, high, bins) of the reference and of the error) adds their joint histogram.
+    ``scale`` (e.g. 1 / SUV constant) converts raw values to reported units; it is applied to the accumulated results
+    and folded into the bin edges, never to the voxels.
+    """
+
+    def __init__(self, bin_edges=(), bin_names=(), histogram=None, scale=1.0):
+        assert len(bin_names) == (len(bin_edges) + 1 if bin_names else 0)
+        assert scale > 0
+        self.bin_names = tuple(bin_names)
+        self.histogram = histogram
+        self.scale = float(scale)
+        self._raw_edges = np.asarray(bin_edges, dtype=ACCUM_DTYPE) / self.scale
+
+        self.count = 0
+        self.error_sum = 0.0
+        self.abs_sum = 0.0
+        self.square_sum = 0.0
+        self.bin_counts = np.zeros(len(self.bin_names), dtype=np.int64)
+        self.bin_abs_sums = np.zeros(len(self.bin_names), dtype=ACCUM_DTYPE)
+        self.hist_counts = None if histogram is None else np.zeros(
+            (histogram[0][2], histogram[1][2]), dtype=np.int64)
+
+    def update(self, pred, ref):
+        """Add the voxels of two matching 1D float64 arrays."""
+        error = pred - ref
+        abs_error = np.abs(error)
+
+        self.count += error.size
+        self.error_sum += float(error.sum())
+        self.abs_sum += float(abs_error.sum())
+        self.square_sum += float(np.dot(error, error))
+
+        if self.bin_names:
+            bins = np.searchsorted(self._raw_edges, ref, side="right")
+            self.bin_counts += np.bincount(bins, minlength=len(self.bin_names))
+            self.bin_abs_sums += np.bincount(bins, weights=abs_error, minlength=len(self.bin_names))
+
+        if self.hist_counts is not None:
+            (ref_axis, error_axis) = self.histogram
+            ref_bins = self._hist_bins(ref, *ref_axis)
+            error_bins = self._hist_bins(error, *error_axis)
+            self.hist_counts += np.bincount(ref_bins * error_axis[2] + error_bins,
+                                            minlength=self.hist_counts.size).reshape(self.hist_counts.shape)
+
+    def _hist_bins(self, values, low, high, bins):
+        width = (high - low) / bins / self.scale
+        index = np.floor((values - low / self.scale) / width)
+        return np.clip(index, 0, bins - 1).astype(np.intp)
+
+    def result(self) -> dict:
+        """Statistics in reported units; per-range MAEs of empty ranges are NaN."""
+        if self.count == 0:
+            raise ValueError("No voxels inside the mask.")
+
+        result = {
+            "count": self.count,
+            "mae": self.abs_sum / self.count * self.scale,
+            "bias": self.error_sum / self.count * self.scale,
+            "rmse": float(np.sqrt(self.square_sum / self.count)) * self.scale,
+        }
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            bin_maes = self.bin_abs_sums / self.bin_counts * self.scale
+
+        for name, count, mae in zip(self.bin_names, self.bin_counts, bin_maes):
+            result[f"mae_{name}"] = float(mae)
+            result[f"count_{name}"] = int(count)
+
+        if self.hist_counts is not None:
+            result["histogram"] = self.hist_counts
+            result["histogram_edges"] = tuple(np.linspace(low, high, bins + 1) for low, high, bins in self.histogram)
+
+        return result
+
 
-    # Create a mask for the body region (assuming body is labeled with 1 in seg)
-    body_mask = seg_data > 0
+def _slab_source(image):
+    """Array-like to read z-slabs from; a file-backed image is reopened with the file kept open, so a gzip'd
+    volume is decompressed once, front to back, whatever the number of slabs."""
+    filename = image.get_filename()
+    if nib.is_proxy(image.dataobj) and filename:
+        return nib.load(filename, keep_file_open=True).dataobj
+    return image.dataobj
 
-    # Calculate MAE only within the body region
-    mae = abs(pred_data[body_mask] - label_data[body_mask]).mean()
-    
-    return mae 
 
+def _segmentation_index(label_seg):
+    """Segmentation index of a label image read from a file, if the volume cache or store already holds it, else None
+    (building one decodes the whole label map, which costs more than masking the slabs)."""
+    filename = label_seg.get_filename()
+    if not filename:
+        return None
+    index = stored_segmentation_index(filename)
+    if index is None:
+        return None
+    return index if index.shape == tuple(label_seg.shape[:3]) else None
+
+
+def reduce_in_body(prediction, label, label_seg, stats: ErrorStats) -> ErrorStats:
+    """Feed ``stats`` with the voxels of the body region (seg > 0) one z-slab at a time, so memory is bounded by
+    the slab size instead of three whole volumes.
+
+    With a stored segmentation index of the label file, only the body's bounding box is read and the body mask of
+    each slab comes from the index instead of the label map.
+    """
+    pred, ref, seg = (_slab_source(image) for image in (prediction, label, label_seg))
+    index = _segmentation_index(label_seg)
+
+    if index is None:
+        x, y, z_range = slice(None), slice(None), range(seg.shape[2])
+    else:
+        box = index.box()
+        if box is None:
+            return stats
+        x, y, z_box = box
+        z_range = range(z_box.start, z_box.stop)
+
+    width = len(range(*x.indices(seg.shape[0]))) * len(range(*y.indices(seg.shape[1])))
+    thickness = max(1, CHUNK_VOXELS // width)
+
+    for z0 in z_range[::thickness]:
+        z = slice(z0, min(z0 + thickness, z_range.stop))
+        if index is None:
+            body_mask = np.asarray(seg[x, y, z]) > 0
+        else:
+            body_mask = index.region_mask((x, y, z))
+        if not body_mask.any():
+            continue
+        stats.update(np.asarray(pred[x, y, z], dtype=IMAGE_DTYPE)[body_mask].astype(ACCUM_DTYPE),
+                     np.asarray(ref[x, y, z], dtype=IMAGE_DTYPE)[body_mask].astype(ACCUM_DTYPE))
+
+    return stats
+
+
+@cached_metric(version="1", name="task1.ct_error_stats")
+def ct_error_stats(prediction_ct, label_ct, label_seg):
+    """Bias, MAE, RMSE, MAE per reference HU range and the joint (reference HU, error) histogram of the predicted
+    CT within the body region, in one pass."""
+    stats = ErrorStats(HU_BIN_EDGES, HU_BIN_NAMES, CT_HISTOGRAM)
+    return reduce_in_body(prediction_ct, label_ct, label_seg, stats).result()
+
+
+@cached_metric(version="1", name="task2.pet_error_stats")
+def pet_error_stats(prediction_pet, label_pet, label_seg, suv_constant):
+    """Bias, MAE, RMSE and the joint (reference SUV, error) histogram of the predicted PET in SUV within the body
+    region, in one pass."""
+    stats = ErrorStats(histogram=SUV_HISTOGRAM, scale=1.0 / suv_constant)
+    return reduce_in_body(prediction_pet, label_pet, label_seg, stats).result()
+
+
+def mae_ct(prediction_ct, label_ct, label_seg):
+    """Calculate Mean Absolute Error (MAE) between predicted CT and label CT within the body region."""
+    return ct_error_stats(prediction_ct, label_ct, label_seg)["mae"]
+
+
+def mae_suv_pet(prediction_pet, label_pet, label_seg, suv_constant):
+    """Calculate Mean Absolute Error (MAE) between predicted PET and label PET in SUV within the body region."""
+    return pet_error_stats(prediction_pet, label_pet, label_seg, suv_constant)["mae"]
@@ -0,0 +1,142 @@
+"""Stream items through a chain of stages connected by bounded queues, each stage with its own worker threads.
+
+A stage blocks when the queue to the next stage is full (backpressure), so at most
+``queue_size`` finished items wait between two stages while every stage keeps working
+on a different item. An item that fails in one stage skips the remaining stages.
+"""
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable
+
+_DONE = object()
+
+
+@dataclass
+class Stage:
+    name: str
+    fn: Callable[[Any], Any]  # value -> value handed to the next stage
+    workers: int = 1
+    queue_size: int = 2  # items allowed to wait for this stage
+
+
+@dataclass
+class PipelineItem:
+    key: Any
+    value: Any
+    error: str | None = None
+    failed_stage: str | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+@dataclass
+class StageStats:
+    name: str
+    workers: int
+    items: int = 0
+    failures: int = 0
+    busy: float = 0.0  # summed over workers
+    first_start: float | None = None
+    last_end: float | None = None
+
+    @property
+    def span(self) -> float:
+        if self.first_start is None:
+            return 0.0
+        return self.last_end - self.first_start
+
+    @property
+    def throughput(self) -> float:
+        """Items per second while the stage was active."""
+        return self.items / self.span if self.span > 0 else 0.0
+
+    @property
+    def utilization(self) -> float:
+        """Fraction of the active span the workers spent working."""
+        return self.busy / (self.span * self.workers) if self.span > 0 else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "stage": self.name, "workers": self.workers, "items": self.items,
+            "failures": self.failures, "busy_s": self.busy, "span_s": self.span,
+            "items_per_s": self.throughput, "utilization": self.utilization,
+        }
+
+
+def run_pipeline(items: list[tuple[Any, Any]], stages: list[Stage], log=print) -> tuple[list[PipelineItem], list[StageStats], float]:
+    """Push ``(key, value)`` pairs through ``stages``.
+
+    Returns the final items in input order, per-stage statistics and the total wall time.
+    """
+    queues = [queue.Queue(maxsize=max(1, s.queue_size)) for s in stages] + [queue.Queue()]
+    stats = [StageStats(s.name, max(1, s.workers)) for s in stages]
+    lock = threading.Lock()
+    remaining = [st.workers for st in stats]
+
+    def work(k: int) -> None:
+        stage, st = stages[k], stats[k]
+        while True:
+            item = queues[k].get()
+            if item is _DONE:
+                break
+            if item.ok:
+                start = time.monotonic()
+                try:
+                    item.value = stage.fn(item.value)
+                except Exception as e:
+                    item.error = f"{type(e).__name__}: {e}"
+                    item.failed_stage = stage.name
+                end = time.monotonic()
+                with lock:
+                    st.items += 1
+                    st.failures += not item.ok
+                    st.busy += end - start
+                    st.first_start = start if st.first_start is None else min(st.first_start, start)
+                    st.last_end = end if st.last_end is None else max(st.last_end, end)
+                log(f"[{stage.name}] {item.key} "
+                    + ("done" if item.ok else f"failed: {item.error}") + f" ({end - start:.1f}s)")
+            queues[k + 1].put(item)
+
+        # The last worker of a stage closes the next one
+        with lock:
+            remaining[k] -= 1
+            last = remaining[k] == 0
+        if last:
+            for _ in range(stats[k + 1].workers if k + 1 < len(stages) else 1):
+                queues[k + 1].put(_DONE)
+
+    def feed() -> None:
+        for key, value in items:
+            queues[0].put(PipelineItem(key, value))
+        for _ in range(stats[0].workers):
+            queues[0].put(_DONE)
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=feed, daemon=True)]
+    threads += [
+        threading.Thread(target=work, args=(k,), name=f"{s.name}-{i}", daemon=True)
+        for k, s in enumerate(stages) for i in range(stats[k].workers)
+    ]
+    for t in threads:
+        t.start()
+
+    finished = {}
+    while (item := queues[-1].get()) is not _DONE:
+        finished[item.key] = item
+    for t in threads:
+        t.join()
+
+    return [finished[key] for key, _ in items], stats, time.monotonic() - start
+
+
+def format_stats(stats: list[StageStats], wall: float) -> str:
+    lines = [f"{'stage':<16}{'workers':>8}{'items':>7}{'failed':>8}{'busy s':>10}{'items/s':>10}{'util':>7}"]
+    for st in stats:
+        lines.append(f"{st.name:<16}{st.workers:>8}{st.items:>7}{st.failures:>8}"
+                     f"{st.busy:>10.1f}{st.throughput:>10.3f}{st.utilization:>7.0%}")
+    lines.append(f"end-to-end wall time: {wall:.1f}s")
+    return "\n".join(lines)
@@ -0,0 +1,8 @@
+"""Put the repository root on sys.path so the evaluation scripts can use evaluation_tool's I/O helpers."""
+import sys
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+
+if str(REPO_ROOT) not in sys.path:
+    sys.path.append(str(REPO_ROOT))
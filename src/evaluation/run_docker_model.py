@@ -1,31 +1,98 @@
-import subprocess
 from pathlib import Path
 
+from scheduler import ContainerJob, JobLedger, JobResult, Mount, format_usage, run_job, run_jobs, summarize_usage
 
-def run_submission(docker_image: str, input_dir: str | Path, output_path: str | Path) -> None:
+PREDICTION_NAME = "predicted_ct.nii.gz"
+
+
+def submission_job(docker_image: str, input_dir: str | Path, output_path: str | Path, job_id: str | None = None) -> ContainerJob:
     input_dir = Path(input_dir).absolute()
     output_path = Path(output_path).absolute()
     output_path.parent.mkdir(parents=True, exist_ok=True)
 
-    cmd = [
-        "docker", "run", "--rm",
-        "-v", f"{input_dir}:/input:ro",
-        "-v", f"{output_path.parent}:/output",
-        docker_image,
-        "/input",
-        f"/output/{output_path.name}"
+    return ContainerJob(
+        job_id=job_id or input_dir.name,
+        image=docker_image,
+        args=["/input", f"/output/{output_path.name}"],
+        mounts=[Mount(input_dir, "/input", read_only=True), Mount(output_path.parent, "/output")],
+        outputs=[output_path],
+    )
+
+
+def run_submission(docker_image: str, input_dir: str | Path, output_path: str | Path,
+                   cpus: float | None = None, memory: str | None = None, timeout: float | None = None,
+                   cpu_time: float | None = None, report_dir: str | Path | None = None) -> JobResult:
+    """Run the submission on one subject; its logs and resource report go to ``report_dir``
+    (default: ``reports/`` next to the output). Raises if the container fails or exceeds a limit."""
+    job = submission_job(docker_image, input_dir, output_path)
+    report_dir = report_dir or Path(output_path).absolute().parent / "reports"
+
+    result = run_job(job, cpus, memory, timeout, cpu_time=cpu_time, report_dir=report_dir)
+    if not result.ok:
+        raise RuntimeError(f"{job.job_id} {result.status}: {result.error}")
+    return result
+
+
+def run_cohort_submissions(docker_image: str, input_root: str | Path, output_root: str | Path,
+                           subjects: list[str] | None = None, workers: int = 1,
+                           cpus: float | None = None, memory: str | None = None,
+                           timeout: float | None = None, retries: int = 0,
+                           ledger_path: str | Path | None = None, cpu_time: float | None = None,
+                           report_dir: str | Path | None = None) -> list[JobResult]:
+    """Run the submission on every subject directory of ``input_root``, ``workers`` containers at once.
+
+    Predictions go to ``output_root/<subject>/predicted_ct.nii.gz``; finished jobs are recorded in
+    ``ledger_path`` (default ``output_root/jobs.jsonl``) and skipped when the run is repeated. Per-subject
+    logs and resource reports and the cohort summary go to ``report_dir`` (default ``output_root/reports``).
+    """
+    input_root = Path(input_root)
+    output_root = Path(output_root)
+    if subjects is None:
+        subjects = sorted(p.name for p in input_root.iterdir() if p.is_dir())
+
+    jobs = [
+        submission_job(docker_image, input_root / s, output_root / s / PREDICTION_NAME, job_id=s)
+        for s in subjects
     ]
+    ledger = JobLedger(ledger_path or output_root / "jobs.jsonl")
 
-    subprocess.run(cmd, check=True)
+    return run_jobs(jobs, workers=workers, cpus=cpus, memory=memory,
+                    timeout=timeout, retries=retries, ledger=ledger, cpu_time=cpu_time,
+                    report_dir=report_dir or output_root / "reports")
 
 
 if __name__ == "__main__":
     import argparse
+    import sys
 
     parser = argparse.ArgumentParser()
     parser.add_argument("docker_image")
-    parser.add_argument("input_dir")
-    parser.add_argument("output_path")
+    parser.add_argument("input_dir", help="Subject directory, or with --batch a directory of subject directories")
+    parser.add_argument("output_path", help="Output file, or with --batch the output directory")
+    parser.add_argument("--batch", action="store_true", help="Run every subject of input_dir")
+    parser.add_argument("--subjects", nargs="+", help="Subjects to run in batch mode (default: all)")
+    parser.add_argument("--workers", type=int, default=1, help="Containers running at once in batch mode")
+    parser.add_argument("--cpus", type=float, help="CPU limit per container (docker --cpus)")
+    parser.add_argument("--memory", help="Memory limit per container (docker --memory, e.g. 16g)")
+    parser.add_argument("--timeout", type=float, help="Seconds before a container is killed")
+    parser.add_argument("--cpu_time", type=float, help="CPU seconds before a container is killed")
+    parser.add_argument("--retries", type=int, default=0, help="Retries of a failed job (batch mode)")
+    parser.add_argument("--ledger", help="Job ledger file (default: <output_path>/jobs.jsonl)")
+    parser.add_argument("--report_dir", help="Directory of container logs and resource reports "
+                                             "(default: reports/ in the output directory)")
 
     args = parser.parse_args()
-    run_submission(args.docker_image, args.input_dir, args.output_path)
+
+    if args.batch:
+        results = run_cohort_submissions(
+            args.docker_image, args.input_dir, args.output_path, subjects=args.subjects,
+            workers=args.workers, cpus=args.cpus, memory=args.memory,
+            timeout=args.timeout, retries=args.retries, ledger_path=args.ledger,
+            cpu_time=args.cpu_time, report_dir=args.report_dir,
+        )
+        sys.exit(0 if all(r.ok for r in results) else 1)
+
+    result = run_submission(args.docker_image, args.input_dir, args.output_path, cpus=args.cpus,
+                            memory=args.memory, timeout=args.timeout, cpu_time=args.cpu_time,
+                            report_dir=args.report_dir)
+    print(format_usage(summarize_usage([result])))
@@ -1,24 +1,37 @@
-import subprocess
 from pathlib import Path
 
-def run_reconstruction(docker_image: str, input_ct: str | Path, recon_dir: str | Path, output_pet: str | Path) -> None:
+from scheduler import ContainerJob, JobResult, Mount, format_usage, run_job, summarize_usage
+
+def reconstruction_job(docker_image: str, input_ct: str | Path, recon_dir: str | Path, output_pet: str | Path, job_id: str | None = None) -> ContainerJob:
     input_ct = Path(input_ct).absolute()
     recon_dir = Path(recon_dir).absolute()
     output_pet = Path(output_pet).absolute()
     output_pet.parent.mkdir(parents=True, exist_ok=True)
 
-    cmd = [
-        "docker", "run", "--rm",
-        "-v", f"{input_ct}:/input_ct:ro",
-        "-v", f"{recon_dir}:/recon:ro",
-        "-v", f"{output_pet.parent}:/output",
-        docker_image,
-        "/input_ct",
-        "/recon",
-        f"/output/{output_pet.name}"
-    ]
+    return ContainerJob(
+        job_id=job_id or recon_dir.name,
+        image=docker_image,
+        args=["/input_ct", "/recon", f"/output/{output_pet.name}"],
+        mounts=[
+            Mount(input_ct, "/input_ct", read_only=True),
+            Mount(recon_dir, "/recon", read_only=True),
+            Mount(output_pet.parent, "/output"),
+        ],
+        outputs=[output_pet],
+    )
+
+def run_reconstruction(docker_image: str, input_ct: str | Path, recon_dir: str | Path, output_pet: str | Path,
+                       cpus: float | None = None, memory: str | None = None, timeout: float | None = None,
+                       cpu_time: float | None = None, report_dir: str | Path | None = None) -> JobResult:
+    """Reconstruct one subject; its logs and resource report go to ``report_dir`` (default: ``reports/``
+    next to the output PET). Raises if the container fails or exceeds a limit."""
+    job = reconstruction_job(docker_image, input_ct, recon_dir, output_pet)
+    report_dir = report_dir or Path(output_pet).absolute().parent / "reports"
 
-    subprocess.run(cmd, check=True)
+    result = run_job(job, cpus, memory, timeout, cpu_time=cpu_time, report_dir=report_dir)
+    if not result.ok:
+        raise RuntimeError(f"{job.job_id} {result.status}: {result.error}")
+    return result
 
 
 if __name__ == "__main__":
@@ -29,6 +42,15 @@ if __name__ == "__main__":
     parser.add_argument("input_ct")
     parser.add_argument("recon_dir")
     parser.add_argument("output_pet")
+    parser.add_argument("--cpus", type=float, help="CPU limit of the container (docker --cpus)")
+    parser.add_argument("--memory", help="Memory limit of the container (docker --memory, e.g. 16g)")
+    parser.add_argument("--timeout", type=float, help="Seconds before the container is killed")
+    parser.add_argument("--cpu_time", type=float, help="CPU seconds before the container is killed")
+    parser.add_argument("--report_dir", help="Directory of the container logs and resource report "
+                                             "(default: reports/ next to output_pet)")
 
     args = parser.parse_args()
-    run_reconstruction(args.docker_image, args.input_ct, args.recon_dir, args.output_pet)
+    result = run_reconstruction(args.docker_image, args.input_ct, args.recon_dir, args.output_pet,
+                                cpus=args.cpus, memory=args.memory, timeout=args.timeout,
+                                cpu_time=args.cpu_time, report_dir=args.report_dir)
+    print(format_usage(summarize_usage([result])))
@@ -0,0 +1,135 @@
+"""Pipelined Task 2: inference, reconstruction and scoring of a cohort in one run.
+
+Subjects flow through bounded queues between the three stages, so reconstruction of one
+subject overlaps inference of the next and scoring of the previous one; end-to-end time
+approaches that of the slowest stage instead of the sum of all three.
+"""
+import csv
+import json
+from pathlib import Path
+
+from evaluate_task2 import evaluate_study
+from pipeline import Stage, format_stats, run_pipeline
+from run_docker_model import PREDICTION_NAME, submission_job
+from run_docker_reconstruction import reconstruction_job
+from scheduler import JobLedger, JobResult, format_usage, load_report, run_job, summarize_usage, write_json
+
+RECONSTRUCTION_NAME = "reconstructed_pet.nii.gz"
+
+
+def run_task2_pipeline(model_image: str, recon_image: str, input_root: str | Path, recon_root: str | Path,
+                       label_root: str | Path, output_root: str | Path, subjects: list[str] | None = None,
+                       inference_workers: int = 1, reconstruction_workers: int = 1, scoring_workers: int = 1,
+                       queue_size: int = 2, cpus: float | None = None, memory: str | None = None,
+                       recon_cpus: float | None = None, recon_memory: str | None = None,
+                       timeout: float | None = None, retries: int = 0, cpu_time: float | None = None,
+                       recon_cpu_time: float | None = None, log=print):
+    """Run Task 2 for every subject of ``input_root``.
+
+    ``recon_root/<subject>`` and ``label_root/<subject>`` hold the reconstruction data and the
+    reference PET of each subject. The predicted CT and reconstructed PET are written to
+    ``output_root/<subject>/``; container jobs already recorded as done in
+    ``output_root/jobs.jsonl`` are not run again. Container logs and resource reports go to
+    ``output_root/reports/<stage>/<subject>.*``, with a per-stage summary in ``reports/summary.json``.
+
+    Returns the pipeline items (value: MAE, or error) and the per-stage statistics.
+    """
+    input_root, recon_root = Path(input_root), Path(recon_root)
+    label_root, output_root = Path(label_root), Path(output_root)
+    if subjects is None:
+        subjects = sorted(p.name for p in input_root.iterdir() if p.is_dir())
+
+    ledger = JobLedger(output_root / "jobs.jsonl")
+    ledger_state = ledger.load()
+    report_dir = output_root / "reports"
+    container_results = {"inference": [], "reconstruction": []}
+
+    def run_container(job, cpus, memory, cpu_time):
+        stage = job.job_id.split("/")[0]
+        if ledger_state.get(job.job_id, {}).get("status") == "done" and job.outputs_exist():
+            # Summarized with the report of the run that completed it
+            previous = load_report(report_dir / f"{job.job_id}.json")
+            container_results[stage].append(previous or JobResult(job.job_id, "skipped"))
+            return
+        result = run_job(job, cpus, memory, timeout, retries, ledger, cpu_time=cpu_time, report_dir=report_dir)
+        container_results[stage].append(result)
+        if not result.ok:
+            raise RuntimeError(f"{job.job_id} {result.status}: {result.error}")
+
+    def infer(subject):
+        job = submission_job(model_image, input_root / subject, output_root / subject / PREDICTION_NAME,
+                             job_id=f"inference/{subject}")
+        run_container(job, cpus, memory, cpu_time)
+        return subject
+
+    def reconstruct(subject):
+        job = reconstruction_job(recon_image, output_root / subject / PREDICTION_NAME, recon_root / subject,
+                                 output_root / subject / RECONSTRUCTION_NAME, job_id=f"reconstruction/{subject}")
+        run_container(job, recon_cpus, recon_memory, recon_cpu_time)
+        return subject
+
+    def score(subject):
+        return float(evaluate_study(output_root / subject / RECONSTRUCTION_NAME, label_root / subject))
+
+    stages = [
+        Stage("inference", infer, inference_workers, queue_size),
+        Stage("reconstruction", reconstruct, reconstruction_workers, queue_size),
+        Stage("scoring", score, scoring_workers, queue_size),
+    ]
+
+    items, stats, wall = run_pipeline([(s, s) for s in subjects], stages, log=log)
+    log(format_stats(stats, wall))
+
+    containers = {stage: summarize_usage(results) for stage, results in container_results.items()}
+    write_json(report_dir / "summary.json", containers)
+    for stage, summary in containers.items():
+        log(f"{stage} containers:\n{format_usage(summary)}")
+
+    with open(output_root / "task2_results.csv", "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["subject", "mae", "error"])
+        for item in items:
+            writer.writerow([item.key, item.value if item.ok else "", item.error or ""])
+
+    with open(output_root / "task2_pipeline_stats.json", "w") as f:
+        json.dump({"wall_s": wall, "stages": [st.as_dict() for st in stats], "containers": containers}, f, indent=2)
+
+    return items, stats
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_image")
+    parser.add_argument("recon_image")
+    parser.add_argument("input_root", help="Directory of subject input directories")
+    parser.add_argument("recon_root", help="Directory of per-subject reconstruction directories")
+    parser.add_argument("label_root", help="Directory of per-subject reference directories")
+    parser.add_argument("output_root")
+    parser.add_argument("--subjects", nargs="+", help="Subjects to run (default: all)")
+    parser.add_argument("--inference_workers", type=int, default=1)
+    parser.add_argument("--reconstruction_workers", type=int, default=1)
+    parser.add_argument("--scoring_workers", type=int, default=1)
+    parser.add_argument("--queue_size", type=int, default=2, help="Subjects allowed to wait between two stages")
+    parser.add_argument("--cpus", type=float, help="CPU limit per model container")
+    parser.add_argument("--memory", help="Memory limit per model container (e.g. 16g)")
+    parser.add_argument("--recon_cpus", type=float, help="CPU limit per reconstruction container")
+    parser.add_argument("--recon_memory", help="Memory limit per reconstruction container")
+    parser.add_argument("--timeout", type=float, help="Seconds before a container is killed")
+    parser.add_argument("--cpu_time", type=float, help="CPU seconds before a model container is killed")
+    parser.add_argument("--recon_cpu_time", type=float, help="CPU seconds before a reconstruction container is killed")
+    parser.add_argument("--retries", type=int, default=0, help="Retries of a failed container")
+
+    args = parser.parse_args()
+
+    items, _ = run_task2_pipeline(
+        args.model_image, args.recon_image, args.input_root, args.recon_root, args.label_root,
+        args.output_root, subjects=args.subjects, inference_workers=args.inference_workers,
+        reconstruction_workers=args.reconstruction_workers, scoring_workers=args.scoring_workers,
+        queue_size=args.queue_size, cpus=args.cpus, memory=args.memory, recon_cpus=args.recon_cpus,
+        recon_memory=args.recon_memory, timeout=args.timeout, retries=args.retries,
+        cpu_time=args.cpu_time, recon_cpu_time=args.recon_cpu_time,
+    )
+    sys.exit(0 if all(item.ok for item in items) else 1)
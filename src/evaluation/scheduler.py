@@ -0,0 +1,454 @@
+"""Run many docker containers at once with CPU/memory limits, timeouts, retries and a resumable ledger.
+
+Containers are started through the ``docker`` executable found on PATH, so a
+fake ``docker`` script placed first on PATH can stand in for it in tests.
+
+While a container runs, its wall time, CPU time, peak memory and I/O bytes are sampled
+from its cgroup (cgroup v2). Without one (cgroup v1, a remote daemon, a fake ``docker``)
+only the wall time is known: the ``docker`` client's own processes say nothing about the
+container. Containers exceeding a CPU-time limit are killed; the memory limit is passed to
+docker, and a container its kernel OOM-kills is reported as killed. With a report
+directory, every job's stdout/stderr and a JSON report of its usage are written there,
+plus a cohort summary with latency percentiles.
+"""
+import json
+import os
+import re
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from dataclasses import asdict, dataclass, field, fields
+from pathlib import Path
+
+DOCKER = "docker"
+
+# Lines of container stderr kept in the result of a failed attempt
+STDERR_TAIL_LINES = 5
+
+# Seconds between resource samples of a running container (the first samples come sooner)
+SAMPLE_INTERVAL_S = 0.5
+
+# Samples during which the cgroup of a started container is looked up before its usage is deemed unavailable
+CGROUP_LOOKUP_ATTEMPTS = 10
+
+CGROUP_ROOT = Path("/sys/fs/cgroup")
+# cgroup v2 directory of a container under the systemd and the cgroupfs drivers
+CGROUP_DIRS = ("system.slice/docker-{id}.scope", "docker/{id}")
+
+MEMORY_UNITS = {"b": 1, "k": 1 << 10, "m": 1 << 20, "g": 1 << 30}
+
+# Percentiles of the cohort summary
+SUMMARY_PERCENTILES = (50, 90, 95, 99)
+
+
+@dataclass
+class Mount:
+    host: Path
+    target: str
+    read_only: bool = False
+
+    def volume_arg(self) -> str:
+        return f"{self.host}:{self.target}" + (":ro" if self.read_only else "")
+
+
+@dataclass
+class ContainerJob:
+    """One ``docker run`` of ``image`` with ``args``; succeeds if it exits 0 and writes all ``outputs``."""
+    job_id: str
+    image: str
+    args: list[str]
+    mounts: list[Mount] = field(default_factory=list)
+    outputs: list[Path] = field(default_factory=list)
+
+    def docker_cmd(self, name: str | None = None, cpus: float | None = None, memory: str | None = None) -> list[str]:
+        cmd = [DOCKER, "run", "--rm"]
+        if name is not None:
+            cmd += ["--name", name]
+        if cpus is not None:
+            cmd += ["--cpus", str(cpus)]
+        if memory is not None:
+            cmd += ["--memory", str(memory)]
+        for mount in self.mounts:
+            cmd += ["-v", mount.volume_arg()]
+        return cmd + [self.image, *self.args]
+
+    def outputs_exist(self) -> bool:
+        return all(Path(p).exists() for p in self.outputs)
+
+
+@dataclass
+class ResourceUsage:
+    """Resources used by one container run; None where unavailable (no cgroup found)."""
+    wall_s: float = 0.0
+    cpu_s: float | None = None
+    peak_memory_bytes: int | None = None
+    read_bytes: int | None = None
+    write_bytes: int | None = None
+    oom_kills: int | None = None
+    source: str | None = None  # "cgroup", or None if only the wall time is known
+
+
+@dataclass
+class JobResult:
+    job_id: str
+    status: str  # "done", "failed", "timeout", "killed" (CPU time limit or OOM) or "skipped" (already done)
+    attempts: int = 0
+    returncode: int | None = None
+    duration: float = 0.0
+    error: str | None = None
+    usage: ResourceUsage | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.status in ("done", "skipped")
+
+
+class JobLedger:
+    """Append-only JSON-lines record of finished attempts; the last record of a job is its state."""
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def load(self) -> dict[str, dict]:
+        state = {}
+        if not self.path.exists():
+            return state
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # line torn by an interrupted run
+                state[record["job_id"]] = record
+        return state
+
+    def completed(self, jobs: list[ContainerJob]) -> set[str]:
+        """Ids of ``jobs`` recorded as done whose outputs are still present."""
+        state = self.load()
+        return {
+            job.job_id for job in jobs
+            if state.get(job.job_id, {}).get("status") == "done" and job.outputs_exist()
+        }
+
+    def record(self, result: JobResult) -> None:
+        line = json.dumps({**asdict(result), "time": time.time()}) + "\n"
+        with self._lock, open(self.path, "a") as f:
+            f.write(line)
+            f.flush()
+
+
+def run_jobs(
+    jobs: list[ContainerJob],
+    workers: int = 1,
+    cpus: float | None = None,
+    memory: str | None = None,
+    timeout: float | None = None,
+    retries: int = 0,
+    ledger: JobLedger | None = None,
+    log=print,
+    cpu_time: float | None = None,
+    report_dir: str | Path | None = None,
+) -> list[JobResult]:
+    """Run ``jobs`` with up to ``workers`` containers at once; results are in input order.
+
+    Each container is limited to ``cpus`` and ``memory`` (docker syntax, e.g. "8g", enforced by docker) and
+    is killed after ``timeout`` seconds or ``cpu_time`` seconds of CPU time (measured only with a cgroup). Failed or timed out jobs are
+    retried ``retries`` times. Jobs that the ``ledger`` records as done (with their outputs present)
+    are skipped, so an interrupted run resumes. With ``report_dir``, the per-job reports and logs
+    and ``summary.json`` (see ``summarize_usage``) are written there; skipped jobs enter the summary
+    with the report of the run that completed them, so the summary always covers the whole batch.
+    """
+    done = ledger.completed(jobs) if ledger is not None else set()
+
+    def run(job: ContainerJob) -> JobResult:
+        if job.job_id in done:
+            return JobResult(job.job_id, "skipped")
+        result = run_job(job, cpus, memory, timeout, retries, ledger, cpu_time=cpu_time, report_dir=report_dir)
+        log(f"[{result.status}] {job.job_id} ({result.duration:.1f}s, {result.attempts} attempt(s))"
+            + (f": {result.error}" if result.error else ""))
+        return result
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        results = list(pool.map(run, jobs))
+
+    failed = [r.job_id for r in results if not r.ok]
+    log(f"{len(results) - len(failed)}/{len(results)} jobs succeeded"
+        + (f"; failed: {', '.join(failed)}" if failed else ""))
+
+    if report_dir is not None:
+        summary = summarize_usage([
+            (load_report(Path(report_dir) / f"{r.job_id}.json") or r) if r.status == "skipped" else r
+            for r in results
+        ])
+        write_json(Path(report_dir) / "summary.json", summary)
+        log(format_usage(summary))
+    return results
+
+
+def run_job(job: ContainerJob, cpus: float | None = None, memory: str | None = None,
+            timeout: float | None = None, retries: int = 0, ledger: JobLedger | None = None,
+            cpu_time: float | None = None, report_dir: str | Path | None = None) -> JobResult:
+    """Run one job in the calling thread, retrying it up to ``retries`` times.
+
+    With ``report_dir``, the container's stdout/stderr go to ``<report_dir>/<job_id>.stdout.log`` and
+    ``.stderr.log`` and the result of the last attempt, with its resource usage and limits, to
+    ``<report_dir>/<job_id>.json``.
+    """
+    for attempt in range(1, retries + 2):
+        # Without a report directory, the logs are only kept for the error message
+        logs = nullcontext(report_dir) if report_dir is not None else tempfile.TemporaryDirectory(prefix="eval-")
+        with logs as log_dir:
+            log_stem = Path(log_dir) / job.job_id
+            result = _run_once(job, cpus, memory, timeout, cpu_time, log_stem)
+        result.attempts = attempt
+        if ledger is not None:
+            ledger.record(result)
+        if report_dir is not None:
+            write_json(log_stem.with_name(log_stem.name + ".json"), {
+                **asdict(result),
+                "limits": {"cpus": cpus, "memory_bytes": parse_memory(memory), "wall_s": timeout, "cpu_s": cpu_time},
+                "stdout": str(log_stem.with_name(log_stem.name + ".stdout.log")),
+                "stderr": str(log_stem.with_name(log_stem.name + ".stderr.log")),
+            })
+        if result.ok:
+            break
+    return result
+
+
+def _run_once(job: ContainerJob, cpus, memory, timeout, cpu_time, log_stem: Path) -> JobResult:
+    # A stale output from an earlier attempt must not count as success
+    for output in job.outputs:
+        Path(output).unlink(missing_ok=True)
+
+    name = _container_name(job.job_id)
+    stdout_path = log_stem.with_name(log_stem.name + ".stdout.log")
+    stderr_path = log_stem.with_name(log_stem.name + ".stderr.log")
+    stdout_path.parent.mkdir(parents=True, exist_ok=True)
+
+    start = time.monotonic()
+    with open(stdout_path, "wb") as stdout, open(stderr_path, "wb") as stderr:
+        # Own session, so a runtime running the job itself can be killed with its children
+        proc = subprocess.Popen(job.docker_cmd(name, cpus, memory), stdout=stdout, stderr=stderr,
+                                start_new_session=True)
+    monitor = ContainerMonitor(name)
+
+    status, error, interval = None, None, SAMPLE_INTERVAL_S / 8
+    while True:
+        pid, wait_status = os.waitpid(proc.pid, os.WNOHANG)
+        if pid:
+            break
+        usage = monitor.sample()
+        elapsed = time.monotonic() - start
+        if timeout is not None and elapsed > timeout:
+            status, error = "timeout", f"timed out after {timeout}s"
+        elif cpu_time is not None and (usage.cpu_s or 0) > cpu_time:
+            status, error = "killed", f"CPU time limit of {cpu_time}s exceeded"
+        if status is not None:
+            _kill(proc, name)
+            _, wait_status = os.waitpid(proc.pid, 0)
+            break
+        time.sleep(min(interval, max(timeout - elapsed, 0.01)) if timeout is not None else interval)
+        interval = min(interval * 2, SAMPLE_INTERVAL_S)
+    # Reaped here: let Popen know, so it never waits for the pid again
+    proc.returncode = os.waitstatus_to_exitcode(wait_status)
+
+    duration = time.monotonic() - start
+    usage = monitor.finish(duration)
+
+    if status is not None:
+        return JobResult(job.job_id, status, returncode=proc.returncode, duration=duration, error=error,
+                         usage=usage)
+    if proc.returncode != 0 and usage.oom_kills:
+        error = f"out of memory (limit {memory})" if memory is not None else "out of memory"
+        return JobResult(job.job_id, "killed", returncode=proc.returncode, duration=duration, error=error,
+                         usage=usage)
+    if proc.returncode != 0:
+        error = _tail(stderr_path.read_text(errors="replace")) or f"exit code {proc.returncode}"
+        if proc.returncode == 137:
+            error += " (killed, e.g. out of memory)"
+        return JobResult(job.job_id, "failed", returncode=proc.returncode, duration=duration, error=error,
+                         usage=usage)
+    if not job.outputs_exist():
+        return JobResult(job.job_id, "failed", returncode=0, duration=duration,
+                         error="container exited without writing its output", usage=usage)
+    return JobResult(job.job_id, "done", returncode=0, duration=duration, usage=usage)
+
+
+def _kill(proc: subprocess.Popen, name: str) -> None:
+    # Killing the docker client does not stop the container itself
+    subprocess.run([DOCKER, "rm", "-f", name], capture_output=True)
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+# =============================================================================
+# Resource accounting
+# =============================================================================
+
+class ContainerMonitor:
+    """Resource usage of a running container, from its cgroup.
+
+    The container is looked up through ``docker inspect`` until it exists, then its cgroup v2 directory during
+    the next samples. Its counters are read as they are (CPU time, ``memory.peak`` or the largest
+    ``memory.current`` seen, ``io.stat``, OOM kills from ``memory.events``). Values are as of the last sample: a
+    container's cgroup disappears when it exits. Without a cgroup (cgroup v1, a remote daemon, a runtime that is
+    not docker) the usage is unavailable and only the wall time is reported.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.container_id: str | None = None
+        self.cgroup: Path | None = None
+        self._lookups = 0
+        self._usage = ResourceUsage()
+
+    def sample(self) -> ResourceUsage:
+        if self.container_id is None:
+            self.container_id = _container_id(self.name)
+        if self.container_id is not None and self.cgroup is None and self._lookups < CGROUP_LOOKUP_ATTEMPTS:
+            # A created container gets its cgroup when it starts
+            self._lookups += 1
+            self.cgroup = _find_cgroup(self.container_id)
+        if self.cgroup is not None:
+            try:
+                _merge_usage(self._usage, _cgroup_usage(self.cgroup))
+                self._usage.source = "cgroup"
+            except OSError:
+                pass  # container exited between the lookup and the read
+        return self._usage
+
+    def finish(self, wall_s: float) -> ResourceUsage:
+        self._usage.wall_s = wall_s
+        return self._usage
+
+
+def _merge_usage(total: ResourceUsage, sample: ResourceUsage) -> None:
+    """Keep the largest value seen of every counter (all of them only grow, or are peaks)."""
+    for name in ("cpu_s", "peak_memory_bytes", "read_bytes", "write_bytes", "oom_kills"):
+        value = getattr(sample, name)
+        if value is not None:
+            current = getattr(total, name)
+            setattr(total, name, value if current is None else max(current, value))
+
+
+def _container_id(name: str) -> str | None:
+    proc = subprocess.run([DOCKER, "inspect", "--format", "{{.Id}}", name], capture_output=True, text=True)
+    container_id = proc.stdout.strip()
+    if proc.returncode != 0 or not re.fullmatch(r"[0-9a-f]{12,64}", container_id):
+        return None
+    return container_id
+
+
+def _find_cgroup(container_id: str) -> Path | None:
+    for pattern in CGROUP_DIRS:
+        path = CGROUP_ROOT / pattern.format(id=container_id)
+        if (path / "cpu.stat").exists():
+            return path
+    return None
+
+
+def _cgroup_usage(path: Path) -> ResourceUsage:
+    cpu = dict(line.split() for line in (path / "cpu.stat").read_text().splitlines())
+    # memory.peak needs Linux 5.19; otherwise the peak is the largest sampled value
+    peak = path / "memory.peak"
+    memory = int((peak if peak.exists() else path / "memory.current").read_text())
+    read_bytes = write_bytes = 0
+    io_stat = path / "io.stat"
+    if io_stat.exists():
+        for line in io_stat.read_text().splitlines():
+            fields = dict(f.split("=") for f in line.split()[1:])
+            read_bytes += int(fields.get("rbytes", 0))
+            write_bytes += int(fields.get("wbytes", 0))
+    events = path / "memory.events"
+    oom_kills = None
+    if events.exists():
+        oom_kills = int(dict(line.split() for line in events.read_text().splitlines()).get("oom_kill", 0))
+    return ResourceUsage(cpu_s=int(cpu["usage_usec"]) / 1e6, peak_memory_bytes=memory,
+                         read_bytes=read_bytes, write_bytes=write_bytes, oom_kills=oom_kills)
+
+
+def parse_memory(memory: str | int | None) -> int | None:
+    """Bytes of a docker memory size ("512m", "16g", or a number of bytes)."""
+    if memory is None:
+        return None
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([bkmg]?)b?\s*", str(memory).lower())
+    if match is None:
+        raise ValueError(f"Invalid memory size: {memory!r}")
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2) or "b"])
+
+
+def _percentile(values: list[float], q: float) -> float:
+    """Linearly interpolated percentile of sorted ``values``."""
+    position = (len(values) - 1) * q / 100
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+def summarize_usage(results: list[JobResult]) -> dict:
+    """Job counts per status, and the mean, percentiles and maximum of every resource over the jobs that ran."""
+    statuses = {}
+    for result in results:
+        statuses[result.status] = statuses.get(result.status, 0) + 1
+
+    usages = [r.usage for r in results if r.usage is not None]
+    summary = {"jobs": len(results), "statuses": statuses, "resources": {}}
+    for name in ("wall_s", "cpu_s", "peak_memory_bytes", "read_bytes", "write_bytes"):
+        values = sorted(getattr(u, name) for u in usages if getattr(u, name) is not None)
+        if not values:
+            continue
+        summary["resources"][name] = {
+            "mean": sum(values) / len(values),
+            **{f"p{q}": _percentile(values, q) for q in SUMMARY_PERCENTILES},
+            "max": values[-1],
+        }
+    return summary
+
+
+def format_usage(summary: dict) -> str:
+    percentiles = [f"p{q}" for q in SUMMARY_PERCENTILES]
+    lines = [f"{'resource':<20}" + "".join(f"{k:>12}" for k in ["mean", *percentiles, "max"])]
+    for name, stats in summary["resources"].items():
+        scale, unit = (1 << 20, "MiB") if name.endswith("bytes") else (1, "")
+        label = name.replace("_bytes", f" {unit}").replace("_s", " s")
+        lines.append(f"{label:<20}" + "".join(f"{stats[k] / scale:>12.1f}" for k in ["mean", *percentiles, "max"]))
+    lines.append("jobs: " + ", ".join(f"{n} {status}" for status, n in sorted(summary["statuses"].items())))
+    return "\n".join(lines)
+
+
+def load_report(path: str | Path) -> JobResult | None:
+    """Result recorded in a per-job report written by ``run_job``, or None if there is no readable report."""
+    try:
+        data = json.loads(Path(path).read_text())
+    except (OSError, ValueError):
+        return None
+    usage = data.get("usage")
+    return JobResult(**{
+        f.name: data[f.name] for f in fields(JobResult) if f.name in data and f.name != "usage"
+    }, usage=ResourceUsage(**usage) if usage else None)
+
+
+def write_json(path: str | Path, data) -> None:
+    """Write ``data`` as JSON, atomically (a reader never sees a partial report)."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}")
+    tmp.write_text(json.dumps(data, indent=2))
+    os.replace(tmp, path)
+
+
+def _container_name(job_id: str) -> str:
+    return f"eval-{re.sub(r'[^a-zA-Z0-9_.-]', '-', job_id)}-{uuid.uuid4().hex[:8]}"
+
+
+def _tail(text: str) -> str:
+    return " | ".join(text.strip().splitlines()[-STDERR_TAIL_LINES:])
@@ -0,0 +1,155 @@
+"""
+Shared fixtures: import paths of the evaluation tool and the Task 1/2
+scripts, synthetic subjects and a clean run-wide state per test.
+
+The evaluation tool imports its package as ``metrics`` (as ``eval.py``
+does); the Task 1/2 ``metrics.py`` module has the same name and is
+loaded as ``task_metrics`` instead.
+"""
+
+import importlib.util
+import json
+import os
+import sys
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for path in (
+    os.path.join(ROOT, "src", "baseline"),
+    os.path.join(ROOT, "src", "evaluation"),
+    os.path.join(ROOT, "evaluation_tool"),
+    ROOT,
+):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+import metrics  # noqa: E402
+
+
+SHAPE = (24, 20, 30)
+AFFINE = np.diag([2.0, 2.0, 3.0, 1.0])
+NUM_FRAMES = 4
+
+ORGAN_LABELS = {"liver": 5, "spleen": 1, "heart": 52, "muscle": 200, "missing": 77}
+AORTA_LABEL = 52
+BRAIN_LABELS = [3, 42, 10]
+
+
+def load_task_metrics():
+    """
+    The Task 1/2 ``src/evaluation/metrics.py`` module.
+    """
+
+    if "task_metrics" not in sys.modules:
+        spec = importlib.util.spec_from_file_location(
+            "task_metrics", os.path.join(ROOT, "src", "evaluation", "metrics.py")
+        )
+        module = importlib.util.module_from_spec(spec)
+        sys.modules["task_metrics"] = module
+        spec.loader.exec_module(module)
+
+    return sys.modules["task_metrics"]
+
+
+def save(data, path, affine=AFFINE):
+    nib.save(nib.Nifti1Image(data, affine), str(path))
+    return str(path)
+
+
+def subject_paths(root, subject):
+    """
+    Input files of a subject in the layout read by ``eval.py``.
+    """
+
+    features = os.path.join(root, subject, "features")
+    labels = os.path.join(root, subject, "labels")
+
+    return {
+        "pred_pet": os.path.join(features, f"{subject}_ses-quadra_trc-18FFDG_rec-nacstatOSEM_pet.nii.gz"),
+        "gt_pet": os.path.join(labels, f"{subject}_ses-quadra_trc-18FFDG_rec-acstatOSEM_pet.nii.gz"),
+        "ts_body": os.path.join(
+            labels, f"{subject}_ses-quadra_acq-LOWDOSE_ce-none_rec-ac_seg-body_space-individual_dseg.nii.gz"
+        ),
+        "ts_total": os.path.join(
+            labels, f"{subject}_ses-quadra_acq-LOWDOSE_ce-none_rec-ac_seg-total_space-individual_dseg.nii.gz"
+        ),
+        "synthseg": os.path.join(
+            labels, f"{subject}_ses-vida_task-rest_acq-MPRAGE_seg-synthsegparc_space-individual_dseg.nii.gz"
+        ),
+        "meta_json": os.path.join(features, "constants.json"),
+    }
+
+
+def make_subject(root, subject="sub-000", seed=0, num_frames=NUM_FRAMES):
+    """
+    Write one synthetic subject in the layout of ``subject_paths`` plus
+    4D prediction / reference PETs. Returns the paths.
+    """
+
+    rng = np.random.default_rng(seed)
+    paths = subject_paths(str(root), subject)
+
+    for key in ("pred_pet", "gt_pet"):
+        os.makedirs(os.path.dirname(paths[key]), exist_ok=True)
+
+    gt = rng.gamma(2.0, 3.0, SHAPE).astype(np.float32)
+    gt[:2] = 0
+    pred = (gt * rng.normal(1.0, 0.08, SHAPE)).astype(np.float32)
+
+    body = np.zeros(SHAPE, np.uint8)
+    body[3:21, 3:17, :] = 1
+
+    total = np.zeros(SHAPE, np.int16)
+    total[6:12, 6:12, 12:20] = 5
+    total[14:16, 6:9, 3:27] = 52
+    total[4:7, 4:7, 4:7] = 1
+    total[16:20, 12:18, 20:26] = 200
+
+    synthseg = np.zeros(SHAPE, np.int16)
+    synthseg[6:12, 8:14, 24:29] = 3
+    synthseg[12:18, 8:14, 24:29] = 42
+    synthseg[9:11, 10:12, 26:28] = 10
+
+    save(pred, paths["pred_pet"])
+    save(gt, paths["gt_pet"])
+    save(body, paths["ts_body"])
+    save(total, paths["ts_total"])
+    save(synthseg, paths["synthseg"])
+
+    with open(paths["meta_json"], "w") as f:
+        json.dump({"PatientWeight": 75, "InjectedRadioactivity": 250}, f)
+
+    gains = 1.0 + 0.1 * np.arange(num_frames, dtype=np.float32)
+    paths["pred_4d"] = save(pred[..., None] * gains, root / f"{subject}_pred_4d.nii.gz")
+    paths["gt_4d"] = save(gt[..., None] * gains, root / f"{subject}_gt_4d.nii.gz")
+
+    return paths
+
+
+@pytest.fixture(autouse=True)
+def clean_state():
+    """
+    Leave an empty volume cache, no stores and the default PET dtype
+    after every test.
+    """
+
+    yield
+
+    # The Task 1/2 scripts import the tool as evaluation_tool.metrics
+    packages = [metrics, sys.modules.get("evaluation_tool.metrics")]
+
+    for package in filter(None, packages):
+        package.get_cache().clear()
+        package.configure_store(None)
+        package.configure_result_store(None)
+        package.set_pet_dtype("float32")
+
+
+@pytest.fixture
+def subject(tmp_path):
+    return make_subject(tmp_path)
@@ -0,0 +1,368 @@
+"""
+Baseline model helpers: input loading, assembly and output, tiled
+inference, resampling plans and the worker.
+"""
+
+import gzip
+import io
+import json
+import os
+import time
+import uuid
+from pathlib import Path
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+import model
+from assemble import CHANNELS, assemble_inputs
+from benchmarks.phantom import make_phantom
+from tiling import patch_grid, scratch_array, sliding_window_inference
+from resample import SeparablePlan, VoxelPlan, get_plan_cache, resample, resampling_plan
+import utils
+from utils import ParallelGzipWriter, get_input_images, load_input_images, save_prediction
+import worker
+from worker import requeue_stale, serve_spool, serve_stdin
+
+from conftest import AFFINE, save
+
+
+INPUT_FILES = [
+    "sub-000_nacstat_pet.nii.gz",
+    "sub-000_DIXONbodyIN_T1w.nii.gz",
+    "sub-000_DIXONbodyOUT_T1w.nii.gz",
+    *(f"sub-000_DIXONbody{phase}_chunk-{i}_T1w.nii.gz" for phase in ("IN", "OUT") for i in range(1, 5)),
+    "sub-000_DIXONheadIN_T1w.nii.gz",
+    "sub-000_DIXONheadOUT_T1w.nii.gz",
+    "sub-000_acq-TOPOGRAM_rec-tr20f_Xray.nii.gz",
+]
+
+SUV = 2.0
+
+
+@pytest.fixture(autouse=True)
+def clear_plans():
+    yield
+    get_plan_cache().clear()
+
+
+@pytest.fixture
+def input_dir(tmp_path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    rng = np.random.default_rng(10)
+
+    for name in INPUT_FILES:
+        save(rng.random((12, 10, 14)).astype(np.float32), input_dir / name)
+    pet = np.zeros((12, 10, 14), np.float32)
+    pet[2:10, 2:8, 3:12] = rng.uniform(0.5, 5.0, (8, 6, 9))
+    save(pet, input_dir / INPUT_FILES[0])
+
+    with open(input_dir / "metadata.json", "w") as f:
+        json.dump({"suv": SUV}, f)
+    return input_dir
+
+
+# =========================================================
+# Input loading
+# =========================================================
+
+def test_prefetched_images_match_nibabel(input_dir):
+    paths = get_input_images(input_dir)
+
+    with load_input_images(input_dir) as images:
+        assert list(images) == list(paths)
+        for name, path in paths.items():
+            np.testing.assert_array_equal(images[name].get_fdata(), nib.load(path).get_fdata())
+            np.testing.assert_array_equal(images[name].affine, AFFINE)
+
+    subset = load_input_images(input_dir, names=["topogram", "nacstat_pet"])
+    assert list(subset) == ["topogram", "nacstat_pet"]
+    assert subset.future("nacstat_pet").result() is subset["nacstat_pet"]
+
+
+def test_model_output(input_dir, tmp_path):
+    output = tmp_path / "ct.nii.gz"
+
+    model.main(str(input_dir), str(output))
+
+    # Water (0 HU) in the body, background (0) elsewhere, on the PET grid
+    np.testing.assert_array_equal(nib.load(output).get_fdata(), np.zeros((12, 10, 14)))
+    np.testing.assert_array_equal(nib.load(output).affine, AFFINE)
+
+
+@pytest.mark.parametrize("name", ["ct.nii", "ct.nii.gz"])
+def test_int16_prediction_round_trip(tmp_path, monkeypatch, name):
+    reference = nib.Nifti1Image(np.zeros((12, 10, 14), np.float32), AFFINE)
+    data = np.random.default_rng(11).uniform(-1024, 3000, (12, 10, 14))
+    # Several gzip members
+    monkeypatch.setattr(utils, "GZIP_CHUNK_BYTES", 1000)
+
+    save_prediction(data, reference, tmp_path / name, threads=2)
+
+    img = nib.load(tmp_path / name)
+    assert img.get_data_dtype() == np.int16
+    np.testing.assert_array_equal(img.affine, AFFINE)
+    np.testing.assert_allclose(img.get_fdata(), data, atol=img.dataobj.slope)
+
+
+# =========================================================
+# Tiling
+# =========================================================
+
+@pytest.fixture
+def image():
+    image = np.random.default_rng(11).random((23, 17, 19, 2)).astype(np.float32)
+    image[:, :, :6] = 0  # air below the body
+    return image
+
+
+def pointwise(patch):
+    return 2 * patch[..., 0] + patch[..., 1]
+
+
+def test_patch_grid_covers_volume():
+    shape = (23, 17, 19)
+    covered = np.zeros(shape, int)
+    for slices in patch_grid(shape, (8, 8, 30), (2, 2, 0)):
+        covered[slices] += 1
+
+    assert covered.min() >= 1
+
+
+@pytest.mark.parametrize("blending", ["gaussian", "linear", "constant"])
+def test_tiled_pointwise_model_matches_whole_volume(image, blending):
+    out = sliding_window_inference(pointwise, image, (8, 8, 8), blending=blending)
+
+    assert isinstance(out, np.memmap)
+    np.testing.assert_allclose(out, pointwise(image), rtol=1e-6)
+
+
+def test_masks_and_accumulators_agree(image, tmp_path):
+    body = image[..., 0] > 0
+
+    by_array = sliding_window_inference(pointwise, image, (8, 8, 4), mask=body, background=-1.0,
+                                        tmp_dir=tmp_path)
+    by_function = sliding_window_inference(pointwise, image, (8, 8, 4), mask=lambda p: np.any(p[..., 0] > 0),
+                                           background=-1.0, tmp_dir=tmp_path)
+    in_memory = sliding_window_inference(pointwise, image, (8, 8, 4), mask=body, background=-1.0,
+                                         out=np.zeros(body.shape, np.float32),
+                                         weight_sums=np.zeros(body.shape, np.float32))
+
+    np.testing.assert_array_equal(by_array, by_function)
+    np.testing.assert_array_equal(by_array, in_memory)
+    np.testing.assert_allclose(by_array[..., 6:], pointwise(image)[..., 6:], rtol=1e-6)
+    # Patches z 0:4 and 3:7 overlap at z = 3; only the first is entirely in the air
+    np.testing.assert_array_equal(by_array[..., :3], -1.0)
+    np.testing.assert_allclose(by_array[..., 3:6], 0.0)
+
+
+def test_scratch_array_is_zeroed_float32(tmp_path):
+    array = scratch_array((3, 4, 5), tmp_path)
+
+    assert array.dtype == np.float32 and array.shape == (3, 4, 5)
+    assert not array.any()
+    assert os.listdir(tmp_path) == []  # unlinked
+
+
+# =========================================================
+# Resampling
+# =========================================================
+
+def reference_resample(data, matrix, target_shape, fill=0):
+    """Trilinear interpolation target voxel by target voxel."""
+    size = np.array(data.shape[:3])
+    out = np.full(tuple(target_shape) + data.shape[3:], fill, dtype=np.float64)
+    for target in np.ndindex(*target_shape):
+        coords = matrix[:3, :3] @ np.array(target, float) + matrix[:3, 3]
+        if np.any(coords < -1e-6) or np.any(coords > size - 1 + 1e-6):
+            continue
+        coords = np.clip(coords, 0, size - 1)
+        low = np.minimum(np.floor(coords).astype(int), np.maximum(size - 2, 0))
+        weight = coords - low
+        value = 0.0
+        for corner in np.ndindex(2, 2, 2):
+            index = tuple(np.minimum(low + corner, size - 1))
+            value = value + data[index] * np.prod(np.where(corner, weight, 1 - weight))
+        out[target] = value
+    return out
+
+
+SOURCE_AFFINE = np.diag([2.0, 2.0, 3.0, 1.0])
+# Flipped, permuted and rescaled, partly outside the source
+TARGET_AFFINE = np.array([
+    [0.0, 1.5, 0.0, 1.0],
+    [-1.3, 0.0, 0.0, 20.0],
+    [0.0, 0.0, 2.5, -2.0],
+    [0.0, 0.0, 0.0, 1.0],
+])
+
+
+@pytest.mark.parametrize("frames", [(), (3,)])
+def test_separable_and_voxel_plans_match_reference(frames):
+    data = np.random.default_rng(12).random((9, 8, 7) + frames).astype(np.float32)
+    target_shape = (7, 10, 9)
+    matrix = np.linalg.inv(SOURCE_AFFINE) @ TARGET_AFFINE
+
+    plan = resampling_plan(data.shape, SOURCE_AFFINE, target_shape, TARGET_AFFINE)
+    separable = resample(data, SOURCE_AFFINE, target_shape, TARGET_AFFINE, fill=-1)
+    voxel = VoxelPlan(data.shape, target_shape, matrix, "linear").apply(data, fill=-1)
+    expected = reference_resample(data.astype(np.float64), matrix, target_shape, fill=-1)
+
+    assert isinstance(plan, SeparablePlan)
+    assert separable.shape == target_shape + frames
+    np.testing.assert_allclose(separable, expected, rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(voxel, expected, rtol=1e-5, atol=1e-6)
+    assert (expected == -1).any() and (expected != -1).any()
+
+
+def test_oblique_grid_uses_voxel_plan():
+    data = np.random.default_rng(13).random((9, 8, 7)).astype(np.float32)
+    angle = np.deg2rad(20)
+    rotation = np.eye(4)
+    rotation[:2, :2] = [[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]]
+    target_affine = rotation @ np.diag([1.8, 1.8, 3.0, 1.0])
+
+    plan = resampling_plan(data.shape, SOURCE_AFFINE, (8, 8, 7), target_affine)
+    out = resample(data, SOURCE_AFFINE, (8, 8, 7), target_affine)
+    matrix = np.linalg.inv(SOURCE_AFFINE) @ target_affine
+
+    assert isinstance(plan, VoxelPlan)
+    np.testing.assert_allclose(out, reference_resample(data, matrix, (8, 8, 7)), rtol=1e-5, atol=1e-6)
+
+
+def test_nearest_keeps_labels_and_plans_are_cached():
+    labels = np.random.default_rng(14).integers(0, 5, (9, 8, 7)).astype(np.int16)
+    matrix = np.linalg.inv(SOURCE_AFFINE) @ TARGET_AFFINE
+
+    out = resample(labels, SOURCE_AFFINE, (7, 10, 9), TARGET_AFFINE, order="nearest")
+    voxel = VoxelPlan(labels.shape, (7, 10, 9), matrix, "nearest").apply(labels)
+
+    assert out.dtype == np.int16
+    np.testing.assert_array_equal(out, voxel)
+    assert set(np.unique(out)) <= set(np.unique(labels))
+    assert resampling_plan(labels.shape, SOURCE_AFFINE, (7, 10, 9), TARGET_AFFINE, "nearest") is \
+        resampling_plan(labels.shape, SOURCE_AFFINE, (7, 10, 9), TARGET_AFFINE, "nearest")
+
+
+def test_same_grid_is_identity():
+    data = np.random.default_rng(15).random((9, 8, 7, 2))
+
+    assert resample(data, SOURCE_AFFINE, (9, 8, 7), SOURCE_AFFINE + 1e-9) is data
+
+
+def test_parallel_gzip_writer(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "GZIP_CHUNK_BYTES", 1000)
+    payload = np.random.default_rng(12).integers(0, 4, 25_000, dtype=np.uint8).tobytes()
+
+    with open(tmp_path / "out.gz", "wb") as f, ParallelGzipWriter(f, threads=2) as gz:
+        for start in range(0, len(payload), 700):
+            gz.write(payload[start:start + 700])
+        assert gz.tell() == len(payload)
+        with pytest.raises(OSError):
+            gz.seek(0)
+
+    assert gzip.decompress((tmp_path / "out.gz").read_bytes()) == payload
+
+
+# =========================================================
+# Input assembly
+# =========================================================
+
+def test_assembly_stitches_chunks_and_is_cached(tmp_path):
+    make_phantom(str(tmp_path), "sub-000", shape=(24, 24, 36), seed=3)
+    input_dir = tmp_path / "sub-000" / "input"
+
+    assembled = assemble_inputs(input_dir)
+    cached = assemble_inputs(input_dir, cache_dir=tmp_path / "cache")
+    again = assemble_inputs(input_dir, cache_dir=tmp_path / "cache")
+
+    pet = nib.load(get_input_images(input_dir)["nacstat_pet"])
+    assert assembled.channels == tuple(CHANNELS)
+    assert assembled.data.shape == (len(CHANNELS),) + pet.shape
+    np.testing.assert_array_equal(assembled.affine, pet.affine)
+    np.testing.assert_allclose(assembled["nacstat_pet"], pet.get_fdata(), rtol=1e-6)
+    # Blended chunks reproduce the full-body DIXON where both are defined
+    both = assembled.mask("dixon_in") & assembled.mask("dixon_body_in")
+    assert both.any()
+    np.testing.assert_allclose(assembled["dixon_in"][both], assembled["dixon_body_in"][both], atol=1e-4)
+    assert assembled.mask("topogram").all()
+
+    assert isinstance(again.data, np.memmap)
+    assert len(list((tmp_path / "cache").iterdir())) == 1
+    np.testing.assert_array_equal(cached.data, assembled.data)
+    np.testing.assert_array_equal(again.valid, assembled.valid)
+
+
+# =========================================================
+# Worker
+# =========================================================
+
+def write_output(input_dir, output):
+    if input_dir == "in-bad":
+        raise RuntimeError("model crashed")
+    Path(output).write_text(input_dir)
+
+
+def test_stdin_jobs_report_results(tmp_path):
+    jobs = [{"id": job_id, "input_dir": f"in-{job_id}", "output": str(tmp_path / f"{job_id}.txt")}
+            for job_id in ("a", "bad")]
+    stdin = io.StringIO("\n".join([json.dumps(jobs[0]), "", "not json", json.dumps(jobs[1])]) + "\n")
+    stdout = io.StringIO()
+
+    serve_stdin(write_output, stdin, stdout)
+
+    results = [json.loads(line) for line in stdout.getvalue().splitlines()]
+    assert [(r["id"], r["status"]) for r in results] == [("a", "ok"), (2, "failed"), ("bad", "failed")]
+    assert "model crashed" in results[2]["error"]
+    assert (tmp_path / "a.txt").read_text() == "in-a"
+    # No partial output of the failed job is left behind
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["a.txt"]
+
+
+def test_spool_runs_queued_jobs(tmp_path):
+    spool = tmp_path / "spool"
+    (spool / "queue").mkdir(parents=True)
+    for job_id in ("a", "b"):
+        job = {"input_dir": f"in-{job_id}", "output": str(tmp_path / "out" / f"{job_id}.txt")}
+        (spool / "queue" / f"{job_id}.json").write_text(json.dumps(job))
+
+    serve_spool(write_output, spool, exit_when_empty=True)
+
+    assert json.loads((spool / "done" / "b.json").read_text())["id"] == "b"
+    assert (tmp_path / "out" / "b.txt").read_text() == "in-b"
+    assert list((spool / "running").iterdir()) == list((spool / "queue").iterdir()) == []
+
+
+def test_spool_requeues_untouched_claims(tmp_path):
+    spool = tmp_path / "spool"
+    for name in ("queue", "running", "done"):
+        (spool / name).mkdir(parents=True)
+
+    claims = {f"{job_id}@{uuid.uuid4().hex}.json": job_id for job_id in ("a", "b")}
+    for claim, job_id in claims.items():
+        job = {"id": job_id, "input_dir": f"in-{job_id}", "output": str(tmp_path / f"{job_id}.txt")}
+        (spool / "running" / claim).write_text(json.dumps(job))
+    live = next(claim for claim, job_id in claims.items() if job_id == "b")
+    time.sleep(0.3)
+
+    # b's worker is alive and touches its claim; a's worker died
+    with worker._Heartbeat(spool / "running" / live, 0.02):
+        time.sleep(0.05)
+        serve_spool(write_output, spool, exit_when_empty=True, stale_after=0.25)
+
+    assert json.loads((spool / "done" / "a.json").read_text())["status"] == "ok"
+    assert (tmp_path / "a.txt").read_text() == "in-a"
+    assert not (tmp_path / "b.txt").exists()
+    assert [p.name for p in (spool / "running").iterdir()] == [live]
+
+
+def test_untouched_claims_expire(tmp_path):
+    spool = tmp_path / "spool"
+    for name in ("queue", "running"):
+        (spool / name).mkdir(parents=True)
+    (spool / "running" / f"c@{uuid.uuid4().hex}.json").write_text("{}")
+
+    assert requeue_stale(spool, stale_after=600.0) == []
+    assert requeue_stale(spool, stale_after=0.0) == [spool / "queue" / "c.json"]
@@ -0,0 +1,161 @@
+"""
+Cohort and leaderboard evaluation against per-subject evaluation, and
+bootstrap intervals.
+"""
+
+import csv
+import os
+import resource
+import shutil
+import sys
+
+import numpy as np
+import pytest
+
+from metrics import bootstrap_indices, bootstrap_mean, bootstrap_means
+from metrics import bootstrap as bootstrap_module
+from cohort import evaluate_subject, run_cohort, summarize_cohort
+from leaderboard import run_leaderboard, submission_path
+import eval as eval_script
+
+from conftest import make_subject
+
+
+SUBJECTS = ["sub-000", "sub-001", "sub-002"]
+COHORT_METRICS = ["whole_body_mae", "brain_outlier", "organ_bias"]
+
+
+# =========================================================
+# Bootstrap
+# =========================================================
+
+def test_bootstrap_means_match_loop(monkeypatch):
+    rng = np.random.default_rng(7)
+    values = rng.random((11, 2))
+    indices = bootstrap_indices(11, 300, seed=8)
+
+    # Several blocks of resamples
+    monkeypatch.setattr(bootstrap_module, "BLOCK_ELEMENTS", 50)
+    means = bootstrap_means(values, indices)
+
+    np.testing.assert_allclose(means, [values[row].mean(axis=0) for row in indices])
+
+
+def test_bootstrap_mean_interval():
+    values = np.random.default_rng(9).normal(3.0, 1.0, 40)
+
+    result = bootstrap_mean(values, num_resamples=2000, seed=10)
+    again = bootstrap_mean(values, num_resamples=2000, seed=10)
+
+    assert result.estimate == pytest.approx(values.mean())
+    assert result.low < result.estimate < result.high
+    np.testing.assert_array_equal(result.samples, again.samples)
+    assert result.low == np.percentile(result.samples, 2.5)
+
+
+# =========================================================
+# Cohort and leaderboard
+# =========================================================
+
+@pytest.fixture
+def cohort_root(tmp_path):
+    root = tmp_path / "data"
+    for seed, subject in enumerate(SUBJECTS):
+        make_subject(root, subject, seed=seed)
+    return root
+
+
+def test_cohort_matches_subjects(cohort_root):
+    rows, cohort = run_cohort(str(cohort_root), SUBJECTS, COHORT_METRICS, bootstrap=200, bootstrap_seed=0)
+    single = [evaluate_subject(str(cohort_root), s, COHORT_METRICS)[0] for s in SUBJECTS]
+
+    assert cohort["num_subjects"] == 3
+    for metric in ("whole_body_mae", "organ_bias"):
+        assert cohort[metric] == pytest.approx(np.mean([r[metric] for r in single]))
+    for metric in COHORT_METRICS:
+        assert cohort[f"{metric}_ci_low"] <= cohort[metric] <= cohort[f"{metric}_ci_high"]
+    for row, expected in zip(rows, single):
+        assert row["error"] is None
+        assert row["whole_body_mae"] == expected["whole_body_mae"]
+
+
+def test_pool_matches_in_process_run(cohort_root):
+    os.remove(os.path.join(cohort_root, "sub-001", "features", "constants.json"))
+
+    rows, cohort = run_cohort(str(cohort_root), SUBJECTS, COHORT_METRICS)
+    pool_rows, pool_cohort = run_cohort(str(cohort_root), SUBJECTS, COHORT_METRICS, workers=2)
+
+    assert [r["subject"] for r in pool_rows] == SUBJECTS
+    assert pool_rows[1]["error"] is not None
+    assert cohort["num_subjects"] == pool_cohort["num_subjects"] == 2
+    for metric in COHORT_METRICS:
+        assert pool_cohort[metric] == cohort[metric]
+
+
+def test_memory_cap_only_in_pool_workers(cohort_root):
+    limit = resource.getrlimit(resource.RLIMIT_AS)
+
+    # Far below what an evaluation needs: applied in process, it would fail the subjects
+    rows, _ = run_cohort(str(cohort_root), SUBJECTS[:1], COHORT_METRICS, worker_mem_mb=64)
+    run_leaderboard(str(cohort_root), str(cohort_root), SUBJECTS[:1], ["none"], COHORT_METRICS, worker_mem_mb=64)
+
+    assert rows[0]["error"] is None
+    assert resource.getrlimit(resource.RLIMIT_AS) == limit
+
+
+def submit(cohort_root, submissions, team, subjects):
+    for subject in subjects:
+        target = submission_path(str(submissions), team, subject)
+        os.makedirs(os.path.dirname(target))
+        shutil.copy(os.path.join(cohort_root, subject, "features",
+                                 f"{subject}_ses-quadra_trc-18FFDG_rec-nacstatOSEM_pet.nii.gz"), target)
+
+
+def test_leaderboard_matches_cohort(cohort_root, tmp_path):
+    submissions = tmp_path / "submissions"
+    submit(cohort_root, submissions, "first", SUBJECTS)
+    submit(cohort_root, submissions, "second", SUBJECTS)
+
+    rows, standings = run_leaderboard(str(cohort_root), str(submissions), SUBJECTS,
+                                      ["first", "second"], COHORT_METRICS, workers=2)
+
+    # Same predictions as the cohort run, so the same scores
+    _, cohort = run_cohort(str(cohort_root), SUBJECTS, COHORT_METRICS)
+
+    assert [(r["subject"], r["team"]) for r in rows[:2]] == [("sub-000", "first"), ("sub-000", "second")]
+    for team in ("first", "second"):
+        expected = summarize_cohort([r for r in rows if r["team"] == team], COHORT_METRICS)
+        for metric in COHORT_METRICS:
+            assert standings[team][metric] == pytest.approx(cohort[metric])
+            assert standings[team][metric] == expected[metric]
+
+
+def test_leaderboard_does_not_rank_partial_teams(cohort_root, tmp_path):
+    submissions = tmp_path / "submissions"
+    submit(cohort_root, submissions, "complete", SUBJECTS)
+    submit(cohort_root, submissions, "partial", SUBJECTS[:2])
+
+    rows, standings = run_leaderboard(str(cohort_root), str(submissions), SUBJECTS,
+                                      ["complete", "partial"], COHORT_METRICS)
+    complete, partial = standings["complete"], standings["partial"]
+
+    assert len(rows) == 6
+    assert complete["complete"] and complete["missing_subjects"] == []
+    assert all(metric in complete for metric in COHORT_METRICS)
+    assert not partial["complete"]
+    assert partial["missing_subjects"] == ["sub-002"]
+    assert partial["num_subjects"] == 2
+    assert not any(metric in partial for metric in COHORT_METRICS)
+
+
+def test_subject_mode_output(cohort_root, tmp_path, monkeypatch):
+    output = tmp_path / "sub-000.csv"
+    monkeypatch.setattr(sys, "argv", ["eval.py", "--subject", "sub-000", "--root", str(cohort_root),
+                                      "-specific_metric", "whole_body_mae", "--output", str(output)])
+
+    eval_script.main()
+
+    rows = list(csv.DictReader(output.open()))
+    expected, _ = evaluate_subject(str(cohort_root), "sub-000", ["whole_body_mae"])
+    assert [row["subject"] for row in rows] == ["sub-000"]
+    assert float(rows[0]["whole_body_mae"]) == pytest.approx(expected["whole_body_mae"])
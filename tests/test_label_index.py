@@ -0,0 +1,141 @@
+"""
+Label indices and the segmentation index against direct masking.
+"""
+
+import numpy as np
+import pytest
+
+import metrics
+from metrics import LabelIndex, SegmentationIndex, SparseLabelIndex, load_label_index
+from metrics.label_stats import compute_label_stats
+
+
+@pytest.fixture
+def labels():
+    rng = np.random.default_rng(1)
+    labels = rng.choice([0, 0, 0, 1, 2, 7, 300], size=(13, 11, 9)).astype(np.int16)
+    labels[..., :2] = 0  # empty slabs below
+    return labels
+
+
+@pytest.fixture
+def values(labels):
+    rng = np.random.default_rng(2)
+    return rng.normal(5.0, 2.0, labels.shape)
+
+
+LABEL_IDS = [7, 1, 300, 4, 1]  # unordered, duplicated and absent labels
+
+
+def reference_stats(labels, label_ids, values):
+    masks = [labels == i for i in label_ids]
+    return (
+        np.array([m.sum() for m in masks]),
+        np.array([values[m].sum() for m in masks]),
+        np.array([np.square(values[m]).sum() for m in masks]),
+    )
+
+
+@pytest.mark.parametrize("order", ["C", "F"])
+def test_label_index_matches_masks(labels, values, order):
+    labels = np.asarray(labels, order=order)
+    count, total, squares = reference_stats(labels, LABEL_IDS, values)
+
+    stats = compute_label_stats(labels, LABEL_IDS, values, 2 * values)
+
+    np.testing.assert_array_equal(stats.count, count)
+    np.testing.assert_allclose(stats.sum[0], total)
+    np.testing.assert_allclose(stats.sum[1], 2 * total)
+    np.testing.assert_allclose(stats.sumsq[0], squares)
+
+
+def test_label_index_background_and_chunks(labels, values, monkeypatch):
+    # Chunk boundaries inside the volume
+    monkeypatch.setattr(metrics.label_stats, "CHUNK_VOXELS", 97)
+    count, total, _ = reference_stats(labels, [0, 2], values)
+
+    index = LabelIndex(labels, [0, 2])
+
+    np.testing.assert_array_equal(index.counts, count)
+    np.testing.assert_allclose(index.sums(values)[0], total)
+
+
+def test_sparse_label_index_matches_dense(labels, values):
+    dense = LabelIndex(labels, LABEL_IDS)
+    sparse = SparseLabelIndex(SegmentationIndex.from_labels(labels), LABEL_IDS)
+
+    np.testing.assert_array_equal(sparse.counts, dense.counts)
+    np.testing.assert_allclose(sparse.sums(values), dense.sums(values))
+    np.testing.assert_allclose(sparse.stats(values).sumsq, dense.stats(values).sumsq)
+
+
+def test_segmentation_index_queries(labels):
+    index = SegmentationIndex.from_labels(labels)
+    flat = labels.ravel(order="F")
+
+    np.testing.assert_array_equal(index.label_ids, [1, 2, 7, 300])
+    np.testing.assert_array_equal(index.region_voxels(), np.flatnonzero(flat > 0))
+    np.testing.assert_array_equal(
+        index.region_voxels([300, 1]), np.flatnonzero(np.isin(flat, [1, 300]))
+    )
+    np.testing.assert_array_equal(index.positions([2, 5, 300]), [1, -1, 3])
+    assert index.superior_slice == np.nonzero(labels.any(axis=(0, 1)))[0].max()
+
+    box = index.box([7])
+    coords = np.nonzero(labels == 7)
+    assert box == tuple(slice(c.min(), c.max() + 1) for c in coords)
+    assert index.box([5]) is None
+
+    region = (slice(2, 9), slice(0, 11), slice(3, 7))
+    np.testing.assert_array_equal(index.region_mask(region), labels[region] > 0)
+    np.testing.assert_array_equal(index.region_mask(region, [2]), labels[region] == 2)
+
+
+def test_segmentation_index_gathers_4d(labels):
+    index = SegmentationIndex.from_labels(labels)
+    dynamic = np.random.default_rng(3).random(labels.shape + (3,))
+    voxels = index.region_voxels([2])
+
+    # Voxels are in Fortran order
+    expected = dynamic.reshape((-1, 3), order="F")[labels.ravel(order="F") == 2]
+
+    np.testing.assert_array_equal(index.gather(dynamic, voxels), expected)
+
+
+def test_empty_segmentation_index():
+    index = SegmentationIndex.from_labels(np.zeros((4, 4, 4), np.uint8))
+
+    assert index.box() is None
+    assert index.region_voxels().size == 0
+    with pytest.raises(ValueError):
+        index.superior_slice
+
+
+def test_stored_index_round_trip(tmp_path, subject):
+    path = subject["ts_total"]
+    labels = metrics.volume_cache.load_labels(path)
+    built = SegmentationIndex.from_labels(labels)
+
+    assert metrics.stored_segmentation_index(path) is None
+
+    metrics.configure_store(str(tmp_path / "store"))
+    metrics.get_cache().clear()
+
+    assert metrics.stored_segmentation_index(path) is None  # never built on lookup
+
+    metrics.load_segmentation_index(path)
+    metrics.get_cache().clear()
+    stored = metrics.stored_segmentation_index(path)
+
+    assert stored is not None
+    np.testing.assert_array_equal(stored.voxels, built.voxels)
+    np.testing.assert_array_equal(stored.boxes, built.boxes)
+
+
+def test_load_label_index_kinds(subject):
+    sparse = load_label_index(subject["ts_total"], [5, 52])
+    dense = load_label_index(subject["ts_total"], [0, 5])
+
+    assert isinstance(sparse, SparseLabelIndex)
+    assert isinstance(dense, LabelIndex)
+    assert load_label_index(subject["ts_total"], [5, 52]) is sparse
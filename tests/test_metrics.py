@@ -0,0 +1,215 @@
+"""
+Metrics against direct whole-volume reference implementations, for
+static (3D) and dynamic (4D) PET, whole-volume and slab-streamed.
+"""
+
+import json
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+import metrics
+from cohort import expand_to_4d
+from metrics.common import compute_auc_of_K, iter_frames, k_value_areas
+
+from conftest import AORTA_LABEL, BRAIN_LABELS, ORGAN_LABELS
+
+
+# =========================================================
+# References (whole volumes in float64)
+# =========================================================
+
+def read(path):
+    return nib.load(path).get_fdata()
+
+
+def suv_factor(json_path, scale=1e3):
+    with open(json_path) as f:
+        meta = json.load(f)
+    return meta["PatientWeight"] / (meta["InjectedRadioactivity"] * scale)
+
+
+def reference_whole_body_mae(paths, exclusion_cm=4.0):
+    factor = suv_factor(paths["meta_json"])
+    pred, gt = read(paths["pred_pet"]) * factor, read(paths["gt_pet"]) * factor
+    body = read(paths["ts_body"]) > 0
+    liver = read(paths["ts_total"]) > 0
+
+    thickness = nib.load(paths["pred_pet"]).header.get_zooms()[2]
+    exclusion = int(round(exclusion_cm * 10.0 / thickness))
+    superior = np.max(np.where(liver)[2])
+
+    body[:, :, max(0, superior - exclusion):superior + exclusion] = False
+    return np.mean(np.abs(pred - gt)[body])
+
+
+def reference_organ_bias(pred_path, gt_path, paths, epsilon=1e-6):
+    factor = suv_factor(paths["meta_json"])
+    pred, gt = read(pred_path) * factor, read(gt_path) * factor
+    seg = read(paths["ts_total"])
+
+    mare = []
+    for label in ORGAN_LABELS.values():
+        mask = seg == label
+        if mask.any():
+            pred_mean, gt_mean = np.mean(pred[mask]), np.mean(gt[mask])
+            mare.append(abs(pred_mean - gt_mean) / (abs(gt_mean) + epsilon))
+    return np.mean(mare)
+
+
+def reference_tac_bias(pred, gt, paths, durations, epsilon=1e-6):
+    regions = [read(paths["ts_total"]) == AORTA_LABEL]
+    regions += [read(paths["synthseg"]) == label for label in BRAIN_LABELS]
+
+    mare = []
+    for mask in regions:
+        auc_pred = np.sum(pred[mask].mean(axis=0) * durations)
+        auc_gt = np.sum(gt[mask].mean(axis=0) * durations)
+        mare.append(abs(auc_pred - auc_gt) / (abs(auc_gt) + epsilon))
+    return np.mean(mare)
+
+
+def reference_k_value(pred, gt, brain, threshold, epsilon=1e-6):
+    if pred.ndim == 4:
+        pred, gt = pred[..., 0], gt[..., 0]
+    valid = brain & (np.abs(gt) > epsilon)
+    relative_error = np.abs(pred - gt) / (np.abs(gt) + epsilon)
+    return np.sum(relative_error[valid] < threshold) / np.sum(valid)
+
+
+def reference_auc_of_K(k_values, num_points=1000):
+    x_values = np.linspace(0, 1, num_points)
+    K = [np.sum(np.array(k_values) > x) / len(k_values) for x in x_values]
+    return np.trapezoid(K, x_values)
+
+
+# =========================================================
+# Evaluation tool
+# =========================================================
+
+@pytest.mark.parametrize("slab_thickness", [None, 1, 7])
+def test_whole_body_mae(subject, slab_thickness):
+    args = (subject["pred_pet"], subject["gt_pet"], subject["ts_body"], subject["ts_total"], subject["meta_json"])
+
+    value = metrics.compute_whole_body_suv_mae(*args, slab_thickness=slab_thickness)
+
+    assert value == pytest.approx(reference_whole_body_mae(subject), rel=1e-6)
+    assert metrics.compute_whole_body_suv_mae(*args, slab_thickness=slab_thickness) == value
+
+
+@pytest.mark.parametrize("dynamic", [False, True])
+def test_organ_bias(subject, dynamic):
+    pred, gt = (subject["pred_4d"], subject["gt_4d"]) if dynamic else (subject["pred_pet"], subject["gt_pet"])
+
+    value = metrics.compute_organ_bias_from_totalseg(
+        pred, gt, subject["ts_total"], ORGAN_LABELS, subject["meta_json"]
+    )
+
+    assert value == pytest.approx(reference_organ_bias(pred, gt, subject), rel=1e-6)
+
+
+def test_float32_matches_float64(subject):
+    args = (subject["pred_4d"], subject["gt_4d"], subject["ts_total"], ORGAN_LABELS, subject["meta_json"])
+
+    single = metrics.compute_organ_bias_from_totalseg(*args)
+    metrics.set_pet_dtype("float64")
+    metrics.get_cache().clear()
+    double = metrics.compute_organ_bias_from_totalseg(*args)
+
+    assert single == pytest.approx(double, rel=1e-6)
+    with pytest.raises(ValueError):
+        metrics.set_pet_dtype("float16")
+
+
+def test_tac_bias(subject):
+    durations = np.array([30.0, 60.0, 120.0, 300.0])
+    args = (subject["ts_total"], subject["synthseg"], durations, AORTA_LABEL, BRAIN_LABELS)
+
+    value = metrics.compute_tac_bias(subject["pred_4d"], subject["gt_4d"], *args)
+    expected = reference_tac_bias(read(subject["pred_4d"]), read(subject["gt_4d"]), subject, durations)
+
+    assert value == pytest.approx(expected, rel=1e-6)
+
+
+def test_tac_bias_virtual_dynamic(subject):
+    durations = np.full(8, 60.0)
+    args = (subject["ts_total"], subject["synthseg"], durations, AORTA_LABEL, BRAIN_LABELS)
+
+    value = metrics.compute_tac_bias(
+        expand_to_4d(subject["pred_pet"]), expand_to_4d(subject["gt_pet"]), *args
+    )
+    pred = np.repeat(read(subject["pred_pet"])[..., None], 8, axis=-1)
+    gt = np.repeat(read(subject["gt_pet"])[..., None], 8, axis=-1)
+
+    assert value == pytest.approx(reference_tac_bias(pred, gt, subject, durations), rel=1e-6)
+
+
+@pytest.mark.parametrize("dynamic", [False, True])
+def test_brain_k_values(subject, dynamic):
+    pred, gt = (subject["pred_4d"], subject["gt_4d"]) if dynamic else (subject["pred_pet"], subject["gt_pet"])
+    thresholds = (0.05, 0.10, 0.15)
+    brain = read(subject["synthseg"]) > 0
+
+    k_values = metrics.compute_brain_k_values([pred], [gt], [subject["synthseg"]], thresholds)
+    expected = [reference_k_value(read(pred), read(gt), brain, t) for t in thresholds]
+
+    np.testing.assert_allclose(k_values[0], expected, rtol=1e-12)
+
+
+def test_brain_k_values_virtual_dynamic(subject):
+    paths = [subject["pred_pet"]], [subject["gt_pet"]], [subject["synthseg"]]
+    virtual = [expand_to_4d(subject["pred_pet"])], [expand_to_4d(subject["gt_pet"])], [subject["synthseg"]]
+
+    np.testing.assert_array_equal(metrics.compute_brain_k_values(*virtual), metrics.compute_brain_k_values(*paths))
+
+
+def test_auc_of_K_is_exact():
+    rng = np.random.default_rng(4)
+
+    for num_cases in (1, 2, 7, 50):
+        k_values = rng.random(num_cases)
+        k_values[rng.random(num_cases) < 0.3] = rng.choice([0.0, 0.5, 1.0, 1.2, -0.1])
+
+        for num_points in (2, 10, 1000):
+            expected = reference_auc_of_K(k_values, num_points)
+            areas = k_value_areas(k_values, num_points)
+
+            assert compute_auc_of_K(k_values, num_points) == expected
+            assert areas.mean() == pytest.approx(expected, abs=1e-12)
+            for k, area in zip(k_values, areas):
+                assert area == reference_auc_of_K([k], num_points)
+
+
+def test_brain_outlier_score_from_k():
+    k_values = np.random.default_rng(5).random((9, 3))
+
+    score = metrics.brain_outlier_score_from_k(k_values)
+    case_scores = metrics.brain_outlier_case_scores(k_values)
+
+    assert score == np.mean([reference_auc_of_K(k_values[:, i]) for i in range(3)])
+    assert case_scores.mean() == pytest.approx(score, abs=1e-12)
+
+
+# =========================================================
+# Dynamic PET
+# =========================================================
+
+def test_iter_frames_matches_volume(subject):
+    frames = list(iter_frames(subject["gt_4d"]))
+
+    np.testing.assert_allclose(np.stack(frames, axis=-1), read(subject["gt_4d"]), rtol=1e-6)
+
+
+def test_frame_durations_from_metadata(subject, tmp_path):
+    sidecar = metrics.sidecar_json_path(subject["pred_4d"])
+    with open(sidecar, "w") as f:
+        json.dump({"FrameDuration": [30, 60, 120, 300]}, f)
+
+    assert sidecar.endswith("_pred_4d.json")
+    np.testing.assert_array_equal(
+        metrics.load_frame_durations([str(tmp_path / "none.json"), sidecar], 4), [30, 60, 120, 300]
+    )
+    np.testing.assert_array_equal(metrics.load_frame_durations([subject["meta_json"]], 3), [4.0, 4.0, 4.0])
+    with pytest.raises(ValueError):
+        metrics.load_frame_durations([sidecar], 5)
@@ -0,0 +1,47 @@
+"""
+Synthetic phantoms: deterministic and readable by the evaluation tool
+and the baseline model.
+"""
+
+import numpy as np
+import nibabel as nib
+
+from benchmarks.phantom import make_cohort, make_phantom
+from cohort import ORGAN_LABELS, evaluate_subject
+from utils import get_input_images
+
+
+SHAPE = (24, 24, 36)
+
+
+def test_phantoms_are_deterministic(tmp_path):
+    first = make_phantom(str(tmp_path / "a"), "sub-000", shape=SHAPE, seed=3)
+    second = make_phantom(str(tmp_path / "b"), "sub-000", shape=SHAPE, seed=3)
+    other = make_phantom(str(tmp_path / "c"), "sub-001", shape=SHAPE, seed=3)
+
+    for key in ("pred_pet", "ts_total", "ref_ct"):
+        np.testing.assert_array_equal(nib.load(first[key]).dataobj, nib.load(second[key]).dataobj)
+    assert not np.array_equal(nib.load(first["pred_pet"]).dataobj, nib.load(other["pred_pet"]).dataobj)
+
+
+def test_phantom_draws_every_scored_organ(tmp_path):
+    paths = make_phantom(str(tmp_path), "sub-000", shape=SHAPE, seed=3)
+    labels = np.unique(np.asarray(nib.load(paths["ts_total"]).dataobj))
+
+    assert set(ORGAN_LABELS.values()) <= set(labels)
+
+
+def test_phantom_cohort_evaluates(tmp_path):
+    root = str(tmp_path)
+    subjects = make_cohort(root, 2, shape=SHAPE, frames=4)
+
+    assert subjects == ["sub-000", "sub-001"]
+    assert set(get_input_images(tmp_path / "sub-000" / "input")) >= {"nacstat_pet", "topogram"}
+
+    for subject in subjects:
+        results, brain_k_values = evaluate_subject(root, subject)
+
+        assert {"whole_body_mae", "brain_outlier", "organ_bias", "tac_bias"} <= set(results)
+        assert all(np.isfinite(v) for v in results.values())
+        assert 0 < results["organ_bias"] < 1
+        assert len(brain_k_values) == 3
@@ -0,0 +1,55 @@
+"""
+Stage pipeline against a sequential run.
+"""
+
+import threading
+import time
+
+from pipeline import Stage, run_pipeline
+
+
+def test_pipeline_matches_sequential_run():
+    values = list(range(12))
+
+    def slow_square(x):
+        time.sleep(0.001 * (x % 3))
+        return x * x
+
+    items, stats, wall = run_pipeline(
+        [(f"item-{v}", v) for v in values],
+        [Stage("square", slow_square, workers=3), Stage("shift", lambda x: x + 1, workers=2, queue_size=1)],
+        log=lambda *_: None,
+    )
+
+    assert [item.key for item in items] == [f"item-{v}" for v in values]
+    assert [item.value for item in items] == [v * v + 1 for v in values]
+    assert all(item.ok for item in items)
+    assert [(st.name, st.items, st.failures) for st in stats] == [("square", 12, 0), ("shift", 12, 0)]
+    assert wall > 0
+
+
+def test_pipeline_failed_items_skip_later_stages():
+    seen = []
+    lock = threading.Lock()
+
+    def check(x):
+        if x % 4 == 0:
+            raise ValueError(f"bad item {x}")
+        return x
+
+    def record(x):
+        with lock:
+            seen.append(x)
+        return x
+
+    items, stats, _ = run_pipeline(
+        [(v, v) for v in range(10)], [Stage("check", check, workers=2), Stage("record", record)],
+        log=lambda *_: None,
+    )
+
+    failed = [item for item in items if not item.ok]
+    assert [item.key for item in failed] == [0, 4, 8]
+    assert all(item.failed_stage == "check" and "bad item" in item.error for item in failed)
+    assert sorted(seen) == [1, 2, 3, 5, 6, 7, 9]
+    assert (stats[0].items, stats[0].failures) == (10, 3)
+    assert (stats[1].items, stats[1].failures) == (7, 0)
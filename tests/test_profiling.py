@@ -0,0 +1,87 @@
+"""
+Profiling spans and reports.
+"""
+
+import tracemalloc
+
+import numpy as np
+import pytest
+
+import metrics
+
+from conftest import ORGAN_LABELS
+
+
+@pytest.fixture
+def profiler():
+    profiler = metrics.start_profiling()
+    yield profiler
+    metrics.stop_profiling()
+
+
+def test_profiling_leaves_metrics_unchanged(subject, profiler):
+    args = (subject["pred_pet"], subject["gt_pet"], subject["ts_total"], ORGAN_LABELS, subject["meta_json"])
+
+    profiled = metrics.compute_organ_bias_from_totalseg(*args)
+    metrics.stop_profiling()
+    metrics.get_cache().clear()
+
+    assert metrics.compute_organ_bias_from_totalseg(*args) == profiled
+
+    names = {s["name"] for s in profiler.spans}
+    assert "compute_organ_bias_from_totalseg" in names
+    # The metric is the outermost span
+    top = [s for s in profiler.spans if s["depth"] == 0]
+    assert [s["name"] for s in top] == ["compute_organ_bias_from_totalseg"]
+
+
+def test_nested_spans_and_reports(profiler):
+    with metrics.span("outer"):
+        with metrics.span("inner", "io"):
+            block = np.ones(1 << 20)  # 8 MiB
+            del block
+
+    inner, outer = profiler.spans
+    summary = metrics.summarize_spans(profiler.spans)
+
+    assert (inner["name"], inner["depth"], outer["depth"]) == ("inner", 1, 0)
+    assert inner["peak_traced"] >= 8 << 20
+    assert outer["peak_traced"] >= inner["peak_traced"]
+    assert outer["wall"] >= inner["wall"]
+    assert summary["inner"]["calls"] == 1 and summary["inner"]["category"] == "io"
+    assert "outer" in metrics.format_summary(summary)
+
+    profiles = [{"subject": s, "start": 100.0 + i, "spans": profiler.spans, "summary": summary}
+                for i, s in enumerate(["sub-000", "sub-001"])]
+    cohort = metrics.aggregate_profiles(profiles)
+    trace = metrics.chrome_trace(profiles)
+
+    assert cohort["inner"]["subjects"] == 2
+    assert cohort["inner"]["wall"]["total"] == pytest.approx(2 * inner["wall"])
+    assert len(trace["traceEvents"]) == 4
+    assert trace["traceEvents"][2]["ts"] == pytest.approx(1e6 + trace["traceEvents"][0]["ts"])
+
+
+def test_spans_are_free_when_off():
+    assert metrics.profiling.get_profiler() is None
+
+    with metrics.span("ignored"):
+        pass
+
+    assert metrics.stop_profiling() is None
+
+
+def test_caller_tracemalloc_is_left_running():
+    tracemalloc.start()
+    try:
+        metrics.start_profiling()
+        metrics.stop_profiling()
+
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+
+    metrics.start_profiling()
+    metrics.stop_profiling()
+
+    assert not tracemalloc.is_tracing()
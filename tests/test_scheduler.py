@@ -0,0 +1,160 @@
+"""
+Container scheduler, against a fake ``docker`` on PATH.
+"""
+
+import json
+import os
+import sys
+
+import pytest
+
+import scheduler
+from scheduler import ContainerJob, JobLedger, Mount, load_report, parse_memory, run_jobs
+
+
+FAKE_DOCKER = """#!{python}
+import os, sys, time
+
+args = sys.argv[1:]
+if args[0] in ("rm", "inspect"):
+    sys.exit(0 if args[0] == "rm" else 1)
+
+mounts, i = {{}}, 1
+while i < len(args):
+    if args[i] == "-v":
+        host, target = args[i + 1].split(":")[:2]
+        mounts[target] = host
+        i += 2
+    elif args[i] in ("--name", "--cpus", "--memory"):
+        i += 2
+    elif args[i] == "--rm":
+        i += 1
+    else:
+        break
+
+subject = os.path.basename(mounts["/input"])
+print("running", subject)
+if subject == "sub-slow":
+    time.sleep(10)
+if subject == "sub-oom":
+    time.sleep(0.5)
+    sys.exit(137)
+if subject == "sub-bad":
+    print("boom: model crashed", file=sys.stderr)
+    sys.exit(3)
+with open(os.path.join(mounts["/output"], os.path.basename(args[-1])), "w") as f:
+    f.write(subject)
+"""
+
+
+@pytest.fixture
+def fake_docker(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    docker = bin_dir / "docker"
+    docker.write_text(FAKE_DOCKER.format(python=sys.executable))
+    docker.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+
+def make_job(tmp_path, subject):
+    input_dir = tmp_path / "input" / subject
+    output_dir = tmp_path / "output" / subject
+    input_dir.mkdir(parents=True)
+    output_dir.mkdir(parents=True)
+    return ContainerJob(
+        subject, "model:latest", ["/output/pred.nii.gz"],
+        mounts=[Mount(input_dir, "/input", read_only=True), Mount(output_dir, "/output")],
+        outputs=[output_dir / "pred.nii.gz"],
+    )
+
+
+# =========================================================
+# Scheduler
+# =========================================================
+
+def test_docker_cmd():
+    job = ContainerJob("sub-000", "model:latest", ["/output/pred.nii.gz"],
+                       mounts=[Mount("/data/in", "/input", read_only=True), Mount("/data/out", "/output")])
+
+    assert job.docker_cmd("eval-sub-000", cpus=2, memory="8g") == [
+        "docker", "run", "--rm", "--name", "eval-sub-000", "--cpus", "2", "--memory", "8g",
+        "-v", "/data/in:/input:ro", "-v", "/data/out:/output", "model:latest", "/output/pred.nii.gz",
+    ]
+
+
+def test_run_jobs_statuses_and_reports(tmp_path, fake_docker):
+    jobs = [make_job(tmp_path, s) for s in ("sub-000", "sub-bad", "sub-001", "sub-slow")]
+    report_dir = tmp_path / "reports"
+
+    results = run_jobs(jobs, workers=2, retries=1, timeout=1.0, report_dir=report_dir, log=lambda *_: None)
+
+    assert [r.job_id for r in results] == ["sub-000", "sub-bad", "sub-001", "sub-slow"]
+    assert [r.status for r in results] == ["done", "failed", "done", "timeout"]
+    assert results[1].attempts == 2 and results[1].returncode == 3
+    assert "boom" in results[1].error
+    assert (tmp_path / "output" / "sub-001" / "pred.nii.gz").read_text() == "sub-001"
+
+    report = load_report(report_dir / "sub-000.json")
+    assert report.status == "done" and report.usage.wall_s > 0
+    # No container cgroup: the docker client's own usage is not reported as the container's
+    assert report.usage.source is None and report.usage.cpu_s is None
+    assert json.loads((report_dir / "sub-000.json").read_text())["limits"]["wall_s"] == 1.0
+    assert (report_dir / "sub-bad.stderr.log").read_text().startswith("boom")
+
+    summary = json.loads((report_dir / "summary.json").read_text())
+    assert summary["jobs"] == 4
+    assert summary["statuses"] == {"done": 2, "failed": 1, "timeout": 1}
+
+
+@pytest.fixture
+def fake_cgroup(tmp_path, monkeypatch):
+    container_id = "ab" * 32
+    cgroup = tmp_path / "cgroup" / "docker" / container_id
+    cgroup.mkdir(parents=True)
+    (cgroup / "cpu.stat").write_text("usage_usec 2500000\nuser_usec 2000000\nsystem_usec 500000\n")
+    (cgroup / "memory.peak").write_text(f"{1 << 30}\n")
+    (cgroup / "memory.events").write_text("low 0\nhigh 0\nmax 4\noom 1\noom_kill 1\n")
+    monkeypatch.setattr(scheduler, "CGROUP_ROOT", tmp_path / "cgroup")
+    monkeypatch.setattr(scheduler, "_container_id", lambda name: container_id)
+    return cgroup
+
+
+def test_cgroup_usage_and_limits(tmp_path, fake_docker, fake_cgroup):
+    oom, slow = make_job(tmp_path, "sub-oom"), make_job(tmp_path, "sub-slow")
+
+    oom_result, = run_jobs([oom], memory="1g", log=lambda *_: None)
+    slow_result, = run_jobs([slow], cpu_time=1.0, log=lambda *_: None)
+
+    assert (oom_result.status, oom_result.error) == ("killed", "out of memory (limit 1g)")
+    assert oom_result.usage.source == "cgroup"
+    assert (oom_result.usage.cpu_s, oom_result.usage.peak_memory_bytes) == (2.5, 1 << 30)
+    assert slow_result.status == "killed" and "CPU time" in slow_result.error
+    assert slow_result.duration < 5
+
+
+def test_ledger_resumes_and_keeps_summary(tmp_path, fake_docker):
+    jobs = [make_job(tmp_path, s) for s in ("sub-000", "sub-bad")]
+    ledger = JobLedger(tmp_path / "ledger.jsonl")
+    report_dir = tmp_path / "reports"
+
+    run_jobs(jobs, ledger=ledger, report_dir=report_dir, log=lambda *_: None)
+    first = json.loads((report_dir / "summary.json").read_text())
+    results = run_jobs(jobs, ledger=ledger, report_dir=report_dir, log=lambda *_: None)
+    second = json.loads((report_dir / "summary.json").read_text())
+
+    assert [r.status for r in results] == ["skipped", "failed"]
+    assert ledger.completed(jobs) == {"sub-000"}
+    assert second["statuses"] == first["statuses"] == {"done": 1, "failed": 1}
+    assert second["resources"]["wall_s"]["max"] > 0
+
+    # A done job whose outputs are gone runs again
+    jobs[0].outputs[0].unlink()
+    assert ledger.completed(jobs) == set()
+
+
+def test_parse_memory():
+    assert parse_memory("8g") == 8 << 30
+    assert parse_memory("512m") == 512 << 20
+    assert parse_memory(1024) == 1024
+    assert parse_memory(None) is None
@@ -0,0 +1,115 @@
+"""
+Persistent volume store and result store.
+"""
+
+import os
+
+import numpy as np
+import nibabel as nib
+
+import metrics
+from metrics import VolumeStore
+
+from conftest import ORGAN_LABELS, SHAPE, save
+
+
+# =========================================================
+# Volume store
+# =========================================================
+
+def test_store_serves_identical_volumes(tmp_path, subject):
+    store = VolumeStore(tmp_path / "store")
+
+    first = store.load(subject["gt_pet"], np.float32)
+    second = store.load(subject["gt_4d"], np.float32)
+    again = store.load(subject["gt_pet"], np.float32)
+
+    np.testing.assert_array_equal(first, nib.load(subject["gt_pet"]).get_fdata(dtype=np.float32))
+    np.testing.assert_array_equal(second, nib.load(subject["gt_4d"]).get_fdata(dtype=np.float32))
+    assert isinstance(again, np.memmap)
+    assert len(store.entries()) == 2
+
+
+def test_store_rebuilds_changed_sources(tmp_path):
+    path = save(np.zeros((4, 4, 4), np.float32), tmp_path / "vol.nii.gz")
+    store = VolumeStore(tmp_path / "store")
+    store.load(path)
+
+    save(np.ones((4, 4, 4), np.float32), path)
+    os.utime(path, ns=(1, 1))
+
+    np.testing.assert_array_equal(store.load(path), 1)
+
+
+def test_store_cap_keeps_latest_volume(tmp_path, subject):
+    # Room for one volume: the least recently used one is evicted
+    store = VolumeStore(tmp_path / "store", max_bytes=int(np.prod(SHAPE)) * 4)
+
+    store.load(subject["gt_pet"], np.float32)
+    store.load(subject["pred_pet"], np.float32)
+
+    (name, *_), = store.entries()
+    assert name.startswith(os.path.basename(subject["pred_pet"]).split(".nii")[0])
+
+
+def test_store_derived_entries(tmp_path, subject):
+    store = VolumeStore(tmp_path / "store")
+    calls = []
+
+    def build():
+        calls.append(1)
+        return np.arange(5), {"n": 5}
+
+    assert not store.has_derived(subject["ts_total"], "test")
+
+    data, meta = store.load_derived(subject["ts_total"], "test", build)
+    again, meta_again = store.load_derived(subject["ts_total"], "test", build)
+
+    assert store.has_derived(subject["ts_total"], "test")
+    assert calls == [1]
+    np.testing.assert_array_equal(again, np.arange(5))
+    assert meta == meta_again == {"n": 5}
+
+
+def test_metrics_unchanged_with_store(tmp_path, subject):
+    args = (subject["pred_pet"], subject["gt_pet"], subject["ts_total"],
+            ORGAN_LABELS, subject["meta_json"])
+
+    direct = metrics.compute_organ_bias_from_totalseg(*args)
+
+    metrics.get_cache().clear()
+    metrics.configure_store(str(tmp_path / "store"))
+    stored = metrics.compute_organ_bias_from_totalseg(*args)
+    metrics.get_cache().clear()
+    reloaded = metrics.compute_organ_bias_from_totalseg(*args)
+
+    assert direct == stored == reloaded
+
+
+# =========================================================
+# Result store
+# =========================================================
+
+def test_result_store_serves_and_keys_by_content(tmp_path, subject):
+    store = metrics.configure_result_store(str(tmp_path / "results.db"))
+    args = (subject["pred_pet"], subject["gt_pet"], subject["ts_total"],
+            ORGAN_LABELS, subject["meta_json"])
+
+    first = metrics.compute_organ_bias_from_totalseg(*args)
+    second = metrics.compute_organ_bias_from_totalseg(*args)
+
+    assert first == second
+    assert (store.hits, store.misses) == (1, 1)
+
+    # A different prediction is a different key
+    pred = nib.load(subject["pred_pet"]).get_fdata(dtype=np.float32)
+    other = save(pred * 1.5, tmp_path / "other_pred.nii.gz")
+    changed = metrics.compute_organ_bias_from_totalseg(other, *args[1:])
+
+    assert store.misses == 2
+    assert changed != first
+
+    metrics.configure_result_store(None)
+    metrics.get_cache().clear()
+
+    assert metrics.compute_organ_bias_from_totalseg(*args) == first
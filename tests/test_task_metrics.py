@@ -0,0 +1,82 @@
+"""
+Task 1/2 error statistics (z-slab streaming) against whole-volume
+references.
+"""
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+from conftest import load_task_metrics, save
+
+
+def read(path):
+    return nib.load(path).get_fdata()
+
+
+@pytest.fixture
+def ct_study(tmp_path):
+    rng = np.random.default_rng(6)
+    shape = (20, 18, 26)
+
+    ref = rng.uniform(-1024, 1500, shape).astype(np.float32)
+    pred = ref + rng.normal(0, 40, shape).astype(np.float32)
+    seg = np.zeros(shape, np.uint8)
+    seg[2:18, 3:15, 4:22] = 1
+
+    return tuple(
+        nib.load(save(data, tmp_path / f"{name}.nii.gz"))
+        for name, data in (("pred", pred), ("ref", ref), ("seg", seg))
+    )
+
+
+def reference_ct_stats(prediction, label, label_seg, edges):
+    body = read(label_seg.get_filename()) > 0
+    ref = label.get_fdata(dtype=np.float32)[body].astype(np.float64)
+    error = prediction.get_fdata(dtype=np.float32)[body].astype(np.float64) - ref
+    bins = np.searchsorted(edges, ref, side="right")
+
+    return {
+        "mae": np.mean(np.abs(error)),
+        "bias": np.mean(error),
+        "rmse": np.sqrt(np.mean(error ** 2)),
+        "bin_maes": [np.mean(np.abs(error[bins == b])) for b in range(len(edges) + 1)],
+    }
+
+
+@pytest.mark.parametrize("chunk_voxels", [1 << 22, 500])
+@pytest.mark.parametrize("with_index", [False, True])
+def test_ct_error_stats(tmp_path, ct_study, monkeypatch, chunk_voxels, with_index):
+    task_metrics = load_task_metrics()
+    monkeypatch.setattr(task_metrics, "CHUNK_VOXELS", chunk_voxels)
+
+    if with_index:
+        # Store of the evaluation tool package as imported by task_metrics
+        from evaluation_tool.metrics import VolumeStore, load_segmentation_index, volume_store
+
+        monkeypatch.setattr(volume_store, "_store", VolumeStore(tmp_path / "store"))
+        load_segmentation_index(ct_study[2].get_filename())
+
+    # Used only if already stored, never built
+    assert (task_metrics._segmentation_index(ct_study[2]) is not None) == with_index
+
+    stats = task_metrics.ct_error_stats(*ct_study)
+    expected = reference_ct_stats(*ct_study, task_metrics.HU_BIN_EDGES)
+
+    assert stats["mae"] == pytest.approx(expected["mae"], rel=1e-9)
+    assert stats["bias"] == pytest.approx(expected["bias"], rel=1e-9)
+    assert stats["rmse"] == pytest.approx(expected["rmse"], rel=1e-9)
+    for name, mae in zip(task_metrics.HU_BIN_NAMES, expected["bin_maes"]):
+        assert stats[f"mae_{name}"] == pytest.approx(mae, rel=1e-9)
+    assert stats["histogram"].sum() == stats["count"]
+
+
+def test_pet_mae_in_suv(ct_study):
+    task_metrics = load_task_metrics()
+    pred, ref, seg = ct_study
+    body = read(seg.get_filename()) > 0
+    error = pred.get_fdata(dtype=np.float32)[body].astype(np.float64) - ref.get_fdata(dtype=np.float32)[body]
+
+    mae = task_metrics.mae_suv_pet(pred, ref, seg, 250.0)
+
+    assert mae == pytest.approx(np.mean(np.abs(error)) / 250.0, rel=1e-9)
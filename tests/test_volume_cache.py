@@ -0,0 +1,101 @@
+"""
+Run-wide volume cache and its loaders.
+"""
+
+import os
+
+import numpy as np
+import nibabel as nib
+
+import metrics
+from metrics.volume_cache import VirtualDynamicImage, VolumeCache, load_labels, load_mask, load_static_frame, load_volume
+
+
+def counting_factory(calls, name, size=100):
+    def build():
+        calls.append(name)
+        return np.zeros(size)  # 8 bytes per element
+    return build
+
+
+def test_cache_evicts_least_recently_used():
+    cache = VolumeCache(max_bytes=3 * 800)
+    calls = []
+
+    for name in "abc":
+        cache.get(("/" + name, "volume"), counting_factory(calls, name))
+
+    cache.get(("/a", "volume"), counting_factory(calls, "a"))  # a is now the most recent
+    cache.get(("/d", "volume"), counting_factory(calls, "d"))  # evicts b
+    cache.get(("/a", "volume"), counting_factory(calls, "a"))
+    cache.get(("/b", "volume"), counting_factory(calls, "b"))  # rebuilt
+
+    assert calls == ["a", "b", "c", "d", "b"]
+    assert cache.nbytes == 3 * 800
+    assert (cache.hits, cache.misses) == (2, 5)
+
+
+def test_cache_values_are_read_only_and_drop_by_path():
+    cache = VolumeCache()
+    calls = []
+
+    value = cache.get(("/x", "volume"), lambda: np.ones(4))
+    cache.get(("/x", "mask"), counting_factory(calls, "x-mask", 4))
+    cache.get(("/y", "volume"), counting_factory(calls, "y", 4))
+
+    assert not value.flags.writeable
+
+    cache.drop("/x")
+    cache.get(("/x", "mask"), counting_factory(calls, "x-mask", 4))
+    cache.get(("/y", "volume"), counting_factory(calls, "y", 4))
+
+    assert calls == ["x-mask", "y", "x-mask"]
+
+
+def test_cache_skips_values_over_budget():
+    cache = VolumeCache(max_bytes=100)
+    calls = []
+
+    cache.get(("/big", "volume"), counting_factory(calls, "big", 1000))
+    cache.get(("/big", "volume"), counting_factory(calls, "big", 1000))
+
+    assert calls == ["big", "big"]
+    assert cache.nbytes == 0
+
+
+def test_loaders_match_nibabel(subject):
+    gt = load_volume(subject["gt_pet"])
+    labels = load_labels(subject["ts_total"])
+    mask = load_mask(subject["ts_total"])
+
+    np.testing.assert_array_equal(gt, nib.load(subject["gt_pet"]).get_fdata(dtype=np.float32))
+    np.testing.assert_array_equal(labels, np.asanyarray(nib.load(subject["ts_total"]).dataobj))
+    np.testing.assert_array_equal(mask, labels > 0)
+    assert gt.dtype == np.float32
+    assert np.issubdtype(labels.dtype, np.integer)
+
+    hits = metrics.get_cache().hits
+    assert load_volume(subject["gt_pet"]) is gt
+    assert metrics.get_cache().hits == hits + 1
+
+
+def test_suv_copy_is_not_cached(subject):
+    factor = metrics.suv_utils.suv_norm_factor(subject["meta_json"])
+
+    suv = metrics.suv_utils.load_pet_as_suv(subject["gt_pet"], subject["meta_json"])
+
+    # Only the raw volume is resident
+    assert metrics.get_cache().nbytes == load_volume(subject["gt_pet"]).nbytes
+    np.testing.assert_allclose(suv, load_volume(subject["gt_pet"]) * factor)
+
+
+def test_static_frames(subject):
+    virtual = VirtualDynamicImage(subject["gt_pet"], num_frames=5)
+    files = sorted(os.listdir(os.path.dirname(subject["gt_pet"])))
+
+    assert virtual.shape == nib.load(subject["gt_pet"]).shape + (5,)
+    np.testing.assert_array_equal(virtual.dataobj[..., 3], load_volume(subject["gt_pet"]))
+    np.testing.assert_array_equal(load_static_frame(virtual), load_volume(subject["gt_pet"]))
+    np.testing.assert_allclose(load_static_frame(subject["gt_4d"]), nib.load(subject["gt_4d"]).get_fdata()[..., 0],
+                               rtol=1e-6)
+    assert sorted(os.listdir(os.path.dirname(subject["gt_pet"]))) == files  # nothing written